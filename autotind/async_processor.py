@@ -0,0 +1,203 @@
+import time
+import asyncio
+import inspect
+import threading
+from loguru import logger
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, List, Optional, Union
+from autotind import metrics
+from autotind.processor import MAIN_STAGE, BaseProcessor, BaseStage, Message, group_tasks
+
+
+class AsyncStage(BaseStage):
+    """
+    An asyncio queue drained by `num_workers` tasks on the processor's loop. Coroutine handlers are awaited on the loop,
+    plain handlers run in a pool of `num_workers` threads so blocking DB work never holds the loop.
+
+    With `max_queue`, putting work on a full queue blocks the calling thread until there is room. The loop itself can't
+    wait: coroutine handlers adding work to a full queue get `asyncio.QueueFull`, plain handlers can hand it over.
+    """
+    def __init__(self, processor: "AsyncProcessor", name: str, num_workers: int, max_batch: int, max_queue: int = 0,
+                 high_water: int = 0, spill_dir: Optional[Union[str, Path]] = None, spill_max_mb: int = 512):
+        super().__init__(name, max_batch, high_water, spill_dir, spill_max_mb)
+        self.processor = processor
+        self.num_workers = num_workers
+        self.queue: asyncio.Queue = asyncio.Queue(max_queue)
+        self.executor: Optional[ThreadPoolExecutor] = None
+        self.tasks: List[asyncio.Task] = []
+        # Handed over to the loop but not queued yet
+        self._in_flight = 0
+        self._in_flight_lock = threading.Lock()
+
+    def queued(self) -> int:
+        return self.queue.qsize() + self._in_flight
+
+    def put(self, message: Message):
+        if self.processor.loop is None or self.processor.on_loop():
+            self.queue.put_nowait(message)
+        elif not self.queue.maxsize:
+            # Never full, e.g. interceptors on mitmproxy's loop hand work over without waiting for the processor's loop
+            with self._in_flight_lock:
+                self._in_flight += 1
+            self.processor.loop.call_soon_threadsafe(self._arrive, message)
+        else:
+            asyncio.run_coroutine_threadsafe(self.queue.put(message), self.processor.loop).result()
+
+    def _arrive(self, message: Message):
+        self.queue.put_nowait(message)
+        with self._in_flight_lock:
+            self._in_flight -= 1
+
+    def start(self):
+        self.executor = ThreadPoolExecutor(max_workers=self.num_workers, thread_name_prefix=self.name,
+                                           initializer=self.processor._mark_handler_thread)
+        self.tasks = [ asyncio.create_task(self._work(), name=f"{self.name}-{id}") for id in range(1, self.num_workers + 1) ]
+        metrics.stage_workers.labels(stage=self.name).set(self.num_workers)
+
+    async def _work(self):
+        stopping = False
+        while not stopping:
+            task = await self.queue.get()
+            tasks = []
+            # Same draining as the process workers: up to `max_batch` messages, stopping at a shutdown sentinel
+            while task is not None:
+                tasks.append(task)
+                if len(tasks) >= self.max_batch:
+                    break
+                try:
+                    task = self.queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    break
+            stopping = task is None
+            for workname, payloads in group_tasks(tasks):
+                await self._dispatch(workname, payloads)
+
+    async def _call(self, workname: str, handler: Callable[[Any], Any], data: Any):
+        start = time.perf_counter()
+        try:
+            if inspect.iscoroutinefunction(handler):
+                await handler(data)
+            else:
+                await asyncio.get_running_loop().run_in_executor(self.executor, handler, data)
+        except Exception as e:
+            metrics.task_errors.labels(task=workname).inc()
+            logger.error(f"{workname}: {e}")
+        finally:
+            metrics.task_seconds.labels(task=workname).observe(time.perf_counter() - start)
+
+    async def _dispatch(self, workname: str, payloads: List[Any]):
+        if workname in self.processor.batch_handlers:
+            await self._call(workname, self.processor.batch_handlers[workname], payloads)
+        elif workname in self.processor.handlers:
+            for data in payloads:
+                await self._call(workname, self.processor.handlers[workname], data)
+        else:
+            logger.error(f"No handler function for task `{workname}`")
+
+    async def stop(self):
+        for _ in self.tasks:
+            await self.queue.put(None)
+        await asyncio.gather(*self.tasks)
+        self.executor.shutdown(wait=True)
+        logger.info(f"Stage {self.name} stopped")
+        if self.spill is not None and len(self.spill):
+            logger.info(f"{len(self.spill)} messages stay spilled in {self.spill.path} until the next start")
+
+class AsyncProcessor(BaseProcessor):
+    """
+    Runs handlers as tasks on an event loop of its own, in a thread of this process, so work handed over by an
+    interceptor is never pickled or sent to another process. Handlers may be coroutine functions.
+
+    Every stage has a fixed number of worker tasks, the `min_workers` and `idle_timeout` arguments of `add_stage` are
+    accepted for compatibility with `Processor` and ignored. Spilled work is queued again every `scale_interval` seconds.
+    """
+    is_async = True
+    def __init__(self, num_workers: int = 4, max_batch: int = 64, high_water: int = 0, spill_dir: Optional[Union[str, Path]] = None,
+                 spill_max_mb: int = 512, scale_interval: float = 1.0):
+        super().__init__(max_batch)
+        self.scale_interval = scale_interval
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[threading.Thread] = None
+        self._maintainer: Optional[threading.Thread] = None
+        self._handler_thread = threading.local()
+        self.queue = self.add_stage(MAIN_STAGE, num_workers, high_water=high_water, spill_dir=spill_dir, spill_max_mb=spill_max_mb).queue
+
+    def add_stage(self, name: str, num_workers: int, max_queue: int = 0, max_batch: Optional[int] = None, min_workers: Optional[int] = None,
+                  idle_timeout: float = 0, high_water: int = 0, spill_dir: Optional[Union[str, Path]] = None, spill_max_mb: int = 512) -> AsyncStage:
+        if name in self.stages:
+            raise ValueError(f"Stage `{name}` already exists")
+        self.stages[name] = AsyncStage(self, name, num_workers, max_batch or self.max_batch, max_queue, high_water, spill_dir, spill_max_mb)
+        return self.stages[name]
+
+    def on_loop(self) -> bool:
+        return threading.current_thread() is self._loop_thread
+
+    def _mark_handler_thread(self):
+        self._handler_thread.active = True
+
+    def in_handler(self) -> bool:
+        return self.on_loop() or getattr(self._handler_thread, 'active', False)
+
+    def _put(self, message: Message, items: int):
+        workname = message[0]
+        stage = self.routes.get(workname) or self.stages[MAIN_STAGE]
+        # Only work added from outside the processor spills, handlers handing work to the next stage wait for room instead
+        if workname in self.low_priority and not self.in_handler():
+            stage.admit(message, items)
+        else:
+            stage.put(message)
+        metrics.tasks_enqueued.labels(task=workname).inc(items)
+
+    def _run_maintainer(self):
+        while not self._stopping.wait(self.scale_interval):
+            for stage in self.stages.values():
+                try:
+                    stage.replay_spill()
+                except Exception as e:
+                    logger.error(f"Replaying spilled work of stage {stage.name}: {e}")
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    async def _start_stages(self):
+        for stage in self.stages.values():
+            stage.start()
+
+    def start(self):
+        """
+        Starts the loop thread and the worker tasks on it.
+        """
+        self.loop = asyncio.new_event_loop()
+        # `asyncio.to_thread` in coroutine handlers runs on these, they wait for room like the stages' threads
+        self.loop.set_default_executor(ThreadPoolExecutor(thread_name_prefix='processor', initializer=self._mark_handler_thread))
+        self._loop_thread = threading.Thread(target=self._run_loop, name='processor-loop', daemon=True)
+        self._loop_thread.start()
+        asyncio.run_coroutine_threadsafe(self._start_stages(), self.loop).result()
+        self.started = True
+        self._maintainer = threading.Thread(target=self._run_maintainer, name='processor-maintainer', daemon=True)
+        self._maintainer.start()
+
+    def _shutdown(self):
+        for hook in self.shutdown_hooks:
+            try:
+                hook()
+            except Exception as e:
+                logger.error(f"Shutdown hook {hook.__name__}: {e}")
+
+    def stop(self):
+        """
+        Also runs the shutdown hooks, while the loop still runs, then stops the loop. Must not be called from the loop.
+        """
+        self._stopping.set()
+        if self._maintainer is not None:
+            self._maintainer.join()
+        for stage in self.stages.values():
+            asyncio.run_coroutine_threadsafe(stage.stop(), self.loop).result()
+        self._shutdown()
+        asyncio.run_coroutine_threadsafe(self.loop.shutdown_default_executor(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._loop_thread.join()
+        self.loop.close()
+        self._run_stop_hooks()
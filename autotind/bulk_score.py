@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import argparse
+import numpy as np
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from loguru import logger
+from autotind.config import config
+from autotind.db import PersonRepo
+from autotind.person import Photo
+from autotind.scoring import load_model, to_input
+
+
+def _decode(jobs: List[Tuple[str, str]], size: int) -> List[Tuple[str, Optional[np.ndarray]]]:
+    from autotind.classifier.image_cache import load_resized
+    decoded = []
+    for photo_id, path in jobs:
+        try:
+            decoded.append((photo_id, load_resized(path, size)))
+        except Exception as e:
+            logger.warning(f"Could not decode {path}: {e}")
+            decoded.append((photo_id, None))
+    return decoded
+
+
+class BulkScorer:
+    """
+    Re-scores every stored person with a trained model. Persons are streamed from the database a page at a time,
+    their photos are decoded in a process pool while the previous page runs through the model, and scores are
+    written back with bulk updates:
+
+    - `PhotoDB.score`: like probability of the photo alone, `PhotoDB.rank`: its position by score within the profile
+    - `PersonDB.score`: like probability of the whole profile
+
+    After each page the last person id is saved to `checkpoint_path`, a rerun with the same model file resumes after it.
+    Once a pass is done, the next run only scores persons updated since that pass started. A different model, or
+    the same file changed on disk, starts over with every person.
+    """
+    def __init__(self, repo: PersonRepo, model_path: str, checkpoint_path: Union[str, Path], workers: Optional[int] = None,
+                 batch_size: int = 64, page_size: int = 500, threads: int = 0, size: int = 224):
+        self.repo = repo
+        self.model_path = model_path
+        self.checkpoint_path = Path(checkpoint_path)
+        self.workers = workers or os.cpu_count()
+        self.batch_size = batch_size
+        self.page_size = page_size
+        self.threads = threads
+        self.size = size
+        self.persons = 0
+        self.photos = 0
+        self.started_at = datetime.utcnow()
+
+    def _model_mtime(self) -> Optional[int]:
+        try:
+            return os.stat(self.model_path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _load_checkpoint(self) -> Tuple[Optional[str], Optional[datetime]]:
+        """
+        Returns where this run starts: the id to resume after and the update time persons are selected from.
+        """
+        if not self.checkpoint_path.exists():
+            return None, None
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        if checkpoint.get('model') != self.model_path or checkpoint.get('model_mtime') != self._model_mtime():
+            logger.info(f"Checkpoint {self.checkpoint_path} is for another model than {self.model_path}, starting over")
+            return None, None
+        if checkpoint.get('done'):
+            since = datetime.fromisoformat(checkpoint['started_at'])
+            logger.info(f"Last pass is done, scoring persons updated since {since}")
+            self.started_at = datetime.utcnow()
+            return None, since
+        self.persons, self.photos = checkpoint['persons'], checkpoint['photos']
+        self.started_at = datetime.fromisoformat(checkpoint['started_at'])
+        since = datetime.fromisoformat(checkpoint['since']) if checkpoint.get('since') else None
+        logger.info(f"Resuming after {checkpoint['last_id']} ({self.persons} persons already scored)")
+        return checkpoint['last_id'], since
+
+    def _save_checkpoint(self, last_id: Optional[str], since: Optional[datetime], done: bool = False):
+        tmp_path = self.checkpoint_path.with_suffix('.part')
+        with open(tmp_path, 'w') as f:
+            json.dump({ 'model': self.model_path, 'model_mtime': self._model_mtime(), 'last_id': last_id, 'done': done,
+                        'started_at': self.started_at.isoformat(), 'since': since.isoformat() if since else None,
+                        'persons': self.persons, 'photos': self.photos, 'updated_at': datetime.utcnow().isoformat() }, f)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def _pages(self, after: Optional[str], since: Optional[datetime] = None) -> Iterator[List[dict]]:
+        rows = self.repo.iter_rows(['_id'], ['id', 'user_id', 'fileName', 'width', 'height'], page_size=self.page_size, after=after, updated_since=since)
+        while True:
+            page = list(islice(rows, self.page_size))
+            if not page:
+                return
+            yield page
+
+    def _submit(self, pool: ProcessPoolExecutor, page: List[dict]) -> List[Future]:
+        keys = { photo['id']: Photo.key_for(photo['user_id'], photo['fileName'], photo['width'], photo['height'])
+                 for row in page for photo in row['photos'] }
+        paths = self.repo.blob_paths(keys.values())
+        jobs = [ (photo_id, str(paths[key])) for photo_id, key in keys.items() if key in paths ]
+        chunk_size = max(1, len(jobs) // self.workers + 1)
+        return [ pool.submit(_decode, jobs[i:i + chunk_size], self.size) for i in range(0, len(jobs), chunk_size) ]
+
+    def _predict(self, model, sequences: List[List]) -> np.ndarray:
+        import torch
+        probs = np.zeros(len(sequences), dtype=np.float32)
+        # Similar lengths together so batches carry little padding
+        order = sorted(range(len(sequences)), key=lambda i: len(sequences[i]))
+        for start in range(0, len(order), self.batch_size):
+            batch = order[start:start + self.batch_size]
+            imgs = torch.nn.utils.rnn.pad_sequence([ torch.stack(sequences[i]) for i in batch ], batch_first=True)
+            lengths = torch.tensor([ len(sequences[i]) for i in batch ])
+            with torch.inference_mode():
+                probs[batch] = model(imgs, lengths)
+        return probs
+
+    def _score_page(self, model, page: List[dict], decoded: Dict[str, np.ndarray]):
+        photo_ids = list(decoded)
+        inputs = { photo_id: to_input(decoded[photo_id]) for photo_id in photo_ids }
+        photo_scores = dict(zip(photo_ids, self._predict(model, [ [inputs[photo_id]] for photo_id in photo_ids ])))
+
+        persons = [ (row['_id'], [ photo['id'] for photo in row['photos'] if photo['id'] in inputs ]) for row in page ]
+        persons = [ (id, ids) for id, ids in persons if ids ]
+        person_scores = self._predict(model, [ [ inputs[photo_id] for photo_id in ids ] for _, ids in persons ])
+
+        photo_rows = []
+        for _, ids in persons:
+            for rank, photo_id in enumerate(sorted(ids, key=lambda photo_id: -photo_scores[photo_id])):
+                photo_rows.append({ 'id': photo_id, 'score': float(photo_scores[photo_id]), 'rank': rank })
+        person_rows = [ { '_id': id, 'score': float(score) } for (id, _), score in zip(persons, person_scores) ]
+        self.repo.record_scores(photo_rows, person_rows)
+        self.persons += len(person_rows)
+        self.photos += len(photo_rows)
+
+    def run(self, restart: bool = False) -> Dict[str, int]:
+        after, since = (None, None) if restart else self._load_checkpoint()
+        model = load_model(self.model_path, self.threads)
+        start = time.perf_counter()
+        last_id = after
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            pages = self._pages(after, since)
+            page = next(pages, None)
+            futures = self._submit(pool, page) if page else []
+            while page:
+                # Start decoding the next page before running the model on this one
+                next_page = next(pages, None)
+                next_futures = self._submit(pool, next_page) if next_page else []
+                decoded = { photo_id: img for future in futures for photo_id, img in future.result() if img is not None }
+                self._score_page(model, page, decoded)
+                last_id = page[-1]['_id']
+                self._save_checkpoint(last_id, since)
+                elapsed = time.perf_counter() - start
+                logger.info(f"Scored {self.persons} persons, {self.photos} photos ({len(page) / elapsed if elapsed else 0:.1f} persons/s this run, up to {last_id})")
+                page, futures = next_page, next_futures
+                start = time.perf_counter()
+        self._save_checkpoint(last_id, since, done=True)
+        return { 'persons': self.persons, 'photos': self.photos }
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Score every stored person and photo with a trained classifier")
+    arg_parser.add_argument('model', help="Lightning checkpoint, or a .pt/.onnx file from autotind.classifier.export")
+    arg_parser.add_argument('--db-url', default=config.DB_URL)
+    arg_parser.add_argument('--checkpoint-file', default='./bulk_score.json')
+    arg_parser.add_argument('--restart', action='store_true', help="Ignore the checkpoint file and score everything again")
+    arg_parser.add_argument('--workers', type=int, default=None, help="Image decoding processes, defaults to the CPU count")
+    arg_parser.add_argument('--threads', type=int, default=0, help="Inference threads, defaults to torch's choice")
+    arg_parser.add_argument('--batch-size', type=int, default=64)
+    arg_parser.add_argument('--page-size', type=int, default=500)
+    args = arg_parser.parse_args()
+
+    scorer = BulkScorer(PersonRepo(args.db_url), args.model, args.checkpoint_file, args.workers, args.batch_size, args.page_size, args.threads)
+    logger.info(f"Done: {scorer.run(restart=args.restart)}")
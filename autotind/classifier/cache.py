@@ -0,0 +1,129 @@
+import os
+import json
+import numpy as np
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+from loguru import logger
+from autotind.classifier.snapshot import PersonSnapshot
+
+CACHE_VERSION = 1
+
+
+def source_stamp(path: Path) -> Optional[Tuple[int, int]]:
+    try:
+        stat = path.stat()
+    except FileNotFoundError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+class SlotCache:
+    """
+    Fixed-shape arrays stored in one memory-mapped file, one slot per photo id. The index records the source path
+    and its size/mtime for each entry: `stale` lists entries whose source changed and `get` ignores entries whose
+    path no longer matches (blob paths change with their content).
+
+    The file is mapped lazily and copy-on-write: reads are zero-copy, tensors built on top of it are writable without
+    touching the file, and DataLoader workers map it themselves instead of receiving a pickled copy of the array.
+    Pickling keeps only the paths and slot geometry, the index is read back from its file on first use in the child,
+    as last committed.
+    """
+    def __init__(self, cache_dir: Union[str, Path], name: str, item_shape: Tuple[int, ...], dtype: str):
+        self.dir = Path(cache_dir)
+        self.item_shape = tuple(item_shape)
+        self.dtype = np.dtype(dtype)
+        self.data_path = self.dir / f"{name}.bin"
+        self.index_path = self.dir / f"{name}.json"
+        self._data = None
+        meta = self._read_index()
+        self._index: Optional[Dict[str, list]] = meta['entries'] if meta else {}
+        self.capacity = meta['capacity'] if meta else 0
+
+    def _read_index(self) -> Optional[dict]:
+        if not self.index_path.exists():
+            return None
+        with open(self.index_path) as f:
+            meta = json.load(f)
+        if meta.get('version') != CACHE_VERSION or tuple(meta.get('shape', ())) != self.item_shape or meta.get('dtype') != self.dtype.str:
+            logger.info(f"Ignoring cache {self.index_path} built with another version or shape")
+            return None
+        return meta
+
+    @property
+    def index(self) -> Dict[str, list]:
+        if self._index is None:
+            meta = self._read_index()
+            self._index = meta['entries'] if meta else {}
+        return self._index
+
+    def _save_index(self):
+        tmp_path = self.index_path.with_suffix('.json.part')
+        with open(tmp_path, 'w') as f:
+            json.dump({ 'version': CACHE_VERSION, 'shape': list(self.item_shape), 'dtype': self.dtype.str, 'capacity': self.capacity, 'entries': self.index }, f)
+        os.replace(tmp_path, self.index_path)
+
+    @property
+    def data(self) -> np.memmap:
+        if self._data is None:
+            self._data = np.memmap(self.data_path, dtype=self.dtype, mode='c', shape=(self.capacity, *self.item_shape))
+        return self._data
+
+    def writable(self) -> np.memmap:
+        return np.memmap(self.data_path, dtype=self.dtype, mode='r+', shape=(self.capacity, *self.item_shape))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        state['_index'] = None
+        return state
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def get(self, photo_id: str, path: str) -> Optional[np.ndarray]:
+        entry = self.index.get(photo_id)
+        if entry is None or entry[1] != path:
+            return None
+        return self.data[entry[0]]
+
+    def stale(self, snapshot: PersonSnapshot, img_root_dir: Union[str, Path]) -> List[Tuple[int, str, str, list]]:
+        """
+        Assigns a slot to every photo of the snapshot that is missing or whose source changed, growing the file as needed.
+        Returns `(slot, photo_id, path, stamp)` for each, `path` relative to `img_root_dir`.
+        """
+        img_root_dir = Path(img_root_dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        free_slots = sorted(set(range(self.capacity)) - { entry[0] for entry in self.index.values() }, reverse=True)
+
+        pending = []
+        for ids, paths in zip(snapshot.column('photo_ids'), snapshot.column('photo_paths')):
+            for photo_id, path in zip(ids, paths):
+                stamp = source_stamp(img_root_dir / path)
+                if stamp is None:
+                    continue
+                entry = self.index.get(photo_id)
+                if entry is not None and entry[1] == path and tuple(entry[2]) == stamp:
+                    continue
+                if entry is not None:
+                    slot = entry[0]
+                elif free_slots:
+                    slot = free_slots.pop()
+                else:
+                    slot = self.capacity
+                    self.capacity += 1
+                pending.append((slot, photo_id, path, list(stamp)))
+
+        if pending:
+            # Grow the file in place, existing slots keep their offsets
+            with open(self.data_path, 'ab') as f:
+                f.truncate(self.capacity * int(np.prod(self.item_shape)) * self.dtype.itemsize)
+            self._data = None
+        return pending
+
+    def commit(self, pending: List[Tuple[int, str, str, list]], failed: set = frozenset()):
+        for slot, photo_id, path, stamp in pending:
+            if slot in failed:
+                self.index.pop(photo_id, None)
+            else:
+                self.index[photo_id] = [slot, path, stamp]
+        self._save_index()
@@ -1,75 +1,160 @@
-import pandas as pd
+import numpy as np
 import torch
 import pytorch_lightning as pl
 import functools
-from typing import Union, Optional, Callable, Tuple
+from typing import Iterator, List, Union, Optional, Callable, Tuple
 from PIL import Image
 from pathlib import Path
-from autotind.person import Person
-from autotind.db import PersonRepo
-from torch.utils.data import Dataset, DataLoader
+from autotind.classifier.snapshot import PersonSnapshot
+from autotind.classifier.image_cache import ImageCache, load_resized
+from autotind.classifier.embedding_cache import EmbeddingCache
+from torch.utils.data import Dataset, DataLoader, Sampler
 from sklearn.model_selection import train_test_split
 
 @functools.lru_cache(maxsize=None)
-def get_datasets(sqlite_url: str = 'sqlite:///tind.sqlite', split_frac: float = 0.2, sample_size: Optional[float] = None, equalize_classes: bool = False) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    repo = PersonRepo(sqlite_url)
-    persons = repo.get_all()
+def load_snapshot(snapshot: str) -> PersonSnapshot:
+    return PersonSnapshot(snapshot)
 
-    df = pd.DataFrame(persons)
-    
-    if sample_size is not None:
-        df = df.sample(frac=sample_size)
+@functools.lru_cache(maxsize=None)
+def get_datasets(snapshot: str = './snapshots', split_frac: float = 0.2, sample_size: Optional[float] = None, equalize_classes: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the train and test row indices into the snapshot at `snapshot`, a file or a directory holding snapshots.
+    """
+    data = load_snapshot(snapshot)
+    labels = data.labels()
+    labels = np.where(labels == 'match', 'like', labels)
+    idx = np.flatnonzero((labels != 'recommendation') & (data.column('n_photos') > 0))
 
-    df['label'] = df['label'].replace('match', 'like')
-    df = df[df['label'] != 'recommendation']
+    if sample_size is not None:
+        idx = np.random.choice(idx, size=int(len(idx) * sample_size), replace=False)
 
     if equalize_classes:
-        sample_size = min(len(df[df['label'] == 'like']), len(df[df['label'] == 'dislike']))
-        df = df.groupby('label').apply(lambda x: x.sample(sample_size)).reset_index(drop=True)
+        likes, dislikes = idx[labels[idx] == 'like'], idx[labels[idx] == 'dislike']
+        sample_size = min(len(likes), len(dislikes))
+        idx = np.concatenate([ np.random.choice(likes, sample_size, replace=False), np.random.choice(dislikes, sample_size, replace=False) ])
     
-    train_df, test_df = train_test_split(df, test_size=split_frac)
-    return train_df, test_df
+    train_idx, test_idx = train_test_split(idx, test_size=split_frac)
+    return train_idx, test_idx
 
 
 class PersonDataset(Dataset):
-    def __init__(self, df: pd.DataFrame, img_root_dir: Union[Path, str], tfms: Optional[Callable] = None):
-        self.df = df
+    """
+    Without an image cache, `tfms` gets PIL images. With one, images come out of the cache already resized and
+    `tfms` gets uint8 (3, H, W) tensors viewing the mapped array, photos missing from the cache are decoded on the spot.
+    """
+    def __init__(self, snapshot: PersonSnapshot, indices: np.ndarray, img_root_dir: Union[Path, str], tfms: Optional[Callable] = None, image_cache: Optional[ImageCache] = None):
+        self.snapshot = snapshot
+        self.indices = indices
         self.img_root_dir = Path(img_root_dir)
         self.tfms = tfms
+        self.image_cache = image_cache
     
     def __len__(self):
-        return len(self.df)
+        return len(self.indices)
     
 
-    def _tfm_label(self, label: str) -> int:
-        if label == 'like':
+    @staticmethod
+    def _tfm_label(label: str) -> int:
+        if label in ('like', 'match'):
             return 1
         elif label == 'dislike':
             return 0
         else:
             raise ValueError(f"Unknown label: {label}")
 
-    def __getitem__(self, idx):
-        row = self.df.iloc[idx]
-        p = Person.from_dict({**row})
+    def _load_images(self, row: int):
         imgs = []
-        for idx, photo in enumerate(p.photos):
-            img_path = photo.get_path(self.img_root_dir)
-            img = Image.open(img_path)
+        for photo_path in self.snapshot.photo_paths(row):
+            img = Image.open(self.img_root_dir / photo_path)
             img = img.convert('RGB')
             if self.tfms:
                 img = self.tfms(img)
             imgs.append(img)
+        return imgs
+
+    def _cached_images(self, row: int):
+        imgs = []
+        for photo_id, photo_path in zip(self.snapshot.photo_ids(row), self.snapshot.photo_paths(row)):
+            img = self.image_cache.get(photo_id, photo_path)
+            if img is None:
+                img = load_resized(self.img_root_dir / photo_path, self.image_cache.size)
+            img = torch.from_numpy(img).permute(2, 0, 1)
+            if self.tfms:
+                img = self.tfms(img)
+            imgs.append(img)
+        return imgs
+
+    def __getitem__(self, idx):
+        row = int(self.indices[idx])
+        imgs = self._cached_images(row) if self.image_cache is not None else self._load_images(row)
         if len(imgs) < 1:
-            raise ValueError(f"No images found for person: {p}")
-        return imgs, self._tfm_label(p.label)
+            raise ValueError(f"No images found for row: {row}")
+        label = self.snapshot.label(row)
+        return imgs, self._tfm_label(label)
+
+
+class PersonEmbeddingDataset(Dataset):
+    """
+    Same rows as `PersonDataset` but yields cached embeddings instead of images, photos missing from the cache are left out.
+    """
+    def __init__(self, snapshot: PersonSnapshot, indices: np.ndarray, embedding_cache: EmbeddingCache):
+        self.snapshot = snapshot
+        self.indices = indices
+        self.embedding_cache = embedding_cache
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        row = int(self.indices[idx])
+        embeddings = []
+        for photo_id, photo_path in zip(self.snapshot.photo_ids(row), self.snapshot.photo_paths(row)):
+            embedding = self.embedding_cache.get(photo_id, photo_path)
+            if embedding is not None:
+                embeddings.append(torch.from_numpy(embedding))
+        if len(embeddings) < 1:
+            raise ValueError(f"No embeddings found for row: {row}")
+        return embeddings, PersonDataset._tfm_label(self.snapshot.label(row))
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batches profiles of similar photo counts together so little padding is needed. Indices are shuffled, split into
+    pools of `pool_batches` batches, sorted by length inside each pool and cut into batches, then the batches are shuffled.
+    """
+    def __init__(self, lengths: np.ndarray, batch_size: int, shuffle: bool = True, pool_batches: int = 50, drop_last: bool = False):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_size = batch_size * pool_batches
+        self.drop_last = drop_last
+
+    def __iter__(self) -> Iterator[List[int]]:
+        order = np.random.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        batches = []
+        for start in range(0, len(order), self.pool_size):
+            pool = order[start:start + self.pool_size]
+            pool = pool[np.argsort(self.lengths[pool], kind='stable')]
+            batches.extend(pool[i:i + self.batch_size].tolist() for i in range(0, len(pool), self.batch_size))
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches.pop()
+        if self.shuffle:
+            np.random.shuffle(batches)
+        return iter(batches)
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return len(self.lengths) // self.batch_size
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
 
 
 class PersonDataModule(pl.LightningDataModule):
-    def __init__(self, db_url: str, img_root_dir: Union[Path, str], batch_size: int = 2, train_tfms: Optional[Callable] = None, val_tfms: Optional[Callable] = None):
+    def __init__(self, snapshot: Union[Path, str], img_root_dir: Union[Path, str], batch_size: int = 2, train_tfms: Optional[Callable] = None, val_tfms: Optional[Callable] = None, image_cache_dir: Optional[Union[Path, str]] = None, embedding_cache: Optional[EmbeddingCache] = None):
         super().__init__()
         self.img_root_dir = Path(img_root_dir)
-        self.db_url = db_url
+        self.snapshot = str(snapshot)
+        self.image_cache = ImageCache(image_cache_dir) if image_cache_dir else None
+        self.embedding_cache = embedding_cache
         self.batch_size = batch_size
         self.train_tfms = train_tfms
         self.val_tfms = val_tfms
@@ -84,10 +169,18 @@ class PersonDataModule(pl.LightningDataModule):
         return img_pack, lengths, labels
 
     def setup(self, stage: Optional[str] = None):
-        self.train_df, self.test_df = get_datasets(self.db_url)
+        self.data = load_snapshot(self.snapshot)
+        self.train_idx, self.test_idx = get_datasets(self.snapshot)
+
+    def _dataloader(self, indices: np.ndarray, tfms: Optional[Callable], shuffle: bool) -> DataLoader:
+        sampler = BucketBatchSampler(self.data.column('n_photos')[indices], self.batch_size, shuffle=shuffle)
+        if self.embedding_cache is not None:
+            # Rows are slices of a mapped array, worker processes would only add overhead
+            return DataLoader(PersonEmbeddingDataset(self.data, indices, self.embedding_cache), batch_sampler=sampler, collate_fn=self.collate_fn)
+        return DataLoader(PersonDataset(self.data, indices, self.img_root_dir, tfms=tfms, image_cache=self.image_cache), batch_sampler=sampler, num_workers=4, collate_fn=self.collate_fn)
 
     def train_dataloader(self):
-        return DataLoader(PersonDataset(self.train_df, self.img_root_dir, tfms=self.train_tfms), batch_size=self.batch_size, shuffle=True, num_workers=4, collate_fn=self.collate_fn)
+        return self._dataloader(self.train_idx, self.train_tfms, shuffle=True)
 
     def val_dataloader(self):
-        return DataLoader(PersonDataset(self.test_df, self.img_root_dir, tfms=self.val_tfms), batch_size=self.batch_size, shuffle=False, num_workers=4, collate_fn=self.collate_fn)
\ No newline at end of file
+        return self._dataloader(self.test_idx, self.val_tfms, shuffle=False)
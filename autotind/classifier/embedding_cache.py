@@ -0,0 +1,112 @@
+import argparse
+import hashlib
+import torch
+from pathlib import Path
+from typing import Optional, Union
+from loguru import logger
+from torch import nn
+from torch.utils.data import Dataset, DataLoader
+from torchvision import transforms
+from autotind.classifier.cache import SlotCache
+from autotind.classifier.image_cache import ImageCache, load_resized
+from autotind.classifier.snapshot import PersonSnapshot
+
+normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+
+
+def encoder_version(encoder: nn.Module, size: int = 224) -> str:
+    """
+    Identifies an encoder by its input size and a hash of its weights, so embeddings of a retrained encoder never mix with old ones.
+    """
+    digest = hashlib.blake2b(digest_size=8)
+    for name, tensor in encoder.state_dict().items():
+        digest.update(name.encode())
+        digest.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return f"{size}-{digest.hexdigest()}"
+
+
+class _PendingImages(Dataset):
+    def __init__(self, jobs, img_root_dir: Path, size: int, image_cache: Optional[ImageCache]):
+        self.jobs = jobs
+        self.img_root_dir = img_root_dir
+        self.size = size
+        self.image_cache = image_cache
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def __getitem__(self, idx):
+        slot, photo_id, path, _ = self.jobs[idx]
+        img = self.image_cache.get(photo_id, path) if self.image_cache is not None else None
+        try:
+            if img is None:
+                img = load_resized(self.img_root_dir / path, self.size)
+        except Exception as e:
+            logger.warning(f"Could not encode {path}: {e}")
+            return slot, None
+        return slot, normalize(transforms.functional.convert_image_dtype(torch.from_numpy(img).permute(2, 0, 1), torch.float))
+
+    @staticmethod
+    def collate_fn(batch):
+        failed = [ slot for slot, img in batch if img is None ]
+        batch = [ (slot, img) for slot, img in batch if img is not None ]
+        if not batch:
+            return [], None, failed
+        return [ slot for slot, _ in batch ], torch.stack([ img for _, img in batch ]), failed
+
+
+class EmbeddingCache(SlotCache):
+    """
+    Encoder outputs, one float32 vector per photo id, for a given encoder version.
+    """
+    def __init__(self, cache_dir: Union[str, Path], version: str, dim: int = 512):
+        super().__init__(cache_dir, f"embeddings-{version}", (dim,), 'f4')
+        self.version = version
+        self.size = int(version.split('-')[0])
+
+    @torch.inference_mode()
+    def build(self, snapshot: PersonSnapshot, img_root_dir: Union[str, Path], encoder: nn.Module, image_cache: Optional[ImageCache] = None, batch_size: int = 64, num_workers: int = 4) -> int:
+        """
+        Encodes the photos of the snapshot that have no embedding yet or whose source changed, returns how many were encoded.
+        """
+        pending = self.stale(snapshot, img_root_dir)
+        if not pending:
+            logger.info(f"Embedding cache {self.data_path} is up to date ({len(self)} photos)")
+            return 0
+
+        images = _PendingImages(pending, Path(img_root_dir), self.size, image_cache)
+        loader = DataLoader(images, batch_size=batch_size, num_workers=num_workers, collate_fn=_PendingImages.collate_fn)
+        was_training = encoder.training
+        encoder.eval()
+        data = self.writable()
+        failed = set()
+        try:
+            for slots, imgs, failed_slots in loader:
+                failed.update(failed_slots)
+                if slots:
+                    data[slots] = encoder(imgs).flatten(1).numpy()
+        finally:
+            encoder.train(was_training)
+            data.flush()
+
+        self.commit(pending, failed)
+        logger.info(f"Encoded {len(pending) - len(failed)} photos into {self.data_path} ({len(failed)} failed, {len(self)} cached)")
+        return len(pending) - len(failed)
+
+
+if __name__ == '__main__':
+    from autotind.classifier.model import PersonClassifier
+    arg_parser = argparse.ArgumentParser(description="Encode the photos of a snapshot with the image encoder and cache the embeddings")
+    arg_parser.add_argument('--snapshot', default='./snapshots')
+    arg_parser.add_argument('--img-root', default='./images')
+    arg_parser.add_argument('--image-cache', default=None, help="Read pre-resized images from this ImageCache directory")
+    arg_parser.add_argument('--out-dir', default='./embedding_cache')
+    arg_parser.add_argument('--checkpoint', default=None, help="Take the encoder from a trained checkpoint instead of the ImageNet weights")
+    arg_parser.add_argument('--batch-size', type=int, default=64)
+    arg_parser.add_argument('--workers', type=int, default=4)
+    args = arg_parser.parse_args()
+
+    model = PersonClassifier.load_from_checkpoint(args.checkpoint) if args.checkpoint else PersonClassifier(freeze_encoder=True)
+    cache = EmbeddingCache(args.out_dir, model.encoder_version())
+    image_cache = ImageCache(args.image_cache) if args.image_cache else None
+    cache.build(PersonSnapshot(args.snapshot), args.img_root, model.img_encoder.module, image_cache, args.batch_size, args.workers)
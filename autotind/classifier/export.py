@@ -0,0 +1,233 @@
+import copy
+import json
+import time
+import argparse
+import numpy as np
+import torch
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from loguru import logger
+from torch import nn
+from torch.ao.quantization import get_default_qconfig_mapping
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from torch.utils.data import DataLoader
+from torchvision import transforms
+from autotind.classifier.model import PersonClassifier
+from autotind.classifier.dataset import BucketBatchSampler, PersonDataModule, PersonDataset, get_datasets, load_snapshot
+from autotind.classifier.embedding_cache import normalize
+from autotind.classifier.image_cache import ImageCache
+from autotind.classifier.runtime import InferenceRunner
+
+
+class InferenceModel(nn.Module):
+    """
+    The layers of a `PersonClassifier` without Lightning or torchmetrics, in a traceable form.
+    Takes `(n_batch, n_seq, 3, H, W)` images and their lengths, returns the like probability of each profile.
+    The GRU runs over the padded sequence and the output at each profile's last real step is kept,
+    for a unidirectional GRU that is the same state the packed sequence ends in.
+    """
+    def __init__(self, classifier: PersonClassifier, channels_last: bool = False):
+        super().__init__()
+        self.encoder = classifier.img_encoder.module
+        self.gru = classifier.gru
+        self.h0 = classifier.gru_h0
+        self.head = classifier.classifier
+        self.channels_last = channels_last
+
+    def forward(self, imgs: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+        n_batch, n_seq = imgs.shape[0], imgs.shape[1]
+        x = imgs.reshape(n_batch * n_seq, imgs.shape[2], imgs.shape[3], imgs.shape[4])
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        x = self.encoder(x).reshape(n_batch, n_seq, -1)
+        h0 = self.h0.unsqueeze(1).repeat(1, n_batch, 1).contiguous()
+        x, _ = self.gru(x, h0)
+        last = (lengths - 1).view(-1, 1, 1).expand(-1, 1, x.shape[2])
+        x = x.gather(1, last).squeeze(1)
+        return self.head(x)[:, 1]
+
+
+Batch = Tuple[torch.Tensor, torch.Tensor]
+
+
+def load_batches(snapshot: str, img_root_dir: Union[str, Path], image_cache_dir: Optional[Union[str, Path]] = None, batch_size: int = 16,
+                 limit: Optional[int] = None, split: str = 'test') -> List[Tuple[torch.Tensor, torch.Tensor, torch.Tensor]]:
+    """
+    Loads `(imgs, lengths, labels)` batches of the `train` or `test` split of a snapshot, in the order of the split.
+    """
+    data = load_snapshot(snapshot)
+    train_idx, test_idx = get_datasets(snapshot)
+    indices = train_idx if split == 'train' else test_idx
+    if limit:
+        indices = indices[:limit]
+    if image_cache_dir:
+        image_cache = ImageCache(image_cache_dir)
+        tfms = transforms.Compose([ transforms.ConvertImageDtype(torch.float), normalize ])
+    else:
+        image_cache = None
+        tfms = transforms.Compose([ transforms.Resize((224, 224)), transforms.ToTensor(), normalize ])
+    dataset = PersonDataset(data, indices, img_root_dir, tfms=tfms, image_cache=image_cache)
+    sampler = BucketBatchSampler(data.column('n_photos')[indices], batch_size, shuffle=False)
+    return list(DataLoader(dataset, batch_sampler=sampler, collate_fn=PersonDataModule.collate_fn))
+
+
+def _real_images(imgs: torch.Tensor, lengths: torch.Tensor) -> torch.Tensor:
+    mask = torch.arange(imgs.shape[1])[None, :] < lengths[:, None]
+    return imgs[mask]
+
+
+def quantize_encoder(encoder: nn.Module, calibration: List[Batch], channels_last: bool = False) -> nn.Module:
+    """
+    Static int8 quantization of the image encoder with FX graph mode: observers are inserted, the calibration images
+    are run through them to fix each activation's scale, then convolutions (with BatchNorm folded in) and the residual
+    adds are swapped for their quantized kernels. The returned module takes and returns fp32 tensors.
+    """
+    example = _real_images(*calibration[0])
+    prepared = prepare_fx(copy.deepcopy(encoder).eval(), get_default_qconfig_mapping('x86'), example_inputs=(example,))
+    with torch.inference_mode():
+        for imgs, lengths in calibration:
+            x = _real_images(imgs, lengths)
+            if channels_last:
+                x = x.contiguous(memory_format=torch.channels_last)
+            prepared(x)
+    return convert_fx(prepared)
+
+
+def export(checkpoint: Union[str, Path], out: Union[str, Path], quantize: bool = False, channels_last: bool = True, size: int = 224,
+           calibration: Optional[List[Batch]] = None) -> Path:
+    """
+    Writes a TorchScript (`.pt`) or ONNX (`.onnx`) inference graph for a trained checkpoint.
+
+    `quantize` needs `calibration`, a few `(imgs, lengths)` batches of real profiles. For TorchScript the ResNet encoder
+    is statically quantized to int8 with them (see `quantize_encoder`) and the GRU and Linear weights of the head are
+    dynamically quantized. For ONNX, onnxruntime's static quantization calibrates every supported op with them.
+    """
+    out = Path(out)
+    if quantize and not calibration:
+        raise ValueError("Quantizing needs calibration batches")
+    classifier = PersonClassifier.load_from_checkpoint(str(checkpoint), map_location='cpu').eval()
+    model = InferenceModel(classifier, channels_last).eval()
+    if channels_last:
+        model = model.to(memory_format=torch.channels_last)
+    meta = { 'checkpoint': str(checkpoint), 'size': size, 'quantized': False, 'channels_last': channels_last }
+    example = (torch.randn(2, 3, 3, size, size), torch.tensor([3, 2]))
+
+    if out.suffix == '.onnx':
+        import onnx
+        torch.onnx.export(model, example, str(out), input_names=['imgs', 'lengths'], output_names=['probs'], opset_version=17,
+                          dynamic_axes={ 'imgs': { 0: 'batch', 1: 'seq' }, 'lengths': { 0: 'batch' }, 'probs': { 0: 'batch' } })
+        if quantize:
+            from onnxruntime.quantization import CalibrationDataReader, QuantFormat, QuantType, quantize_static
+
+            class Reader(CalibrationDataReader):
+                def __init__(self):
+                    self.batches = iter(calibration)
+
+                def get_next(self):
+                    batch = next(self.batches, None)
+                    if batch is None:
+                        return None
+                    return { 'imgs': batch[0].numpy(), 'lengths': batch[1].numpy().astype(np.int64) }
+
+            quantize_static(str(out), str(out), Reader(), quant_format=QuantFormat.QDQ, weight_type=QuantType.QInt8)
+            meta['quantized'] = 'int8-static'
+        graph = onnx.load(str(out))
+        graph.metadata_props.add(key='autotind', value=json.dumps(meta))
+        onnx.save(graph, str(out))
+    else:
+        if quantize:
+            model.encoder = quantize_encoder(model.encoder, calibration, channels_last)
+            model = torch.ao.quantization.quantize_dynamic(model, { nn.Linear, nn.GRU }, dtype=torch.qint8)
+            meta['quantized'] = 'int8-static-encoder+int8-dynamic-head'
+        with torch.inference_mode():
+            traced = torch.jit.trace(model, example, check_trace=False)
+        traced = torch.jit.freeze(traced)
+        torch.jit.save(traced, str(out), _extra_files={ 'meta.json': json.dumps(meta) })
+    logger.info(f"Exported {checkpoint} to {out} ({out.stat().st_size / 2**20:.1f} MiB, {meta})")
+    return out
+
+
+def _percentile(values: List[float], q: float) -> float:
+    return float(np.percentile(values, q * 100)) if values else 0.0
+
+
+def benchmark(checkpoint: Union[str, Path], exported: List[Union[str, Path]], snapshot: str, img_root_dir: Union[str, Path],
+              image_cache_dir: Optional[Union[str, Path]] = None, batch_size: int = 16, limit: Optional[int] = None, threads: int = 0) -> Dict[str, dict]:
+    """
+    Runs the original Lightning module and every exported model over the held-out split of a snapshot and compares
+    latency per batch, throughput, accuracy and agreement with the original, next to how each model was quantized.
+    Batches are loaded up front, only inference is timed.
+    """
+    if threads:
+        torch.set_num_threads(threads)
+    batches = load_batches(snapshot, img_root_dir, image_cache_dir, batch_size, limit)
+    labels = np.concatenate([ y.numpy() for _, _, y in batches ])
+
+    classifier = PersonClassifier.load_from_checkpoint(str(checkpoint), map_location='cpu').eval()
+    models: Dict[str, Callable[[torch.Tensor, torch.Tensor], np.ndarray]] = {
+        'lightning': lambda imgs, lengths: classifier((imgs, lengths, None))[:, 1].numpy()
+    }
+    quantized = { 'lightning': False }
+    for path in exported:
+        runner = InferenceRunner(path)
+        models[Path(path).name] = runner.predict
+        quantized[Path(path).name] = runner.meta.get('quantized', False)
+
+    results, reference = {}, None
+    for name, predict in models.items():
+        with torch.inference_mode():
+            # TorchScript's profiling executor only settles on an optimized graph after a couple of runs
+            for _ in range(3):
+                predict(*batches[0][:2])
+            latencies, probs = [], []
+            for imgs, lengths, _ in batches:
+                start = time.perf_counter()
+                probs.append(predict(imgs, lengths))
+                latencies.append((time.perf_counter() - start) * 1000)
+        probs = np.concatenate(probs)
+        if reference is None:
+            reference = probs
+        results[name] = {
+            'quantized': quantized[name],
+            'latency_ms_p50': _percentile(latencies, 0.5),
+            'latency_ms_p95': _percentile(latencies, 0.95),
+            'profiles_per_s': len(probs) / (sum(latencies) / 1000),
+            'accuracy': float(((probs > 0.5) == labels).mean()),
+            'agreement': float(((probs > 0.5) == (reference > 0.5)).mean()),
+            'max_abs_diff': float(np.abs(probs - reference).max()),
+        }
+        logger.info(f"{name}: {results[name]}")
+    return results
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Export a trained classifier for CPU inference and benchmark it")
+    subparsers = arg_parser.add_subparsers(dest='command', required=True)
+    export_parser = subparsers.add_parser('export')
+    export_parser.add_argument('checkpoint')
+    export_parser.add_argument('out', help="Output file, .pt for TorchScript or .onnx")
+    export_parser.add_argument('--quantize', action='store_true',
+                               help="Int8: static for the ResNet encoder and dynamic for the GRU and Linear head (TorchScript), static for every supported op (ONNX). Calibrates on the training split of --snapshot")
+    export_parser.add_argument('--no-channels-last', action='store_true')
+    export_parser.add_argument('--snapshot', default='./snapshots')
+    export_parser.add_argument('--img-root', default='./images')
+    export_parser.add_argument('--image-cache', default=None)
+    export_parser.add_argument('--calibration-profiles', type=int, default=256, help="Training profiles to calibrate activation ranges on")
+    bench_parser = subparsers.add_parser('bench')
+    bench_parser.add_argument('checkpoint')
+    bench_parser.add_argument('exported', nargs='*')
+    bench_parser.add_argument('--snapshot', default='./snapshots')
+    bench_parser.add_argument('--img-root', default='./images')
+    bench_parser.add_argument('--image-cache', default=None)
+    bench_parser.add_argument('--batch-size', type=int, default=16)
+    bench_parser.add_argument('--limit', type=int, default=None)
+    bench_parser.add_argument('--threads', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    if args.command == 'export':
+        calibration = None
+        if args.quantize:
+            calibration = [ (imgs, lengths) for imgs, lengths, _ in load_batches(args.snapshot, args.img_root, args.image_cache, limit=args.calibration_profiles, split='train') ]
+        export(args.checkpoint, args.out, quantize=args.quantize, channels_last=not args.no_channels_last, calibration=calibration)
+    else:
+        benchmark(args.checkpoint, args.exported, args.snapshot, args.img_root, args.image_cache, args.batch_size, args.limit, args.threads)
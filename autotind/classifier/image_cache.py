@@ -0,0 +1,77 @@
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import List, Optional, Tuple, Union
+from loguru import logger
+from PIL import Image
+from autotind.classifier.cache import SlotCache
+from autotind.classifier.snapshot import PersonSnapshot
+
+
+def load_resized(path: Union[str, Path], size: int) -> np.ndarray:
+    """
+    Decodes an image to a (size, size, 3) uint8 array, same result as `Resize((size, size))` on the RGB image.
+    """
+    with Image.open(path) as img:
+        # Lets the JPEG decoder skip straight to a smaller scale when the source is much larger
+        img.draft('RGB', (size, size))
+        img = img.convert('RGB').resize((size, size), Image.BILINEAR)
+        return np.array(img, dtype=np.uint8)
+
+
+def _encode_slots(cache: 'ImageCache', jobs: List[Tuple[int, str]]) -> List[int]:
+    """
+    Runs in a pool worker, writes straight into the shared array file. Returns the slots that failed to decode.
+    """
+    data = cache.writable()
+    failed = []
+    for slot, path in jobs:
+        try:
+            data[slot] = load_resized(path, cache.size)
+        except Exception as e:
+            logger.warning(f"Could not cache {path}: {e}")
+            failed.append(slot)
+    data.flush()
+    return failed
+
+
+class ImageCache(SlotCache):
+    """
+    Resized uint8 RGB images, `(size, size, 3)` per photo id.
+    """
+    def __init__(self, cache_dir: Union[str, Path], size: int = 224):
+        super().__init__(cache_dir, f"images-{size}", (size, size, 3), 'u1')
+        self.size = size
+
+    def build(self, snapshot: PersonSnapshot, img_root_dir: Union[str, Path], workers: Optional[int] = None, chunk_size: int = 256) -> int:
+        """
+        Encodes every photo of the snapshot that is missing from the cache or whose source changed since it was cached.
+        Returns the number of images encoded.
+        """
+        pending = self.stale(snapshot, img_root_dir)
+        if not pending:
+            logger.info(f"Image cache {self.dir} is up to date ({len(self)} images)")
+            return 0
+
+        jobs = [ (slot, str(Path(img_root_dir) / path)) for slot, _, path, _ in pending ]
+        failed = set()
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [ pool.submit(_encode_slots, self, jobs[i:i + chunk_size]) for i in range(0, len(jobs), chunk_size) ]
+            for future in futures:
+                failed.update(future.result())
+
+        self.commit(pending, failed)
+        logger.info(f"Encoded {len(jobs) - len(failed)} images into {self.dir} ({len(failed)} failed, {len(self)} cached)")
+        return len(jobs) - len(failed)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Pre-decode and resize the photos of a snapshot into an image cache")
+    arg_parser.add_argument('--snapshot', default='./snapshots')
+    arg_parser.add_argument('--img-root', default='./images')
+    arg_parser.add_argument('--out-dir', default='./image_cache')
+    arg_parser.add_argument('--size', type=int, default=224)
+    arg_parser.add_argument('--workers', type=int, default=None)
+    args = arg_parser.parse_args()
+    ImageCache(args.out_dir, args.size).build(PersonSnapshot(args.snapshot), args.img_root, args.workers)
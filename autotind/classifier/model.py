@@ -1,4 +1,4 @@
-from typing import Iterable
+from typing import Iterable, Optional
 import torch
 import torchvision
 import torchmetrics
@@ -6,7 +6,9 @@ import pytorch_lightning as pl
 from torch.functional import F
 from torch import nn
 from torchvision import transforms
-from autotind.classifier.dataset import PersonDataModule
+from autotind.classifier.dataset import PersonDataModule, load_snapshot
+from autotind.classifier.image_cache import ImageCache
+from autotind.classifier.embedding_cache import EmbeddingCache, encoder_version
 
 class SequenceWise(nn.Module):
     """
@@ -17,8 +19,15 @@ class SequenceWise(nn.Module):
         super().__init__()
         self.module = module
 
-    def forward(self, x: torch.Tensor):
+    def forward(self, x: torch.Tensor, lengths: Optional[torch.Tensor] = None):
         n_batch, n_seq = x.shape[:2]
+        if lengths is not None:
+            # Only run the module on real frames and scatter the results back into the padded layout
+            mask = torch.arange(n_seq, device=x.device)[None, :] < lengths.to(x.device)[:, None]
+            y = self.module(x[mask])
+            out = y.new_zeros(n_batch, n_seq, *y.shape[1:])
+            out[mask] = y
+            return out
         data_shape = x.shape[2:]
         x = x.view(-1, *data_shape)
         x = self.module(x)
@@ -50,7 +59,7 @@ class PersonClassifier(pl.LightningModule):
         self.img_embedding_size = embedder.fc.in_features
         self.lr = lr
         self.gru = nn.GRU(self.img_embedding_size, 128, 2, batch_first=True, dropout=0.1)
-        self.gru_h0: nn.Parameter = nn.Parameter(torch.randn(2, 128), requires_grad=True).type(torch.FloatTensor)
+        self.gru_h0 = nn.Parameter(torch.randn(2, 128), requires_grad=True)
         self.classifier = nn.Sequential(
             nn.Linear(128, 256),
             nn.ReLU(),
@@ -65,17 +74,22 @@ class PersonClassifier(pl.LightningModule):
             nn.Softmax()
         )
     
+    def encoder_version(self) -> str:
+        return encoder_version(self.img_encoder.module)
+
     def forward(self, batch):
         x, lengths, labels = batch
-        x = self.img_encoder(x)
-        x.squeeze_(-1).squeeze_(-1)
+        # (n_batch, n_seq, embedding) batches come from an EmbeddingCache and skip the encoder
+        if x.dim() > 3:
+            x = self.img_encoder(x, lengths)
+            x = x.flatten(2)
 
         # Make initial state a learned parameter instead of zeros
         # https://r2rt.com/non-zero-initial-states-for-recurrent-neural-networks.html
-        h0 = self.gru_h0.repeat(x.shape[0], 1, 1)
-        #TODO use PackedSequence
-        x, _ = self.gru(x, h0)
-        x = x[:, -1, :] # take last hidden state
+        h0 = self.gru_h0.unsqueeze(1).repeat(1, x.shape[0], 1).contiguous()
+        packed = nn.utils.rnn.pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
+        _, h_n = self.gru(packed, h0)
+        x = h_n[-1] # last layer's state after each sequence's last real step
         x = self.classifier(x)
         return x
 
@@ -129,13 +143,29 @@ val_tfms = transforms.Compose([
     transforms.ToTensor()
 ])
 
+# For images served by an ImageCache: already resized uint8 tensors, only the cheap steps are left
+cached_train_tfms = transforms.Compose([
+    transforms.RandomHorizontalFlip(),
+    transforms.ConvertImageDtype(torch.float),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
+])
+
+cached_val_tfms = transforms.ConvertImageDtype(torch.float)
+
 
 if __name__ == '__main__':
     from pytorch_lightning.loggers import WandbLogger
-    dm = PersonDataModule('sqlite:///tind.sqlite', './images', batch_size=2, train_tfms=train_tfms, val_tfms=val_tfms)
+    freeze_encoder = False
+    model = PersonClassifier(lr=5e-6, freeze_encoder=freeze_encoder)
+    embedding_cache = None
+    if freeze_encoder:
+        # The encoder never changes: encode new photos once and train the GRU and head from the cached embeddings
+        embedding_cache = EmbeddingCache('./embedding_cache', model.encoder_version())
+        embedding_cache.build(load_snapshot('./snapshots'), './images', model.img_encoder.module, image_cache=ImageCache('./image_cache'))
+
+    dm = PersonDataModule('./snapshots', './images', batch_size=2, train_tfms=cached_train_tfms, val_tfms=cached_val_tfms, image_cache_dir='./image_cache', embedding_cache=embedding_cache)
     # sample_dm(dm)
 
-    model = PersonClassifier(lr=5e-6, freeze_encoder=False)
     trainer = pl.Trainer(accelerator="gpu", max_epochs=50, enable_progress_bar=True, logger=WandbLogger(project="tind-classifier"), accumulate_grad_batches=5)
     trainer.fit(model, dm)
     # tuner = trainer.tuner.lr_find(model, dm)
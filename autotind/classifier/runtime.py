@@ -0,0 +1,44 @@
+import json
+import time
+import numpy as np
+import torch
+from pathlib import Path
+from typing import Union
+from loguru import logger
+
+
+class InferenceRunner:
+    """
+    Runs a model written by `autotind.classifier.export`: a TorchScript `.pt` file or an `.onnx` file (needs onnxruntime).
+    Only torch and numpy are imported, loading never touches Lightning, torchvision or torchmetrics.
+
+    `predict` takes normalized images padded to `(n_batch, n_seq, 3, H, W)` and the number of real images of
+    each profile, and returns the like probability of each profile.
+    """
+    def __init__(self, path: Union[str, Path], threads: int = 0):
+        self.path = Path(path)
+        if threads:
+            torch.set_num_threads(threads)
+        start = time.perf_counter()
+        if self.path.suffix == '.onnx':
+            import onnxruntime
+            options = onnxruntime.SessionOptions()
+            if threads:
+                options.intra_op_num_threads = threads
+            self.session = onnxruntime.InferenceSession(str(self.path), options, providers=['CPUExecutionProvider'])
+            self.meta = json.loads(self.session.get_modelmeta().custom_metadata_map.get('autotind', '{}'))
+            self.module = None
+        else:
+            extra_files = { 'meta.json': '' }
+            self.module = torch.jit.load(str(self.path), map_location='cpu', _extra_files=extra_files)
+            self.meta = json.loads(extra_files['meta.json'] or '{}')
+            self.session = None
+        self.size = self.meta.get('size', 224)
+        logger.info(f"Loaded {self.path} {self.meta} in {(time.perf_counter() - start) * 1000:.0f}ms")
+
+    @torch.inference_mode()
+    def predict(self, imgs: torch.Tensor, lengths: torch.Tensor) -> np.ndarray:
+        if self.session is not None:
+            inputs = { 'imgs': imgs.numpy(), 'lengths': lengths.numpy().astype(np.int64) }
+            return self.session.run(['probs'], inputs)[0]
+        return self.module(imgs, lengths).numpy()
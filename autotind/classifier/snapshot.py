@@ -0,0 +1,159 @@
+import argparse
+import numpy as np
+import pyarrow as pa
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Iterator, List, Union
+from loguru import logger
+from sqlalchemy import and_
+from autotind.config import config
+from autotind.person import Photo
+from autotind.store import blob_path
+from autotind.db import PersonDB, PersonRepo, PhotoDB, PhotoFileDB
+
+SNAPSHOT_VERSION = 1
+
+SCHEMA = pa.schema([
+    ('_id', pa.string()),
+    ('label', pa.string()),
+    ('birth_date', pa.timestamp('us')),
+    ('gender', pa.float64()),
+    ('distance_mi', pa.float64()),
+    ('n_photos', pa.int32()),
+    ('photo_ids', pa.list_(pa.string())),
+    # Relative to the image root, either a blob path or a legacy <user_id>/<file> path
+    ('photo_paths', pa.list_(pa.string())),
+], metadata={ 'snapshot_version': str(SNAPSHOT_VERSION) })
+
+
+def _iter_batches(repo: PersonRepo, page_size: int) -> Iterator[pa.RecordBatch]:
+    session = repo.Session()
+    try:
+        last_id = None
+        while True:
+            query = session.query(PersonDB._id, PersonDB.label, PersonDB.birth_date, PersonDB.gender, PersonDB.distance_mi)
+            if last_id is not None:
+                query = query.filter(PersonDB._id > last_id)
+            persons = query.order_by(PersonDB._id).limit(page_size).all()
+            if not persons:
+                return
+            last_id = persons[-1][0]
+
+            photos: Dict[str, List[tuple]] = {}
+            photo_query = session.query(PhotoDB.user_id, PhotoDB.id, PhotoDB.fileName, PhotoDB.width, PhotoDB.height, PhotoFileDB.path, PhotoFileDB.sha256)\
+                .outerjoin(PhotoFileDB, and_(PhotoFileDB.photo_id == PhotoDB.id, PhotoFileDB.sha256.isnot(None)))\
+                .filter(PhotoDB.user_id.in_([ p[0] for p in persons ]))\
+                .order_by(PhotoDB.user_id, PhotoDB.rank, PhotoDB.id)
+            for user_id, photo_id, file_name, width, height, ref_path, sha256 in photo_query:
+                key = Photo.key_for(user_id, file_name, width, height)
+                entries = photos.setdefault(user_id, [])
+                # A photo can have refs for its variant and its original, keep the variant
+                if ref_path is not None and ref_path != key:
+                    continue
+                if entries and entries[-1][0] == photo_id:
+                    continue
+                path = str(blob_path('', sha256)) if sha256 else key
+                entries.append((photo_id, path))
+
+            columns = {
+                '_id': [ p[0] for p in persons ],
+                'label': [ p[1] for p in persons ],
+                'birth_date': [ p[2] for p in persons ],
+                'gender': [ p[3] for p in persons ],
+                'distance_mi': [ p[4] for p in persons ],
+                'n_photos': [ len(photos.get(p[0], [])) for p in persons ],
+                'photo_ids': [ [ e[0] for e in photos.get(p[0], []) ] for p in persons ],
+                'photo_paths': [ [ e[1] for e in photos.get(p[0], []) ] for p in persons ],
+            }
+            yield pa.RecordBatch.from_pydict(columns, schema=SCHEMA)
+    finally:
+        session.close()
+
+
+def export_snapshot(db_url: str, out_dir: Union[str, Path], page_size: int = 5000) -> Path:
+    """
+    Writes one row per person with the list of their photo paths to an uncompressed Arrow IPC file
+    that `PersonSnapshot` memory-maps. Rows are streamed from SQL one page at a time.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    path = out_dir / f"persons-v{SNAPSHOT_VERSION}-{datetime.utcnow():%Y%m%dT%H%M%S}.arrow"
+    tmp_path = path.with_suffix('.arrow.part')
+    repo = PersonRepo(db_url)
+    rows = 0
+    with pa.OSFile(str(tmp_path), 'wb') as sink, pa.ipc.new_file(sink, SCHEMA) as writer:
+        for batch in _iter_batches(repo, page_size):
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    tmp_path.replace(path)
+    logger.info(f"Exported {rows} persons to {path}")
+    return path
+
+
+def latest_snapshot(snapshot_dir: Union[str, Path]) -> Path:
+    candidates = sorted(Path(snapshot_dir).glob(f"persons-v{SNAPSHOT_VERSION}-*.arrow"))
+    if not candidates:
+        raise FileNotFoundError(f"No v{SNAPSHOT_VERSION} snapshot in {snapshot_dir}, run `python -m autotind.classifier.snapshot` first")
+    return candidates[-1]
+
+
+class PersonSnapshot:
+    """
+    Memory-mapped, read-only view of a snapshot. Columns stay in the mapped file, a row's photo paths are
+    sliced out of the list column's offsets on access so no per-person Python objects are built up front.
+    """
+    def __init__(self, path: Union[str, Path]):
+        path = Path(path)
+        self.path = latest_snapshot(path) if path.is_dir() else path
+        self._open()
+
+    def _open(self):
+        self.table = pa.ipc.open_file(pa.memory_map(str(self.path), 'r')).read_all()
+        version = (self.table.schema.metadata or {}).get(b'snapshot_version', b'?').decode()
+        if version != str(SNAPSHOT_VERSION):
+            raise ValueError(f"Snapshot {self.path} has version {version}, expected {SNAPSHOT_VERSION}")
+        self._paths = self.table.column('photo_paths').chunks
+        self._photo_ids = self.table.column('photo_ids').chunks
+        self._labels = self.table.column('label').chunks
+        self._starts = np.cumsum([0] + [ len(chunk) for chunk in self._paths ])
+
+    def __getstate__(self):
+        return { 'path': self.path }
+
+    def __setstate__(self, state):
+        self.path = state['path']
+        self._open()
+
+    def __len__(self) -> int:
+        return self.table.num_rows
+
+    def column(self, name: str) -> np.ndarray:
+        return self.table.column(name).to_numpy(zero_copy_only=False)
+
+    def labels(self) -> np.ndarray:
+        return self.column('label')
+
+    def _locate(self, idx: int):
+        chunk = int(np.searchsorted(self._starts, idx, side='right')) - 1
+        return chunk, idx - self._starts[chunk]
+
+    def photo_paths(self, idx: int) -> List[str]:
+        chunk, local = self._locate(idx)
+        return self._paths[chunk][local].as_py()
+
+    def photo_ids(self, idx: int) -> List[str]:
+        chunk, local = self._locate(idx)
+        return self._photo_ids[chunk][local].as_py()
+
+    def label(self, idx: int) -> str:
+        chunk, local = self._locate(idx)
+        return self._labels[chunk][local].as_py()
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Export the person database to a columnar snapshot")
+    arg_parser.add_argument('--db-url', default=config.DB_URL)
+    arg_parser.add_argument('--out-dir', default='./snapshots')
+    arg_parser.add_argument('--page-size', type=int, default=5000)
+    args = arg_parser.parse_args()
+    export_snapshot(args.db_url, args.out_dir, args.page_size)
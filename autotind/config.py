@@ -9,4 +9,43 @@ config = Dynaconf(
         Validator("IMG_SAVE_PATH", must_exist=True, default="./images"),
         Validator("LOCATION_SPOOFING", default=False),
         Validator("LOCATION", default="0.0, 0.0"),
+        Validator("PROCESSOR_BACKEND", default="process", is_in=["process", "asyncio"]),
+        Validator("PROCESSOR_WORKERS", default=4),
+        Validator("PROCESSOR_MAX_BATCH", default=64),
+        Validator("PROCESSOR_MIN_WORKERS", default=1),
+        Validator("PROCESSOR_IDLE_TIMEOUT", default=30),
+        Validator("PROCESSOR_SCALE_INTERVAL", default=1.0),
+        Validator("PROCESSOR_TARGET_BACKLOG", default=2.0),
+        Validator("PROCESSOR_HIGH_WATER", default=1000),
+        Validator("PROCESSOR_SPILL_DIR", default="./spill"),
+        Validator("PROCESSOR_SPILL_MAX_MB", default=512),
+        Validator("PHOTO_VARIANT_MIN_SIZE", default=320),
+        Validator("PHOTO_KEEP_ORIGINAL", default=False),
+        Validator("PHOTO_VERIFY_INTERVAL", default=60),
+        Validator("PROFILE_CACHE_SIZE", default=10000),
+        Validator("DOWNLOAD_MAX_CONCURRENCY", default=16),
+        Validator("DOWNLOAD_PER_PERSON_CONCURRENCY", default=4),
+        Validator("DOWNLOAD_RETRIES", default=3),
+        Validator("DOWNLOAD_BACKOFF", default=0.5),
+        Validator("DOWNLOAD_TIMEOUT", default=15.0),
+        Validator("DOWNLOAD_WORKERS", default=2),
+        Validator("DOWNLOAD_MIN_WORKERS", default=1),
+        Validator("DOWNLOAD_QUEUE_SIZE", default=64),
+        Validator("WRITE_BATCH_SIZE", default=20),
+        Validator("WRITE_BATCH_MS", default=200),
+        Validator("LABEL_BATCH_SIZE", default=50),
+        Validator("LABEL_BATCH_MS", default=500),
+        Validator("DB_JOURNAL_MODE", default="WAL"),
+        Validator("DB_SYNCHRONOUS", default="NORMAL"),
+        Validator("DB_BUSY_TIMEOUT_MS", default=5000),
+        Validator("DB_SINGLE_WRITER", default=False),
+        Validator("SCORING_CHECKPOINT", default=None),
+        Validator("SCORING_BATCH_SIZE", default=32),
+        Validator("SCORING_BATCH_MS", default=500),
+        Validator("SCORING_THREADS", default=1),
+        Validator("METRICS_HOST", default="127.0.0.1"),
+        Validator("METRICS_PORT", default=9108),
+        Validator("METRICS_DIR", default="./metrics"),
+        Validator("METRICS_PUSH_INTERVAL", default=5.0),
+        Validator("PROFILER_INTERVAL_MS", default=10),
     ])
\ No newline at end of file
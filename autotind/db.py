@@ -1,14 +1,28 @@
+import os
 import json
-import requests
+import atexit
+import asyncio
+import time
+import signal
+from dataclasses import replace
+from datetime import datetime, timedelta
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor
 from PIL import Image
-from typing import Any, Dict, List, Union
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Set, Tuple, Union
 from pathlib import Path
 from loguru import logger
 from dateutil import parser
+from autotind import metrics, migrations
+from autotind.config import config
 from autotind.person import Label, Person, Photo
+from autotind.downloader import AsyncPhotoDownloader, DownloadResult, PhotoDownloader
+from autotind.writer import GroupCommitWriter
+from autotind.store import BlobStore
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import scoped_session, sessionmaker, relationship
-from sqlalchemy import Column, DateTime, Float, ForeignKey, Integer, String, create_engine
+from sqlalchemy.orm import Query, scoped_session, selectinload, sessionmaker, relationship
+from sqlalchemy import Boolean, Column, DateTime, Float, ForeignKey, Index, Integer, String, bindparam, create_engine, event
+from sqlalchemy.engine import Engine
 
 Base = declarative_base()
 
@@ -20,6 +34,9 @@ def is_valid_image(path: Union[str, Path]) -> bool:
         return False
 
 
+# A label only ever replaces one of a lower or equal rank: swipes replace recs and each other, nothing replaces a match
+LABEL_RANK = { Label.REC.value: 0, Label.DISLIKE.value: 1, Label.LIKE.value: 1, Label.MATCH.value: 2 }
+
 class InvalidPhotoURLException(Exception):
     pass
 
@@ -34,6 +51,11 @@ class PhotoDB(Base):
     rank = Column(Integer, nullable=True)
     score = Column(Float, nullable=True)
     win_count = Column(Integer, nullable=True)
+    width = Column(Integer, nullable=True)
+    height = Column(Integer, nullable=True)
+    original_url = Column(String, nullable=True)
+    # `to_photo` reads them, loading them with the photos keeps every read at one query per relationship
+    files = relationship("PhotoFileDB", primaryjoin="PhotoDB.id == foreign(PhotoFileDB.photo_id)", viewonly=True, lazy='selectin')
 
     @staticmethod
     def from_photo(photo: Photo) -> 'PhotoDB':
@@ -46,11 +68,14 @@ class PhotoDB(Base):
             media_type=photo.media_type,
             score=photo.score,
             win_count=photo.win_count,
-            rank=photo.rank
+            rank=photo.rank,
+            width=photo.width,
+            height=photo.height,
+            original_url=photo.original_url
         )
 
     def to_photo(self) -> "Photo":
-        return Photo(
+        photo = Photo(
             id=self.id,
             user_id=self.user_id,
             url=self.url,
@@ -59,8 +84,46 @@ class PhotoDB(Base):
             media_type=self.media_type,
             score=self.score,
             win_count=self.win_count,
-            rank=self.rank
+            rank=self.rank,
+            width=self.width,
+            height=self.height,
+            original_url=self.original_url
         )
+        key = photo.get_key()
+        sha256 = next((f.sha256 for f in self.files if f.path == key), None)
+        return replace(photo, sha256=sha256) if sha256 else photo
+
+class PhotoFileDB(Base):
+    """
+    References from photos to the blobs holding their bytes, keyed by the photo's logical path (`Photo.get_key`).
+    """
+    __tablename__ = 'photo_file'
+    path = Column(String, primary_key=True)
+    photo_id = Column(String, nullable=False, index=True)
+    sha256 = Column(String, nullable=True, index=True)
+    size = Column(Integer, nullable=False)
+    mtime = Column(Float, nullable=False)
+
+class BlobDB(Base):
+    """
+    Blobs in the content-addressed store. `validated` is None until the verifier has checked the file,
+    invalid blobs are deleted together with their references.
+    """
+    __tablename__ = 'blob'
+    sha256 = Column(String, primary_key=True)
+    size = Column(Integer, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    validated = Column(Boolean, nullable=True)
+    checked_at = Column(DateTime, nullable=True)
+
+class PendingLabelDB(Base):
+    """
+    Swipes on persons that weren't stored yet, applied as soon as the person is upserted.
+    """
+    __tablename__ = 'pending_label'
+    person_id = Column(String, primary_key=True)
+    label = Column(String, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
 
 class PersonDB(Base):
     __tablename__ = 'person'
@@ -71,11 +134,29 @@ class PersonDB(Base):
     bio = Column(String, nullable=True)
     gender = Column(Float, nullable=True)
     distance_mi = Column(Float, nullable=True)
+    fingerprint = Column(String, nullable=True)
+    score = Column(Float, nullable=True)
+    created_at = Column(DateTime, nullable=True, default=datetime.utcnow)
+    updated_at = Column(DateTime, nullable=True, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Bumped by every sighting, also the ones skipped as unchanged that never touch `updated_at`
+    last_seen = Column(DateTime, nullable=True, default=datetime.utcnow)
     photos = relationship("PhotoDB", backref="person")
 
+    __table_args__ = (
+        Index('ix_person_label_updated_at', 'label', 'updated_at'),
+        Index('ix_person_label_distance_mi', 'label', 'distance_mi'),
+        Index('ix_person_updated_at', 'updated_at'),
+        Index('ix_person_label_last_seen', 'label', 'last_seen'),
+        Index('ix_person_last_seen', 'last_seen'),
+        Index('ix_person_distance_mi', 'distance_mi'),
+        Index('ix_person_birth_date', 'birth_date'),
+        Index('ix_person_score', 'score'),
+    )
+
     @staticmethod
     def from_person(person: Person) -> "PersonDB":
         photos = [ PhotoDB.from_photo(photo) for photo in person.photos ]
+        now = datetime.utcnow()
         return PersonDB(
             _id=person._id,
             label=person.label,
@@ -84,6 +165,10 @@ class PersonDB(Base):
             bio=person.bio,
             gender=person.gender,
             distance_mi=person.distance_mi,
+            # Stored with the photos, see `PersonRepo.upsert_many`
+            fingerprint=None,
+            updated_at=now,
+            last_seen=now,
             photos=photos
         )
     
@@ -99,75 +184,832 @@ class PersonDB(Base):
             photos=[p.to_photo() for p in self.photos]
         )
 
+def make_engine(db_url: str) -> Engine:
+    if not db_url.startswith('sqlite'):
+        return create_engine(db_url)
+
+    engine = create_engine(db_url, connect_args={'timeout': config.DB_BUSY_TIMEOUT_MS / 1000})
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        # pysqlite only emits BEGIN before DML, the SAVEPOINTs of a transaction that hasn't written yet would each
+        # commit on their own. It is told to stay out of it and every transaction is begun explicitly below
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={config.DB_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={config.DB_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={int(config.DB_BUSY_TIMEOUT_MS)}")
+        cursor.close()
+
+    @event.listens_for(engine, 'begin')
+    def begin(conn):
+        conn.exec_driver_sql(f"BEGIN {conn.get_execution_options().get('sqlite_begin', 'DEFERRED')}")
+
+    return engine
+
+def make_downloader() -> PhotoDownloader:
+    return PhotoDownloader(
+        max_concurrency=config.DOWNLOAD_MAX_CONCURRENCY,
+        per_call_concurrency=config.DOWNLOAD_PER_PERSON_CONCURRENCY,
+        retries=config.DOWNLOAD_RETRIES,
+        backoff_factor=config.DOWNLOAD_BACKOFF,
+        timeout=config.DOWNLOAD_TIMEOUT,
+    )
+
+def make_async_downloader() -> AsyncPhotoDownloader:
+    return AsyncPhotoDownloader(
+        max_concurrency=config.DOWNLOAD_MAX_CONCURRENCY,
+        per_call_concurrency=config.DOWNLOAD_PER_PERSON_CONCURRENCY,
+        retries=config.DOWNLOAD_RETRIES,
+        backoff_factor=config.DOWNLOAD_BACKOFF,
+        timeout=config.DOWNLOAD_TIMEOUT,
+    )
+
 class PersonRepo:
-    def __init__(self, db_url: str) -> None:
-        self.engine = create_engine(db_url)
-        self.Session = scoped_session(sessionmaker(bind=self.engine))
-        Base.metadata.create_all(self.engine)
-    
+    """
+    The engine and session factory are created lazily in each process that uses the repo,
+    so a repo built before the workers fork never shares SQLite connections across processes.
+
+    With `single_writer`, every write is handed to a dedicated `PersonWriterProcess`
+    and the calling processes only ever read.
+    """
+    def __init__(self, db_url: str, downloader: Optional[PhotoDownloader] = None, single_writer: bool = False,
+                 img_root: Optional[Union[str, Path]] = None) -> None:
+        self.db_url = db_url
+        self.downloader = downloader or make_downloader()
+        self.store = BlobStore(img_root or config.IMG_SAVE_PATH)
+        self.writer = GroupCommitWriter(self.write_many, max_items=config.WRITE_BATCH_SIZE, max_delay_ms=config.WRITE_BATCH_MS)
+        self.label_writer = GroupCommitWriter(self.write_labels, max_items=config.LABEL_BATCH_SIZE, max_delay_ms=config.LABEL_BATCH_MS)
+        self.seen_writer = GroupCommitWriter(self.write_seen, max_items=config.LABEL_BATCH_SIZE, max_delay_ms=config.LABEL_BATCH_MS)
+        self.writer_queue: Optional[mp.Queue] = mp.Queue() if single_writer else None
+        self.writer_process: Optional["PersonWriterProcess"] = None
+        self._writer_owner: Optional[int] = None
+        self._engine: Optional[Engine] = None
+        self._session_factory: Optional[scoped_session] = None
+        self._pid = None
+        migrations.upgrade(self.engine, Base.metadata)
+        self._backfill_last_seen()
+
+    def _backfill_last_seen(self):
+        # Rows written before `last_seen` existed were last seen when they were last updated
+        session = self.Session()
+        try:
+            person = PersonDB.__table__
+            session.execute(person.update().where(person.c.last_seen.is_(None)).values(last_seen=person.c.updated_at, updated_at=person.c.updated_at))
+            session.commit()
+        finally:
+            session.close()
+
+    def _ensure_engine(self):
+        if self._pid != os.getpid():
+            if self._engine is not None:
+                # Inherited from the parent, drop the pool without closing the parent's connections
+                self._engine.dispose(close=False)
+            self._engine = make_engine(self.db_url)
+            self._session_factory = scoped_session(sessionmaker(bind=self._engine))
+            self._pid = os.getpid()
+
+    def _begin_write(self, session):
+        # A deferred SQLite transaction that reads before writing can't be upgraded once another
+        # writer commits, take the write lock up front so contention waits on busy_timeout instead
+        if self.engine.dialect.name == 'sqlite':
+            session.connection(execution_options={ 'sqlite_begin': 'IMMEDIATE' })
+
+    @staticmethod
+    def _commit(session, op: str):
+        with metrics.db_commit_seconds.labels(op=op).time():
+            session.commit()
+
+    @property
+    def engine(self) -> Engine:
+        self._ensure_engine()
+        return self._engine
+
+    @property
+    def Session(self) -> scoped_session:
+        self._ensure_engine()
+        return self._session_factory
+
+    def start_writer(self) -> "PersonWriterProcess":
+        """
+        Starts the writer process, `stop_writer` stops it once everything written before was committed. It is also
+        stopped when the interpreter exits, so a script that never calls `stop_writer` neither hangs nor loses writes.
+        """
+        if self.writer_queue is None:
+            raise ValueError("PersonRepo was not created with single_writer=True")
+        if self.writer_process is None:
+            self.writer_process = PersonWriterProcess(self)
+            self.writer_process.start()
+            self._writer_owner = os.getpid()
+            atexit.register(self.stop_writer)
+        return self.writer_process
+
+    def stop_writer(self):
+        # Forked workers inherit the handle, only the process that started the writer stops it
+        if self.writer_process is not None and self._writer_owner == os.getpid():
+            self.writer_process.stop()
+            self.writer_process = None
+
     def upsert(self, person: Person):
+        """
+        Writes the row and downloads the person's photos.
+        """
+        [e] = self.upsert_many([person])
+        if e is not None:
+            raise e
+
+    def upsert_many(self, persons: Sequence[Person], download: bool = True) -> List[Optional[Exception]]:
+        """
+        Writes all rows in one group commit, then downloads photos for every person. Without `download` only the rows
+        are written, `download_photos` fetches the photos later. Returns one entry per person: None or the error that person raised.
+
+        A row is written without its fingerprint, `_write_files` stores it with the photos: until they are all stored,
+        the next sighting of the person counts as a change and writes it again.
+        """
+        errors: List[Optional[Exception]] = [None] * len(persons)
+        ready = []
+        for idx, person in enumerate(persons):
+            if len(person.photos) == 0:
+                errors[idx] = Exception("Person has no photos")
+            else:
+                ready.append((idx, person))
+        if not ready:
+            return errors
+
+        if self.writer_queue is not None:
+            for _, person in ready:
+                self.writer_queue.put(('upsert', person))
+        else:
+            # Already a batch, committed right away so the caller gets every row's error. The single writer batches
+            # the rows it is handed one at a time with `writer`, both count in the same stats.
+            start = time.perf_counter()
+            write_errors = self.write_many([ person for _, person in ready ])
+            self.writer.stats.record(len(ready), (time.perf_counter() - start) * 1000, sum(e is not None for e in write_errors))
+            for (idx, _), e in zip(ready, write_errors):
+                errors[idx] = e
+
+        if download:
+            written = [ (idx, person) for idx, person in ready if errors[idx] is None ]
+            for (idx, _), result in zip(written, self.download_photos([ person for _, person in written ])):
+                if isinstance(result, Exception):
+                    errors[idx] = result
+        return errors
+
+    def write_many(self, persons: Sequence[Person]) -> List[Optional[Exception]]:
+        """
+        Merges every person in a single transaction, each inside its own savepoint so that
+        a failing row is rolled back alone. Returns one entry per person: None or the error.
+        """
         session = self.Session()
+        errors: List[Optional[Exception]] = []
+        try:
+            self._begin_write(session)
+            labels = self._stored_labels(session, [ person._id for person in persons ])
+            scores = self._stored_scores(session, [ person._id for person in persons ])
+            for person in persons:
+                try:
+                    with session.begin_nested():
+                        self._merge_persons(session, [person], labels, scores)
+                    errors.append(None)
+                except Exception as e:
+                    errors.append(e)
+            self._apply_pending_labels(session, [ person._id for person, e in zip(persons, errors) if e is None ])
+            self._commit(session, 'upserts')
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+        return errors
 
+    @staticmethod
+    def _stored_labels(session, ids: List[str]) -> Dict[str, str]:
+        return dict(session.query(PersonDB._id, PersonDB.label).filter(PersonDB._id.in_(ids)))
+
+    @staticmethod
+    def _stored_scores(session, ids: List[str]) -> Dict[str, Tuple[float, int]]:
+        query = session.query(PhotoDB.id, PhotoDB.score, PhotoDB.rank).filter(PhotoDB.user_id.in_(ids), PhotoDB.score >= 0)
+        return { id: (score, rank) for id, score, rank in query }
+
+    def _merge_persons(self, session, persons: Sequence[Person], labels: Optional[Dict[str, str]] = None, scores: Optional[Dict[str, Tuple[float, int]]] = None):
+        if labels is None:
+            labels = self._stored_labels(session, [ person._id for person in persons ])
+        if scores is None:
+            scores = self._stored_scores(session, [ person._id for person in persons ])
+        for person in persons:
+            row = PersonDB.from_person(person)
+            # Seeing a person again in recs must not undo a swipe or a match
+            stored = labels.get(person._id)
+            if row.label == Label.REC.value and stored not in (None, Label.REC.value):
+                row.label = stored
+            # Nor drop the scores and ranks the classifier gave their photos
+            for photo in row.photos:
+                if (photo.score is None or photo.score < 0) and photo.id in scores:
+                    photo.score, photo.rank = scores[photo.id]
+            session.merge(row)
+
+    def flush(self):
+        self.writer.flush()
+        self.label_writer.flush()
+        self.seen_writer.flush()
+
+    def flush_stats(self) -> Dict[str, Dict[str, float]]:
+        return { 'upserts': self.writer.stats.snapshot(), 'labels': self.label_writer.stats.snapshot(), 'seen': self.seen_writer.stats.snapshot() }
+
+    def mark_seen(self, ids: Sequence[str]):
+        """
+        Records a sighting of persons that weren't upserted because they were stored unchanged.
+        """
+        if not ids:
+            return
+        if self.writer_queue is not None:
+            self.writer_queue.put(('seen', list(ids)))
+            return
+        for id in ids:
+            self.seen_writer.add(id)
+
+    def write_seen(self, ids: Sequence[str]) -> List[Optional[Exception]]:
+        session = self.Session()
         try:
-            if len(person.photos) == 0:
-                raise Exception("Person has no photos")
-            p = PersonDB.from_person(person)
-            self._download_photos(person)
-            session.merge(p)
-            session.commit()
+            self._begin_write(session)
+            person = PersonDB.__table__
+            session.execute(person.update().where(person.c._id.in_(set(ids))).values(last_seen=datetime.utcnow(), updated_at=person.c.updated_at))
+            self._commit(session, 'seen')
         except Exception as e:
             session.rollback()
             raise e
+        finally:
+            session.close()
+        return [None] * len(ids)
+
+    def download_photos(self, persons: Sequence[Person]) -> List[Union[Person, Exception]]:
+        """
+        Downloads and records the photos of already stored persons, a few persons at a time so that every slot of the
+        downloader's pool is in use. Returns one entry per person: the person with the `sha256` of the photos stored
+        for it filled in, or the error its downloads raised. With a single writer the references may not be committed
+        yet, the hashes are the way to find the new files.
+        """
+        if not persons:
+            return []
+        def download(person: Person) -> Union[Person, Exception]:
+            try:
+                return self._download_photos(person)
+            except Exception as e:
+                return e
+        concurrency = max(1, self.downloader.max_concurrency // self.downloader.per_call_concurrency)
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(persons)), thread_name_prefix='person-dl') as pool:
+            return list(pool.map(download, persons))
+
+    async def download_photos_async(self, persons: Sequence[Person], downloader: AsyncPhotoDownloader) -> List[Union[Person, Exception]]:
+        """
+        `download_photos` for an event loop: every person at once, the connection pool of `downloader` bounds
+        the requests in flight. Index lookups and writes run in threads.
+        """
+        async def download(person: Person) -> Union[Person, Exception]:
+            try:
+                jobs, refs, blobs = await asyncio.to_thread(self._plan_downloads, person)
+                results = await downloader.download([ (url, tmp_path) for _, _, url, tmp_path in jobs ])
+                hashes = await asyncio.to_thread(self._record_downloads, person, jobs, results, refs, blobs)
+                return self._with_hashes(person, hashes)
+            except Exception as e:
+                return e
+        return list(await asyncio.gather(*(download(person) for person in persons)))
+
+    def _download_photos(self, person: Person) -> Person:
+        jobs, refs, blobs = self._plan_downloads(person)
+        results = self.downloader.download([ (url, tmp_path) for _, _, url, tmp_path in jobs ])
+        return self._with_hashes(person, self._record_downloads(person, jobs, results, refs, blobs))
+
+    @staticmethod
+    def _with_hashes(person: Person, hashes: Dict[str, str]) -> Person:
+        photos = [ replace(photo, sha256=hashes[photo.get_key()]) if photo.get_key() in hashes else photo for photo in person.photos ]
+        return replace(person, photos=photos)
 
-    def _download_photos(self, person: Person):
-        path = person.get_path('./images')
-        path.mkdir(parents=True, exist_ok=True)
+    def _plan_downloads(self, person: Person) -> Tuple[List[tuple], List[dict], List[dict]]:
+        """
+        The (photo, key, url, tmp_path) jobs for the files of `person` that aren't stored yet, and the rows of
+        the files imported from the legacy layout instead.
+        """
+        wanted = { key: (photo, url) for photo in person.photos for url, key in photo.downloads() }
+        indexed = self.indexed_files(wanted.keys())
 
-        for photo in person.photos:
-            path = photo.get_path('./images')
-            if path.exists():
-                if is_valid_image(path):
+        jobs = []
+        refs, blobs = [], []
+        for key, (photo, url) in wanted.items():
+            if key in indexed:
+                continue
+            # Files saved before the blob store existed are moved into it the first time they are needed
+            legacy_path = self.store.root / key
+            if legacy_path.exists():
+                if is_valid_image(legacy_path):
+                    sha256, size = self.store.import_file(legacy_path)
+                    refs.append(self._ref_row(key, photo.id, sha256, size))
+                    blobs.append(self._blob_row(sha256, size, validated=True))
                     continue
                 else:
-                    logger.info(f"Deleting invalid image: {path}")
-                    path.unlink()
+                    logger.info(f"Deleting invalid image: {legacy_path}")
+                    legacy_path.unlink()
+            jobs.append((photo, key, url, self.store.tmp_path()))
+        return jobs, refs, blobs
 
-            try:
-                req = requests.get(photo.url, stream=True)
-                req.raise_for_status()
+    def _record_downloads(self, person: Person, jobs: List[tuple], results: List[DownloadResult], refs: List[dict], blobs: List[dict]) -> Dict[str, str]:
+        """
+        Stores the downloaded files and records them with `refs`, returns the sha256 of every recorded key.
+        Once every photo of `person` is stored, its fingerprint is recorded with them.
+        """
+        for (photo, key, _, _), result in zip(jobs, results):
+            if result.error is not None:
+                continue
+            self.store.commit(result.path, result.sha256)
+            refs.append(self._ref_row(key, photo.id, result.sha256, result.size))
+            blobs.append(self._blob_row(result.sha256, result.size))
 
-                with open(path, 'wb') as f:
-                    for chunk in req.iter_content(chunk_size=1024):
-                        if chunk:
-                            f.write(chunk)
-                            f.flush()
+        errors = [ r.error for r in results if r.error ]
+        self.record_files(refs, blobs, {} if errors else { person._id: person.fingerprint() })
+        if errors:
+            e = errors[0]
+            if e.status_code == 403:
+                raise InvalidPhotoURLException(f"403 Forbidden: {e.url[:50]}")
+            raise InvalidPhotoURLException(e)
+        return { ref['path']: ref['sha256'] for ref in refs }
 
-            except Exception as e:
-                path.unlink(missing_ok=True)
-                if req.status_code == 403:
-                    e = f"403 Forbidden: {photo.url[:50]}"
-                raise InvalidPhotoURLException(e)
+    @staticmethod
+    def _ref_row(key: str, photo_id: str, sha256: str, size: int) -> dict:
+        return { 'path': key, 'photo_id': photo_id, 'sha256': sha256, 'size': size, 'mtime': time.time() }
 
-    def like(self, id: str):
+    @staticmethod
+    def _blob_row(sha256: str, size: int, validated: Optional[bool] = None) -> dict:
+        now = datetime.utcnow()
+        return { 'sha256': sha256, 'size': size, 'created_at': now, 'validated': validated, 'checked_at': now if validated else None }
+
+    def indexed_files(self, paths: Iterable[str]) -> Set[str]:
+        paths = list(paths)
+        if not paths:
+            return set()
+        session = self.Session()
+        try:
+            query = session.query(PhotoFileDB.path).filter(PhotoFileDB.path.in_(paths), PhotoFileDB.sha256.isnot(None))
+            return { path for path, in query }
+        finally:
+            session.close()
+
+    def blob_paths(self, keys: Iterable[str]) -> Dict[str, Path]:
+        """
+        Maps photo keys to the blob their file was stored as, keys without a stored file are left out.
+        """
+        keys = list(keys)
+        if not keys:
+            return {}
+        session = self.Session()
+        try:
+            query = session.query(PhotoFileDB.path, PhotoFileDB.sha256).filter(PhotoFileDB.path.in_(keys), PhotoFileDB.sha256.isnot(None))
+            return { path: self.store.path(sha256) for path, sha256 in query }
+        finally:
+            session.close()
+
+    def fingerprints(self, ids: Iterable[str]) -> Dict[str, Optional[str]]:
+        ids = list(ids)
+        if not ids:
+            return {}
+        session = self.Session()
+        try:
+            return dict(session.query(PersonDB._id, PersonDB.fingerprint).filter(PersonDB._id.in_(ids)))
+        finally:
+            session.close()
+
+    def record_files(self, refs: List[dict], blobs: List[dict], fingerprints: Optional[Dict[str, str]] = None):
+        """
+        Records stored photo files, and the fingerprints of persons whose photos are now all stored.
+        """
+        if not (refs or blobs or fingerprints):
+            return
+        if self.writer_queue is not None:
+            self.writer_queue.put(('files', (refs, blobs, fingerprints)))
+            return
+        self._write_files(refs, blobs, fingerprints)
+
+    def record_blob_checks(self, blobs: List[dict]):
+        if self.writer_queue is not None:
+            self.writer_queue.put(('blob_checks', blobs))
+            return
+        self._write_blob_checks(blobs)
+
+    def forget_blobs(self, sha256s: List[str]):
+        if self.writer_queue is not None:
+            self.writer_queue.put(('forget_blobs', sha256s))
+            return
+        self._delete_blobs(sha256s)
+
+    def record_scores(self, photos: List[dict], persons: Optional[List[dict]] = None):
+        """
+        Stores classifier scores with bulk updates. `photos` holds `{'id', 'score'}` rows, optionally with a `rank`,
+        `persons` holds `{'_id', 'score'}` rows.
+        """
+        if self.writer_queue is not None:
+            self.writer_queue.put(('scores', (photos, persons)))
+            return
+        self._write_scores(photos, persons)
+
+    def _write_files(self, refs: List[dict], blobs: List[dict], fingerprints: Optional[Dict[str, str]] = None):
+        # The rows the fingerprints go to may still be buffered by the single writer
+        self.writer.flush()
         session = self.Session()
-        session.query(PersonDB).where(PersonDB._id == id).update({ "label": Label.LIKE.value })
-        session.commit()
-        session.close()
+        try:
+            self._begin_write(session)
+            for id, fingerprint in (fingerprints or {}).items():
+                session.query(PersonDB).filter(PersonDB._id == id).update({ 'fingerprint': fingerprint, 'updated_at': PersonDB.updated_at }, synchronize_session=False)
+            # Checked under the write lock: collect_garbage deletes blob files holding it too, so a blob
+            # found stored by `store.commit` that was collected since is seen missing here
+            missing = { blob['sha256'] for blob in blobs if not self.store.exists(blob['sha256']) }
+            if missing:
+                logger.warning(f"{len(missing)} blobs were collected before their references were written, dropping them")
+                photo_ids = [ ref['photo_id'] for ref in refs if ref['sha256'] in missing ]
+                affected = session.query(PhotoDB.user_id).filter(PhotoDB.id.in_(photo_ids))
+                # So their next sighting downloads them again
+                session.query(PersonDB).filter(PersonDB._id.in_(affected.scalar_subquery())).update({ 'fingerprint': None }, synchronize_session=False)
+                refs = [ ref for ref in refs if ref['sha256'] not in missing ]
+                blobs = [ blob for blob in blobs if blob['sha256'] not in missing ]
+            for blob in blobs:
+                # A blob that is already known keeps its validation state
+                if session.get(BlobDB, blob['sha256']) is None:
+                    session.add(BlobDB(**blob))
+            for ref in refs:
+                session.merge(PhotoFileDB(**ref))
+            self._commit(session, 'files')
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def _write_blob_checks(self, blobs: List[dict]):
+        session = self.Session()
+        try:
+            self._begin_write(session)
+            for blob in blobs:
+                session.query(BlobDB).filter(BlobDB.sha256 == blob['sha256']).update(blob, synchronize_session=False)
+            self._commit(session, 'blob_checks')
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def _write_scores(self, photos: List[dict], persons: Optional[List[dict]] = None):
+        session = self.Session()
+        try:
+            self._begin_write(session)
+            if photos:
+                session.bulk_update_mappings(PhotoDB, photos)
+            if persons:
+                person = PersonDB.__table__
+                # Scoring is not a sighting, keep updated_at as it is
+                session.execute(
+                    person.update().where(person.c._id == bindparam('person_id')).values(score=bindparam('new_score'), updated_at=person.c.updated_at),
+                    [ { 'person_id': row['_id'], 'new_score': row['score'] } for row in persons ]
+                )
+            self._commit(session, 'scores')
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+    def _delete_blobs(self, sha256s: List[str]):
+        session = self.Session()
+        try:
+            self._begin_write(session)
+            # Persons that lost a photo must not be skipped as unchanged on their next sighting
+            affected = session.query(PhotoDB.user_id)\
+                .join(PhotoFileDB, PhotoFileDB.photo_id == PhotoDB.id)\
+                .filter(PhotoFileDB.sha256.in_(sha256s))
+            session.query(PersonDB).filter(PersonDB._id.in_(affected.scalar_subquery())).update({ 'fingerprint': None }, synchronize_session=False)
+            session.query(PhotoFileDB).filter(PhotoFileDB.sha256.in_(sha256s)).delete(synchronize_session=False)
+            session.query(BlobDB).filter(BlobDB.sha256.in_(sha256s)).delete(synchronize_session=False)
+            self._commit(session, 'forget_blobs')
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+        for sha256 in sha256s:
+            self.store.delete(sha256)
+
+    def collect_garbage(self, min_age: timedelta = timedelta(hours=1)) -> Dict[str, int]:
+        """
+        Deletes references to photos that no longer exist, blobs nothing references, blob files the
+        database doesn't know about and stale temp files. Anything younger than `min_age` is left alone
+        so that downloads still being recorded are not collected. Unreferenced blob files are deleted before the
+        transaction commits, while it holds the write lock `_write_files` needs to reference them.
+        """
+        cutoff = datetime.utcnow() - min_age
+        session = self.Session()
+        try:
+            self._begin_write(session)
+            orphan_refs = session.query(PhotoFileDB)\
+                .filter(~PhotoFileDB.photo_id.in_(session.query(PhotoDB.id)))\
+                .delete(synchronize_session=False)
+            unreferenced = [ sha256 for sha256, in session.query(BlobDB.sha256)
+                .filter(BlobDB.created_at < cutoff, ~BlobDB.sha256.in_(session.query(PhotoFileDB.sha256).filter(PhotoFileDB.sha256.isnot(None)))) ]
+            for start in range(0, len(unreferenced), 500):
+                chunk = unreferenced[start:start+500]
+                session.query(BlobDB).filter(BlobDB.sha256.in_(chunk)).delete(synchronize_session=False)
+            for sha256 in unreferenced:
+                self.store.delete(sha256)
+            self._commit(session, 'gc')
+
+            known = { sha256 for sha256, in session.query(BlobDB.sha256) }
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+
+        untracked = 0
+        file_cutoff = time.time() - min_age.total_seconds()
+        for sha256, stat in self.store.iter_blobs():
+            if sha256 not in known and stat.st_mtime < file_cutoff:
+                self.store.delete(sha256)
+                untracked += 1
+        tmp = self.store.clean_tmp(min_age.total_seconds())
+        return { 'orphan_refs': orphan_refs, 'unreferenced_blobs': len(unreferenced), 'untracked_blobs': untracked, 'tmp_files': tmp }
+
+    def like(self, id: str):
+        self._label(id, Label.LIKE.value)
     
     def dislike(self, id: str):
+        self._label(id, Label.DISLIKE.value)
+
+    def _label(self, id: str, label: str):
+        if self.writer_queue is not None:
+            self.writer_queue.put(('label', (id, label)))
+            return
+        self.label_writer.add((id, label))
+
+    def write_labels(self, events: Sequence[Tuple[str, str]]) -> List[Optional[Exception]]:
+        """
+        Applies a batch of (person id, label) swipes in one transaction, the last swipe per person wins.
+        Swipes on persons that aren't stored yet are kept in `pending_label` until their upsert.
+        """
+        # A buffered upsert of one of these persons must land first or it would overwrite the label
+        self.writer.flush()
+        latest = dict(events)
+        now = datetime.utcnow()
         session = self.Session()
-        session.query(PersonDB).where(PersonDB._id == id).update({ "label": Label.DISLIKE.value })
-        session.commit()
-        session.close()
+        try:
+            self._begin_write(session)
+            existing = { id for id, in session.query(PersonDB._id).filter(PersonDB._id.in_(latest.keys())) }
+            if existing:
+                person = PersonDB.__table__
+                session.execute(
+                    person.update().where(person.c._id == bindparam('person_id')).values(label=bindparam('new_label'), updated_at=now, last_seen=now),
+                    [ { 'person_id': id, 'new_label': latest[id] } for id in existing ]
+                )
+            for id, label in latest.items():
+                if id not in existing:
+                    session.merge(PendingLabelDB(person_id=id, label=label, created_at=now))
+            self._commit(session, 'labels')
+        except Exception as e:
+            session.rollback()
+            raise e
+        finally:
+            session.close()
+        if len(existing) < len(latest):
+            logger.info(f"Deferred {len(latest) - len(existing)} label(s) for persons not stored yet")
+        return [None] * len(events)
+
+    def _apply_pending_labels(self, session, ids: List[str]):
+        if not ids:
+            return
+        pending = session.query(PendingLabelDB).filter(PendingLabelDB.person_id.in_(ids)).all()
+        labels = self._stored_labels(session, [ entry.person_id for entry in pending ])
+        for entry in pending:
+            # A swipe kept for a person who shows up in a matches page must not undo the match
+            if LABEL_RANK.get(entry.label, 0) >= LABEL_RANK.get(labels.get(entry.person_id), 0):
+                session.query(PersonDB).filter(PersonDB._id == entry.person_id).update({ 'label': entry.label }, synchronize_session=False)
+            session.delete(entry)
 
     def get_all(self) -> List[Person]:
-        session = self.Session()
-        data = [ p.to_person() for p in session.query(PersonDB).all() ]
-        session.close()
-        return data
+        return list(self.iter_persons())
 
     def where(self, condition: Dict[str, Any]) -> List[Person]:
+        return list(self.iter_persons(condition))
+
+    def query(self) -> "PersonQuery":
+        return PersonQuery(self)
+
+    def iter_pages(self, condition: Optional[Dict[str, Any]] = None, page_size: int = 500) -> Iterator[List[Person]]:
+        return self._iter_pages(lambda query: query.filter_by(**(condition or {})).order_by(PersonDB._id), page_size)
+
+    def _iter_pages(self, build: Callable[[Query], Query], page_size: int) -> Iterator[List[Person]]:
+        """
+        Streams persons from a server-side cursor, `page_size` rows at a time. Photos and their blob references
+        are loaded with one IN query per page instead of one query per person.
+        """
+        session = self.Session()
+        try:
+            query = build(session.query(PersonDB))\
+                .options(selectinload(PersonDB.photos).selectinload(PhotoDB.files))\
+                .execution_options(stream_results=True)\
+                .yield_per(page_size)
+            page = []
+            for person in query:
+                page.append(person.to_person())
+                if len(page) >= page_size:
+                    yield page
+                    page = []
+            if page:
+                yield page
+        finally:
+            session.close()
+
+    def iter_persons(self, condition: Optional[Dict[str, Any]] = None, page_size: int = 500) -> Iterator[Person]:
+        for page in self.iter_pages(condition, page_size):
+            yield from page
+
+    def iter_rows(self, columns: Sequence[str], photo_columns: Optional[Sequence[str]] = None,
+                  condition: Optional[Dict[str, Any]] = None, page_size: int = 1000, after: Optional[str] = None,
+                  updated_since: Optional[datetime] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Streams plain dicts holding only the requested `PersonDB` columns, without building ORM objects, in `_id` order
+        starting after `after`, only persons updated at or after `updated_since` if given. With `photo_columns`, each row
+        gets a `photos` list of dicts with those `PhotoDB` columns, ordered by rank, fetched with one query per page.
+        """
+        person_cols = [ getattr(PersonDB, name) for name in columns ]
+        photo_cols = [ getattr(PhotoDB, name) for name in photo_columns or [] ]
         session = self.Session()
-        data = [ p.to_person() for p in session.query(PersonDB).filter_by(**condition).all() ]
-        session.close()
-        return data
+        try:
+            last_id = after
+            while True:
+                query = session.query(PersonDB._id, *person_cols).filter_by(**(condition or {}))
+                if updated_since is not None:
+                    query = query.filter(PersonDB.updated_at >= updated_since)
+                if last_id is not None:
+                    query = query.filter(PersonDB._id > last_id)
+                page = query.order_by(PersonDB._id).limit(page_size).all()
+                if not page:
+                    return
+                last_id = page[-1][0]
+
+                photos: Dict[str, List[dict]] = {}
+                if photo_cols:
+                    photo_query = session.query(PhotoDB.user_id, *photo_cols)\
+                        .filter(PhotoDB.user_id.in_([ row[0] for row in page ]))\
+                        .order_by(PhotoDB.user_id, PhotoDB.rank)
+                    for user_id, *values in photo_query:
+                        photos.setdefault(user_id, []).append(dict(zip(photo_columns, values)))
+
+                for _id, *values in page:
+                    row = dict(zip(columns, values))
+                    if photo_cols:
+                        row['photos'] = photos.get(_id, [])
+                    yield row
+        finally:
+            session.close()
+
+
+class PersonQuery:
+    """
+    Chainable filters over persons, each backed by an index on `person`:
+
+        repo.query().labels(Label.LIKE).seen_since(week_ago).distance_between(max=10).all()
+    """
+    def __init__(self, repo: PersonRepo):
+        self.repo = repo
+        self.criteria = []
+        self.ordering = []
+        self._limit: Optional[int] = None
+
+    def labels(self, *labels: Union[Label, str]) -> "PersonQuery":
+        values = [ label.value if isinstance(label, Label) else label for label in labels ]
+        self.criteria.append(PersonDB.label.in_(values))
+        return self
+
+    def born_between(self, start: Optional[datetime] = None, end: Optional[datetime] = None) -> "PersonQuery":
+        if start is not None:
+            self.criteria.append(PersonDB.birth_date >= start)
+        if end is not None:
+            self.criteria.append(PersonDB.birth_date <= end)
+        return self
+
+    @staticmethod
+    def _years_ago(now: datetime, years: int) -> datetime:
+        try:
+            return now.replace(year=now.year - years)
+        except ValueError:
+            # Feb 29th in a non leap year
+            return now.replace(year=now.year - years, day=28)
+
+    def age_between(self, min: Optional[int] = None, max: Optional[int] = None) -> "PersonQuery":
+        now = datetime.utcnow()
+        # Someone is `max` years old until the day before their (max + 1)th birthday
+        start = self._years_ago(now, max + 1) + timedelta(days=1) if max is not None else None
+        end = self._years_ago(now, min) if min is not None else None
+        return self.born_between(start, end)
+
+    def distance_between(self, min: Optional[float] = None, max: Optional[float] = None) -> "PersonQuery":
+        if min is not None:
+            self.criteria.append(PersonDB.distance_mi >= min)
+        if max is not None:
+            self.criteria.append(PersonDB.distance_mi <= max)
+        return self
+
+    def seen_since(self, since: datetime) -> "PersonQuery":
+        """
+        Persons intercepted or swiped since `since`, sightings of unchanged profiles count too.
+        """
+        self.criteria.append(PersonDB.last_seen >= since)
+        return self
+
+    def order_by(self, column: str, desc: bool = False) -> "PersonQuery":
+        attr = getattr(PersonDB, column)
+        self.ordering.append(attr.desc() if desc else attr.asc())
+        return self
+
+    def limit(self, n: int) -> "PersonQuery":
+        self._limit = n
+        return self
+
+    def _build(self, query: Query) -> Query:
+        query = query.filter(*self.criteria).order_by(*self.ordering, PersonDB._id)
+        if self._limit is not None:
+            query = query.limit(self._limit)
+        return query
+
+    def __iter__(self) -> Iterator[Person]:
+        for page in self.iter_pages():
+            yield from page
+
+    def iter_pages(self, page_size: int = 500) -> Iterator[List[Person]]:
+        return self.repo._iter_pages(self._build, page_size)
+
+    def all(self) -> List[Person]:
+        return list(self)
+
+    def ids(self) -> List[str]:
+        session = self.repo.Session()
+        try:
+            return [ id for id, in self._build(session.query(PersonDB._id)) ]
+        finally:
+            session.close()
+
+    def count(self) -> int:
+        """
+        Counts what `all` would return, `limit` included.
+        """
+        session = self.repo.Session()
+        try:
+            return self._build(session.query(PersonDB._id)).count()
+        finally:
+            session.close()
+
+
+class PersonWriterProcess(mp.Process):
+    """
+    Owns the only write connection to the database. Workers hand it rows through
+    `PersonRepo.writer_queue`, it group-commits them in arrival order.
+    """
+    def __init__(self, repo: PersonRepo):
+        super().__init__(name='person-writer')
+        self.repo = repo
+        self.queue = repo.writer_queue
+
+    def run(self):
+        def signal_handler(sig, frame):
+            # Stopped by `PersonRepo.stop_writer` once the stages handing it rows have drained
+            logger.warning(f"Writer received signal {signal.strsignal(sig)}, waiting to be stopped")
+
+        signal.signal(signal.SIGINT, signal_handler)
+
+        while True:
+            message = self.queue.get()
+            if message is None:
+                break
+            op, payload = message
+            try:
+                if op == 'upsert':
+                    self.repo.writer.add(payload)
+                elif op == 'label':
+                    self.repo.label_writer.add(payload)
+                elif op == 'seen':
+                    for id in payload:
+                        self.repo.seen_writer.add(id)
+                elif op == 'files':
+                    self.repo._write_files(*payload)
+                elif op == 'blob_checks':
+                    self.repo._write_blob_checks(payload)
+                elif op == 'forget_blobs':
+                    self.repo._delete_blobs(payload)
+                elif op == 'scores':
+                    self.repo._write_scores(*payload)
+                else:
+                    logger.error(f"Unknown writer op `{op}`")
+            except Exception as e:
+                logger.error(f"Writer {op}: {e}")
+
+        self.repo.flush()
+        logger.info(f"Writer stopped, group commit stats: {self.repo.flush_stats()}")
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
@@ -0,0 +1,60 @@
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Sequence
+from autotind.person import Person
+from autotind.db import PersonRepo
+
+
+class ProfileCache:
+    """
+    Drops profiles that were already stored unchanged, photos included. Profiles are compared against the fingerprints
+    stored with `PersonDB` once their photos are, the pairs found there are kept in a bounded LRU.
+    The cache is per process: each worker keeps its own after the fork, handler threads of the asyncio backend share one.
+    """
+    def __init__(self, repo: PersonRepo, max_size: int = 10000):
+        self.repo = repo
+        self.max_size = max_size
+        self._seen: "OrderedDict[str, str]" = OrderedDict()
+        self.lru_hits = 0
+        self.db_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def _remember(self, id: str, fingerprint: str):
+        self._seen[id] = fingerprint
+        self._seen.move_to_end(id)
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
+
+    def filter_changed(self, persons: Sequence[Person]) -> List[Person]:
+        pending = []
+        with self._lock:
+            for person in persons:
+                fingerprint = person.fingerprint()
+                if self._seen.get(person._id) == fingerprint:
+                    self._seen.move_to_end(person._id)
+                    self.lru_hits += 1
+                else:
+                    pending.append((person, fingerprint))
+
+        stored = self.repo.fingerprints(person._id for person, _ in pending)
+        changed = []
+        with self._lock:
+            for person, fingerprint in pending:
+                if stored.get(person._id) == fingerprint:
+                    self._remember(person._id, fingerprint)
+                    self.db_hits += 1
+                else:
+                    changed.append(person)
+                    self.misses += 1
+        return changed
+
+    def stats(self) -> Dict[str, float]:
+        total = self.lru_hits + self.db_hits + self.misses
+        return {
+            'lru_hits': self.lru_hits,
+            'db_hits': self.db_hits,
+            'misses': self.misses,
+            'hit_rate': (self.lru_hits + self.db_hits) / total if total else 0.0,
+            'size': len(self._seen),
+        }
@@ -0,0 +1,233 @@
+import os
+import time
+import asyncio
+import hashlib
+import threading
+import aiohttp
+import requests
+from dataclasses import dataclass
+from pathlib import Path
+from loguru import logger
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Iterable, List, Optional, Tuple
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from autotind import metrics
+
+CHUNK_SIZE = 64 * 1024
+WRITE_BUFFER_SIZE = 1024 * 1024
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class DownloadError(Exception):
+    def __init__(self, url: str, message: str, status_code: Optional[int] = None):
+        super().__init__(message)
+        self.url = url
+        self.status_code = status_code
+
+
+@dataclass
+class DownloadResult:
+    url: str
+    path: Path
+    size: int = 0
+    sha256: Optional[str] = None
+    error: Optional[DownloadError] = None
+
+
+class PhotoDownloader:
+    """
+    Fetches photos over a shared keep-alive connection pool.
+
+    `max_concurrency` bounds the number of in-flight requests across every caller,
+    `per_call_concurrency` bounds how many of those a single `download` call may hold.
+    """
+    def __init__(self, max_concurrency: int = 16, per_call_concurrency: int = 4, retries: int = 3,
+                 backoff_factor: float = 0.5, timeout: float = 15.0, session: Optional[requests.Session] = None):
+        self.max_concurrency = max_concurrency
+        self.per_call_concurrency = max(1, min(per_call_concurrency, max_concurrency))
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self._session = session
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _make_session(pool_size: int, retries: int, backoff_factor: float) -> requests.Session:
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=frozenset(['GET']),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def _ensure_process_local(self):
+        # Thread pools and pooled sockets don't survive a fork, build them lazily in whichever process uses them
+        with self._lock:
+            if self._pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix='photo-dl')
+                if self._session is None or self._pid is not None:
+                    self._session = self._make_session(self.max_concurrency, self.retries, self.backoff_factor)
+                self._pid = os.getpid()
+
+    @property
+    def session(self) -> requests.Session:
+        self._ensure_process_local()
+        return self._session
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        self._ensure_process_local()
+        return self._executor
+
+    def fetch(self, url: str, path: Path) -> DownloadResult:
+        tmp_path = path.with_name(f".{path.name}.part")
+        start = time.perf_counter()
+        try:
+            with self.session.get(url, stream=True, timeout=self.timeout) as res:
+                if res.status_code >= 400:
+                    raise DownloadError(url, f"{res.status_code} {res.reason}: {url[:50]}", res.status_code)
+                size = 0
+                digest = hashlib.sha256()
+                with open(tmp_path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+                    for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+                        f.write(chunk)
+                        digest.update(chunk)
+                        size += len(chunk)
+            os.replace(tmp_path, path)
+            metrics.download_seconds.labels(result='ok').observe(time.perf_counter() - start)
+            metrics.download_bytes.inc(size)
+            return DownloadResult(url, path, size, digest.hexdigest())
+        except DownloadError:
+            tmp_path.unlink(missing_ok=True)
+            metrics.download_seconds.labels(result='error').observe(time.perf_counter() - start)
+            raise
+        except Exception as e:
+            tmp_path.unlink(missing_ok=True)
+            metrics.download_seconds.labels(result='error').observe(time.perf_counter() - start)
+            raise DownloadError(url, f"{type(e).__name__}: {e}") from e
+
+    def download(self, jobs: Iterable[Tuple[str, Path]]) -> List[DownloadResult]:
+        """
+        Downloads every (url, path) pair, returns one result per job, failed jobs have `error` set.
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return []
+        slots = threading.BoundedSemaphore(self.per_call_concurrency)
+        futures: List[Future] = []
+        for url, path in jobs:
+            slots.acquire()
+            future = self.executor.submit(self.fetch, url, path)
+            future.add_done_callback(lambda _: slots.release())
+            futures.append(future)
+
+        results = []
+        for (url, path), future in zip(jobs, futures):
+            try:
+                results.append(future.result())
+            except DownloadError as e:
+                logger.debug(f"Download failed: {e}")
+                results.append(DownloadResult(url, path, error=e))
+        return results
+
+    def close(self):
+        if self._pid == os.getpid():
+            self._executor.shutdown(wait=True)
+            self._session.close()
+        self._executor = None
+        self._pid = None
+
+
+def _write_file(path: Path, body: bytes) -> str:
+    tmp_path = path.with_name(f".{path.name}.part")
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(body)
+        os.replace(tmp_path, path)
+    except Exception:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    return hashlib.sha256(body).hexdigest()
+
+
+class AsyncPhotoDownloader:
+    """
+    `PhotoDownloader` for an event loop: requests share one aiohttp connection pool, files are written and hashed
+    in a thread so a large photo never holds the loop. The session is created on first use, on the loop using it.
+    """
+    def __init__(self, max_concurrency: int = 16, per_call_concurrency: int = 4, retries: int = 3,
+                 backoff_factor: float = 0.5, timeout: float = 15.0):
+        self.max_concurrency = max_concurrency
+        self.per_call_concurrency = max(1, min(per_call_concurrency, max_concurrency))
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+            )
+        return self._session
+
+    async def _get(self, url: str) -> bytes:
+        for attempt in range(self.retries + 1):
+            try:
+                async with self.session.get(url) as res:
+                    if res.status < 400:
+                        return await res.read()
+                    if res.status not in RETRY_STATUSES or attempt == self.retries:
+                        raise DownloadError(url, f"{res.status} {res.reason}: {url[:50]}", res.status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    raise DownloadError(url, f"{type(e).__name__}: {e}") from e
+            await asyncio.sleep(self.backoff_factor * 2 ** attempt)
+
+    async def fetch(self, url: str, path: Path) -> DownloadResult:
+        start = time.perf_counter()
+        try:
+            body = await self._get(url)
+            sha256 = await asyncio.to_thread(_write_file, path, body)
+            metrics.download_seconds.labels(result='ok').observe(time.perf_counter() - start)
+            metrics.download_bytes.inc(len(body))
+            return DownloadResult(url, path, len(body), sha256)
+        except DownloadError:
+            metrics.download_seconds.labels(result='error').observe(time.perf_counter() - start)
+            raise
+        except Exception as e:
+            metrics.download_seconds.labels(result='error').observe(time.perf_counter() - start)
+            raise DownloadError(url, f"{type(e).__name__}: {e}") from e
+
+    async def download(self, jobs: Iterable[Tuple[str, Path]]) -> List[DownloadResult]:
+        """
+        Downloads every (url, path) pair, returns one result per job, failed jobs have `error` set.
+        """
+        slots = asyncio.Semaphore(self.per_call_concurrency)
+        async def fetch(url: str, path: Path) -> DownloadResult:
+            async with slots:
+                try:
+                    return await self.fetch(url, path)
+                except DownloadError as e:
+                    logger.debug(f"Download failed: {e}")
+                    return DownloadResult(url, path, error=e)
+        return list(await asyncio.gather(*(fetch(url, path) for url, path in jobs)))
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+        self._session = None
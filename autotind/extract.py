@@ -0,0 +1,74 @@
+from dataclasses import fields
+from typing import Any, List, Optional
+from loguru import logger
+from autotind.config import config
+from autotind.person import Person, Photo, pick_dict
+
+PERSON_KEYS = [ f.name for f in fields(Person) if f.name not in ('label', 'photos') ]
+PHOTO_KEYS = [ f.name for f in fields(Photo) if f.name not in ('user_id', 'width', 'height', 'original_url', 'sha256') ]
+
+
+def select_variant(photo: dict, min_size: Optional[int]) -> Optional[dict]:
+    """
+    Picks the smallest entry of `processedFiles` whose shorter side is at least `min_size` pixels.
+    Returns None when the original should be used: no `min_size`, or no variant large enough.
+    """
+    if not min_size:
+        return None
+    best = None
+    for variant in photo.get('processedFiles') or []:
+        try:
+            width, height, url = int(variant['width']), int(variant['height']), variant['url']
+        except (KeyError, TypeError, ValueError):
+            continue
+        if not url or min(width, height) < min_size:
+            continue
+        if best is None or width * height < best['width'] * best['height']:
+            best = { 'url': url, 'width': width, 'height': height }
+    return best
+
+
+def trim_photo(photo: dict, min_size: Optional[int], keep_original: bool) -> dict:
+    record = pick_dict(photo, PHOTO_KEYS)
+    variant = select_variant(photo, min_size)
+    if variant is not None:
+        if keep_original:
+            record['original_url'] = record.get('url')
+        record.update(variant)
+    return record
+
+
+def trim_person(user: Any, min_size: Optional[int] = None, keep_original: bool = False) -> Optional[dict]:
+    """
+    Keeps only the fields `Person.from_dict` and `Photo.from_dict` read, so workers are sent a record
+    of a few hundred bytes instead of the full user object with its spotify/instagram/teaser blobs.
+    Photo urls are swapped for the variant chosen by `select_variant`.
+    """
+    if not isinstance(user, dict) or not user.get('_id'):
+        return None
+    record = pick_dict(user, PERSON_KEYS)
+    record['photos'] = [ trim_photo(photo, min_size, keep_original) for photo in user.get('photos') or [] if isinstance(photo, dict) ]
+    return record
+
+
+def _extract(body: Any, list_key: str, person_key: str, kind: str) -> List[dict]:
+    if not isinstance(body, dict):
+        return []
+    items = (body.get('data') or {}).get(list_key) or []
+    min_size, keep_original = config.PHOTO_VARIANT_MIN_SIZE, config.PHOTO_KEEP_ORIGINAL
+    records = []
+    for item in items:
+        record = trim_person(item.get(person_key) if isinstance(item, dict) else None, min_size, keep_original)
+        if record is None:
+            logger.warning(f"No person data in {kind}: {str(item)[:200]}")
+            continue
+        records.append(record)
+    return records
+
+
+def extract_recs(body: Any) -> List[dict]:
+    return _extract(body, 'results', 'user', 'rec')
+
+
+def extract_matches(body: Any) -> List[dict]:
+    return _extract(body, 'matches', 'person', 'match')
@@ -1,25 +1,51 @@
 from abc import ABC, abstractmethod
-import io
+import re
 import json
+import time
+from collections import defaultdict
 from mitmproxy import http
-from typing import Any, List, Optional
+from typing import Any, Dict, List, Optional, Pattern, Tuple
+from autotind import metrics
+
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 def read_json_body(flow: http.HTTPFlow) -> Optional[dict]:
     try:
         data = flow.response.get_content()
         if not data:
             return None
-        json_dict = json.load(io.BytesIO(data))
-        return json_dict
+        return json_loads(data)
     except:
         return None
 
 class BaseInterceptor(ABC):
+    """
+    Interceptors declare the flows they handle with `method` and `path`, a regex searched in the request path.
+    Interceptors that leave either unset are matched by calling `accepts` on every flow instead, they must override it.
+    """
     type = 'response'
-    @abstractmethod
+    method: Optional[str] = None
+    path: Optional[str] = None
+    _route: Optional[Pattern] = None
+
+    @classmethod
+    def route(cls) -> Optional[Pattern]:
+        if cls.method is None or cls.path is None:
+            return None
+        if cls._route is None or cls._route.pattern != cls.path:
+            cls._route = re.compile(cls.path)
+        return cls._route
+
     def accepts(self, flow: http.HTTPFlow) -> bool:
-        return NotImplemented
-    
+        route = self.route()
+        if route is None:
+            return False
+        return flow.request.method == self.method and route.search(flow.request.path) is not None
+
     @abstractmethod
     def process(self, flow: http.HTTPFlow, body: Any) -> None:
         return NotImplemented
@@ -34,15 +60,47 @@ class BaseInterceptor(ABC):
             self.process(flow, body)
 
 class InterceptorMiddleware:
+    """
+    Routes are indexed by hook type and method once, a flow only runs the path regexes of its method.
+    The response body is parsed at most once per flow and only when an interceptor matched it.
+    """
     def __init__(self, interceptors: List[BaseInterceptor]):
         self.interceptors = interceptors
+        self.routes: Dict[str, Dict[str, List[Tuple[Pattern, BaseInterceptor]]]] = defaultdict(lambda: defaultdict(list))
+        self.fallbacks: Dict[str, List[BaseInterceptor]] = defaultdict(list)
+        for interceptor in interceptors:
+            route = interceptor.route()
+            if route is None:
+                self.fallbacks[interceptor.type].append(interceptor)
+            else:
+                self.routes[interceptor.type][interceptor.method].append((route, interceptor))
+
+    def match(self, type: str, flow: http.HTTPFlow) -> List[BaseInterceptor]:
+        path = flow.request.path
+        matched = [ i for route, i in self.routes[type].get(flow.request.method, ()) if route.search(path) ]
+        matched.extend(i for i in self.fallbacks[type] if i.accepts(flow))
+        return matched
+
+    @staticmethod
+    def _process(interceptor: BaseInterceptor, flow: http.HTTPFlow, body: Any):
+        name = type(interceptor).__name__
+        start = time.perf_counter()
+        try:
+            interceptor.process(flow, body)
+        except Exception:
+            metrics.interceptor_errors.labels(interceptor=name).inc()
+            raise
+        finally:
+            metrics.interceptor_seconds.labels(interceptor=name).observe(time.perf_counter() - start)
 
     def request(self, flow: http.HTTPFlow):
-        interceptors = [i for i in self.interceptors if i.type == 'request']
-        for interceptor in interceptors:
-            interceptor(flow)
-    
+        for interceptor in self.match('request', flow):
+            self._process(interceptor, flow, None)
+
     def response(self, flow: http.HTTPFlow):
-        interceptors = [i for i in self.interceptors if i.type == 'response']
+        interceptors = self.match('response', flow)
+        if not interceptors:
+            return
+        body = read_json_body(flow)
         for interceptor in interceptors:
-            interceptor(flow)
\ No newline at end of file
+            self._process(interceptor, flow, body)
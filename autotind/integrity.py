@@ -0,0 +1,111 @@
+import argparse
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Optional, Union
+from loguru import logger
+from PIL import Image
+from sqlalchemy import or_
+from autotind.config import config
+from autotind.db import BlobDB, PersonRepo
+from autotind.store import hash_file
+
+
+def verify_image(path: Union[str, Path]) -> bool:
+    try:
+        with Image.open(path) as img:
+            img.verify()
+        return True
+    except Exception:
+        return False
+
+
+class PhotoVerifier(threading.Thread):
+    """
+    Lazily checks stored blobs in the background: new blobs and blobs not checked for `recheck_after`.
+    Blobs that are missing, whose bytes no longer match their hash or that don't decode are deleted along with
+    their references, so the next sighting of the person downloads them again.
+
+    Blobs are visited in hash order from an in-memory cursor: with a single writer the results of a batch are
+    only written later, the cursor keeps the next batch from checking the same blobs again. A pass ends with
+    a batch that isn't full, the next one starts over.
+    """
+    def __init__(self, repo: PersonRepo, interval: float = 60, batch_size: int = 200, recheck_after: timedelta = timedelta(days=7)):
+        super().__init__(name='photo-verifier', daemon=True)
+        self.repo = repo
+        self.interval = interval
+        self.batch_size = batch_size
+        self.recheck_after = recheck_after
+        self._stop_event = threading.Event()
+        self._after: Optional[str] = None
+
+    def run(self):
+        while not self._stop_event.is_set():
+            try:
+                checked = self.verify_batch()
+            except Exception as e:
+                logger.error(f"Photo verifier: {e}")
+                checked = 0
+            # Keep going while there is a backlog, otherwise wait for new blobs
+            if checked < self.batch_size:
+                self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _check(self, blob: BlobDB) -> bool:
+        path = self.repo.store.path(blob.sha256)
+        if not path.exists():
+            return False
+        if blob.validated and path.stat().st_size == blob.size:
+            return True
+        if hash_file(path) != blob.sha256:
+            logger.info(f"Blob changed on disk: {path}")
+            return False
+        return verify_image(path)
+
+    def verify_batch(self) -> int:
+        session = self.repo.Session()
+        try:
+            stale = datetime.utcnow() - self.recheck_after
+            query = session.query(BlobDB).filter(or_(BlobDB.validated.is_(None), BlobDB.checked_at < stale))
+            if self._after is not None:
+                query = query.filter(BlobDB.sha256 > self._after)
+            blobs = query.order_by(BlobDB.sha256).limit(self.batch_size).all()
+            session.expunge_all()
+        finally:
+            session.close()
+        self._after = blobs[-1].sha256 if len(blobs) == self.batch_size else None
+
+        checked, invalid = [], []
+        now = datetime.utcnow()
+        for blob in blobs:
+            if self._check(blob):
+                checked.append({ 'sha256': blob.sha256, 'validated': True, 'checked_at': now })
+            else:
+                logger.info(f"Dropping invalid blob: {blob.sha256}")
+                invalid.append(blob.sha256)
+
+        if checked:
+            self.repo.record_blob_checks(checked)
+        if invalid:
+            self.repo.forget_blobs(invalid)
+        return len(blobs)
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Photo store maintenance")
+    arg_parser.add_argument('command', choices=['verify', 'gc'])
+    arg_parser.add_argument('--db-url', default=config.DB_URL)
+    arg_parser.add_argument('--min-age-hours', type=float, default=1.0, help="gc: leave blobs younger than this alone")
+    args = arg_parser.parse_args()
+
+    repo = PersonRepo(args.db_url)
+    if args.command == 'verify':
+        verifier = PhotoVerifier(repo)
+        total = 0
+        while (checked := verifier.verify_batch()):
+            total += checked
+        logger.info(f"Verified {total} blobs")
+    elif args.command == 'gc':
+        logger.info(f"Garbage collected: {repo.collect_garbage(timedelta(hours=args.min_age_hours))}")
@@ -0,0 +1,301 @@
+"""
+Counters and latency histograms for the ingest pipeline, recorded with prometheus_client.
+
+prometheus_client picks its multiprocess mode when it is first imported: with `PROMETHEUS_MULTIPROC_DIR` set by then
+(server.py does so), every process writes its values to its own files in that directory and `MetricsServer` sums them
+at scrape time. The stack profiler hands its samples over through the same directory:
+
+    curl localhost:9108/metrics
+    curl -X POST localhost:9108/profile/start; sleep 30; curl -X POST localhost:9108/profile/stop
+    curl localhost:9108/profile > stacks.folded
+"""
+import os
+import sys
+import time
+import threading
+import multiprocessing as mp
+from abc import ABC, abstractmethod
+from collections import Counter as StackCounter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Dict, List, Optional
+from loguru import logger
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, generate_latest
+from prometheus_client import multiprocess
+from autotind.config import config
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def multiprocess_dir() -> Optional[Path]:
+    path = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    return Path(path) if path else None
+
+
+def total(metric) -> float:
+    """
+    The value of a counter summed over its labels, as recorded by this process.
+    """
+    return sum((sample.value for family in metric.collect() for sample in family.samples if sample.name.endswith('_total')), 0.0)
+
+
+def mark_process_dead(pid: int):
+    """
+    Drops the gauges of a worker that exited, its counters and histograms stay counted.
+    """
+    if multiprocess_dir() is not None:
+        multiprocess.mark_process_dead(pid)
+
+
+class StackSampler:
+    """
+    While running, samples the stack of every other thread in this process every `interval` seconds.
+    Stacks are counted in the folded format flame graph tools read, outermost frame first.
+    """
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.stacks: StackCounter = StackCounter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        with self._lock:
+            self.stacks.clear()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='stack-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self._stop.set()
+        self._thread.join()
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.stacks)
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            sampled = []
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}")
+                    frame = frame.f_back
+                sampled.append(';'.join(reversed(stack)))
+            with self._lock:
+                self.stacks.update(sampled)
+
+
+class BaseProfiler(ABC):
+    def __init__(self, sample_interval_ms: float = 10):
+        self.sampler = StackSampler(sample_interval_ms / 1000)
+
+    @abstractmethod
+    def set_profiling(self, enabled: bool) -> None:
+        return NotImplemented
+
+    @abstractmethod
+    def stacks(self) -> List[str]:
+        """
+        Folded stacks of every profiled process, each prefixed with its process name.
+        """
+        return NotImplemented
+
+    def start(self):
+        """
+        Called by each worker process once it is running.
+        """
+
+    def publish(self):
+        """
+        Hands this process' samples over to the process serving them.
+        """
+
+    def _folded(self) -> List[str]:
+        process = mp.current_process().name
+        return [ f"{process};{stack} {count}" for stack, count in self.sampler.snapshot().items() ]
+
+
+class Profiler(BaseProfiler):
+    """
+    Profiles this process only, without a multiprocess directory workers are not sampled.
+    """
+    def set_profiling(self, enabled: bool):
+        if enabled:
+            self.sampler.start()
+        else:
+            self.sampler.stop()
+
+    def stacks(self) -> List[str]:
+        return self._folded()
+
+
+class SharedProfiler(BaseProfiler):
+    """
+    Switches the stack sampler of every process on or off through a flag file in `path`. Each process polls the flag
+    every second and writes its samples to `stacks-<pid>.folded` every `write_interval` seconds and once it stops.
+    """
+    FLAG = 'profiling'
+
+    def __init__(self, path: Path, sample_interval_ms: float = 10, write_interval: float = 5.0):
+        super().__init__(sample_interval_ms)
+        self.path = path
+        self.write_interval = write_interval
+        self._pid: Optional[int] = None
+
+    def start(self):
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        # The sampler thread of the parent did not survive the fork, its samples are the parent's to report
+        self.sampler = StackSampler(self.sampler.interval)
+        threading.Thread(target=self._run, name='profiler', daemon=True).start()
+
+    def _run(self):
+        since_write = 0.0
+        while True:
+            poll = min(1.0, self.write_interval)
+            time.sleep(poll)
+            since_write += poll
+            enabled = (self.path / self.FLAG).exists()
+            if enabled and not self.sampler.running:
+                self.sampler.start()
+            elif not enabled and self.sampler.running:
+                self.sampler.stop()
+                # Hand over the samples right away instead of on the next write
+                self.publish()
+            if self.sampler.running and since_write >= self.write_interval:
+                self.publish()
+                since_write = 0.0
+
+    def publish(self):
+        if self._pid != os.getpid():
+            return
+        target = self.path / f"stacks-{os.getpid()}.folded"
+        tmp = target.with_suffix('.tmp')
+        try:
+            tmp.write_text('\n'.join(self._folded()))
+            tmp.replace(target)
+        except OSError as e:
+            logger.debug(f"Could not write stack samples: {e}")
+
+    def set_profiling(self, enabled: bool):
+        flag = self.path / self.FLAG
+        if enabled:
+            for stale in self.path.glob('stacks-*.folded'):
+                stale.unlink(missing_ok=True)
+            flag.touch()
+            self.sampler.start()
+        else:
+            flag.unlink(missing_ok=True)
+            self.sampler.stop()
+
+    def stacks(self) -> List[str]:
+        lines = self._folded()
+        for path in self.path.glob('stacks-*.folded'):
+            if path.name != f"stacks-{os.getpid()}.folded":
+                lines.extend(line for line in path.read_text().splitlines() if line)
+        return lines
+
+
+def make_profiler(sample_interval_ms: float = 10, write_interval: float = 5.0) -> BaseProfiler:
+    path = multiprocess_dir()
+    if path is None:
+        return Profiler(sample_interval_ms)
+    return SharedProfiler(path, sample_interval_ms, write_interval)
+
+
+class MetricsServer:
+    """
+    Serves the metrics of every process recording into the multiprocess directory, or of this process without one:
+
+    - `GET /metrics`: Prometheus text format
+    - `POST /profile/start`, `POST /profile/stop`: switch the stack sampler on or off in every process
+    - `GET /profile`: the sampled stacks in folded format, each prefixed with its process name
+    """
+    def __init__(self, profiler: BaseProfiler, host: str = '127.0.0.1', port: int = 9108):
+        self.profiler = profiler
+        if multiprocess_dir() is not None:
+            self.registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(self.registry)
+        else:
+            self.registry = REGISTRY
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+
+    def render_profile(self) -> str:
+        return '\n'.join(self.profiler.stacks()) + '\n'
+
+    def _handler(self):
+        metrics_server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _send(self, status: int, body: bytes, content_type: str = 'text/plain; charset=utf-8'):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path == '/metrics':
+                    self._send(200, generate_latest(metrics_server.registry), CONTENT_TYPE_LATEST)
+                elif self.path == '/profile':
+                    self._send(200, metrics_server.render_profile().encode())
+                else:
+                    self._send(404, b"Not found\n")
+
+            def do_POST(self):
+                if self.path in ('/profile/start', '/profile/stop'):
+                    enabled = self.path.endswith('start')
+                    metrics_server.profiler.set_profiling(enabled)
+                    logger.info(f"Profiler {'started' if enabled else 'stopped'}")
+                    self._send(200, b"ok\n")
+                else:
+                    self._send(404, b"Not found\n")
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "MetricsServer":
+        threading.Thread(target=self.server.serve_forever, name='metrics-server', daemon=True).start()
+        host, port = self.server.server_address[:2]
+        logger.info(f"Serving metrics on http://{host}:{port}/metrics")
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+profiler = make_profiler(config.PROFILER_INTERVAL_MS, config.METRICS_PUSH_INTERVAL)
+
+interceptor_seconds = Histogram('autotind_interceptor_seconds', "Time spent handling a flow in an interceptor, on mitmproxy's event loop", ('interceptor',), buckets=DEFAULT_BUCKETS)
+interceptor_errors = Counter('autotind_interceptor_errors', "Flows an interceptor raised on", ('interceptor',))
+tasks_enqueued = Counter('autotind_tasks_enqueued', "Task payloads put on the processor queue", ('task',))
+task_queue_wait_seconds = Histogram('autotind_task_queue_wait_seconds', "Time a task payload spent in the processor queue", ('task',), buckets=DEFAULT_BUCKETS)
+task_seconds = Histogram('autotind_task_seconds', "Handler duration, one observation per handler call", ('task',), buckets=DEFAULT_BUCKETS)
+task_errors = Counter('autotind_task_errors', "Handler calls that raised", ('task',))
+tasks_spilled = Counter('autotind_tasks_spilled', "Low priority task payloads written to disk above the high-water mark", ('task',))
+tasks_shed = Counter('autotind_tasks_shed', "Low priority task payloads dropped above the high-water mark", ('task',))
+# Set by the process owning the processor, summed over the live processes
+queue_depth = Gauge('autotind_queue_depth', "Messages waiting in a stage's queue", ('stage',), multiprocess_mode='livesum')
+spilled_messages = Gauge('autotind_spilled_messages', "Messages of a stage waiting on disk", ('stage',), multiprocess_mode='livesum')
+stage_workers = Gauge('autotind_stage_workers', "Live workers of a stage", ('stage',), multiprocess_mode='livesum')
+db_commit_seconds = Histogram('autotind_db_commit_seconds', "Duration of database commits", ('op',), buckets=DEFAULT_BUCKETS)
+download_seconds = Histogram('autotind_download_seconds', "Photo download duration", ('result',), buckets=DEFAULT_BUCKETS)
+download_bytes = Counter('autotind_download_bytes', "Bytes of photos downloaded")
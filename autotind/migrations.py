@@ -0,0 +1,43 @@
+from loguru import logger
+from sqlalchemy import MetaData, inspect
+from sqlalchemy.engine import Engine
+
+
+def add_missing_columns(engine: Engine, metadata: MetaData):
+    """
+    `create_all` never alters existing tables, add any nullable column the models gained since the table was created.
+    """
+    inspector = inspect(engine)
+    existing_tables = set(inspector.get_table_names())
+    with engine.begin() as conn:
+        for table in metadata.sorted_tables:
+            if table.name not in existing_tables:
+                continue
+            existing = { c['name'] for c in inspector.get_columns(table.name) }
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if not column.nullable:
+                    raise RuntimeError(f"Cannot add non-nullable column {table.name}.{column.name} to an existing table")
+                col_type = column.type.compile(dialect=engine.dialect)
+                logger.info(f"Migrating: adding column {table.name}.{column.name} {col_type}")
+                conn.exec_driver_sql(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {col_type}')
+
+
+def create_missing_indexes(engine: Engine, metadata: MetaData):
+    """
+    `create_all` only creates indexes together with their table, create the ones added to existing tables.
+    """
+    inspector = inspect(engine)
+    for table in metadata.sorted_tables:
+        existing = { index['name'] for index in inspector.get_indexes(table.name) }
+        for index in table.indexes:
+            if index.name not in existing:
+                logger.info(f"Migrating: creating index {index.name} on {table.name}")
+                index.create(bind=engine)
+
+
+def upgrade(engine: Engine, metadata: MetaData):
+    metadata.create_all(engine)
+    add_missing_columns(engine, metadata)
+    create_missing_indexes(engine, metadata)
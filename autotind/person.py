@@ -1,9 +1,12 @@
+import json
+import hashlib
 from dataclasses import dataclass, fields, asdict
 from datetime import date
 from enum import Enum
 from pathlib import Path
 from typing import Any, List, Optional, Tuple, Union
 from loguru import logger
+from autotind.store import blob_path
 
 
 class Label(Enum):
@@ -31,6 +34,10 @@ class Photo:
     rank: int = -1
     score: float = -1
     win_count: int = -1
+    width: Optional[int] = None
+    height: Optional[int] = None
+    original_url: Optional[str] = None
+    sha256: Optional[str] = None
 
     def __repr__(self) -> str:
         return f"<Photo(id={self.id} url='{self.url[:40]}' fileName={self.fileName})>"
@@ -38,8 +45,29 @@ class Photo:
     def to_dict(self) -> dict:
         return asdict(self)
 
+    @staticmethod
+    def key_for(user_id: str, fileName: str, width: Optional[int] = None, height: Optional[int] = None) -> str:
+        # Resized variants are keyed next to the original under a size prefix
+        if width and height:
+            return f"{user_id}/{width}x{height}_{fileName}"
+        return f"{user_id}/{fileName}"
+
+    def get_key(self) -> str:
+        return Photo.key_for(self.user_id, self.fileName, self.width, self.height)
+
+    def get_original_key(self) -> str:
+        return f"{self.user_id}/{self.fileName}"
+
     def get_path(self, root_dir: Union[str, Path]) -> Path:
-        return Path(root_dir) / Path(self.user_id) / Path(self.fileName)
+        if self.sha256:
+            return blob_path(root_dir, self.sha256)
+        return Path(root_dir) / self.get_key()
+
+    def downloads(self) -> List[Tuple[str, str]]:
+        jobs = [ (self.url, self.get_key()) ]
+        if self.original_url and self.original_url != self.url:
+            jobs.append((self.original_url, self.get_original_key()))
+        return jobs
 
     @staticmethod
     def from_dict(photo_data: dict) -> Optional['Photo']:
@@ -74,6 +102,16 @@ class Person:
     def get_path(self, root_dir: Union[str, Path]) -> Path:
         return Path(root_dir) / Path(self._id)
 
+    def fingerprint(self) -> str:
+        """
+        Stable hash of the profile as intercepted, fields filled in from the database are left out.
+        """
+        data = self.to_dict()
+        for photo in data['photos']:
+            photo.pop('sha256', None)
+        encoded = json.dumps(data, sort_keys=True, separators=(',', ':'), default=str)
+        return hashlib.blake2b(encoded.encode(), digest_size=16).hexdigest()
+
     @staticmethod
     def from_dict(person_data: dict) -> Optional['Person']:
         data = {}
@@ -1,79 +1,566 @@
+import os
+import time
+import pickle
 import signal
+import threading
 import multiprocessing as mp
+from abc import ABC, abstractmethod
 from loguru import logger
+from pathlib import Path
 from queue import Empty
-from typing import Any, Callable, Dict
+from itertools import groupby
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Union
+from autotind import metrics
+
+MAIN_STAGE = 'main'
+
+Message = Tuple[str, Any, bool, float]
+
+def group_tasks(tasks: List[Message]) -> Iterator[Tuple[str, List[Any]]]:
+    """
+    Merges consecutive messages of the same type into one list of payloads, order across types is kept.
+    """
+    now = time.time()
+    for workname, group in groupby(tasks, key=lambda task: task[0]):
+        payloads = []
+        queue_wait = metrics.task_queue_wait_seconds.labels(task=workname)
+        for _, data, is_batch, queued_at in group:
+            if is_batch:
+                payloads.extend(data)
+            else:
+                payloads.append(data)
+            wait = max(0.0, now - queued_at)
+            for _ in range(len(data) if is_batch else 1):
+                queue_wait.observe(wait)
+        yield workname, payloads
 
 class Worker(mp.Process):
-    def __init__(self, id: str, processor: "Processor"):
-        super().__init__()
+    def __init__(self, id: int, processor: "Processor", stage: "Stage"):
+        super().__init__(name=f"{stage.name}-{id}")
         self.id = id
-        self.task_queue = processor.queue
+        self.task_queue = stage.queue
         self.processor = processor
+        self.stage = stage
+        # Set while the worker takes tasks, cleared while it is parked
+        self.active = mp.Value('b', 0, lock=False)
 
     def run(self):
         self.started = True
-        logger.debug(f"Worker {self.id} started")
+        logger.debug(f"Worker {self.name} started")
+        metrics.profiler.start()
 
         def signal_handler(sig, frame):
-            logger.warning(f"Worker {self.id} received signal {signal.strsignal(sig)}")
-            self.task_queue.put(None)
+            # The processor stops the stages in order, a stage stopping on its own could leave the stage feeding it blocked on a full queue
+            logger.warning(f"Worker {self.name} received signal {signal.strsignal(sig)}, waiting for the processor to stop it")
 
         signal.signal(signal.SIGINT, signal_handler)
 
+        stopping = False
+        while not stopping:
+            # Parked until the stage needs another worker, or is stopped
+            self.stage.wake.acquire()
+            self.active.value = 1
+            stopping = self._work()
+            self.active.value = 0
+        self.stage.retire(force=True)
+        logger.warning(f"Worker {self.name} stopped")
+        self._shutdown()
+
+    def _work(self) -> bool:
+        """
+        Handles tasks until it takes a shutdown sentinel (returns True) or has been idle long enough to park.
+        """
+        idle_since = time.monotonic()
         while True:
             try:
-                next_task = self.task_queue.get(timeout=1)
+                task = self.task_queue.get(timeout=1)
             except Empty:
+                if self.stage.idle_timeout and time.monotonic() - idle_since >= self.stage.idle_timeout and self.stage.retire():
+                    logger.debug(f"Worker {self.name} idle for {self.stage.idle_timeout}s, parking")
+                    return False
                 continue
-            if next_task is None:
-                logger.warning(f"Worker {self.id}/{len(self.processor.workers)} stopped")
-                # self.task_queue.task_done()
-                break
-            workname, data = next_task
-            self._dispatch(workname, data)
-            # self.task_queue.task_done()
-        return
+            tasks = []
+            # Drain whatever else is already queued so one wakeup handles many tasks, stopping at
+            # a shutdown sentinel so the sentinels meant for other workers stay in the queue
+            while task is not None:
+                tasks.append(task)
+                if len(tasks) >= self.stage.max_batch:
+                    break
+                try:
+                    task = self.task_queue.get_nowait()
+                except Empty:
+                    break
+            self.stage.taken(len(tasks))
+            start = time.perf_counter()
+            self._dispatch_many(tasks)
+            self.stage.handled(len(tasks), time.perf_counter() - start)
+            if task is None:
+                return True
+            idle_since = time.monotonic()
 
-    def _dispatch(self, workname: str, data: Any):
-        if workname in self.processor.handlers:
+    def _shutdown(self):
+        for hook in self.processor.shutdown_hooks:
             try:
-                self.processor.handlers[workname](data)
+                hook()
             except Exception as e:
-                logger.error(f"{workname}: {e}")
+                logger.error(f"Shutdown hook {hook.__name__}: {e}")
+        metrics.profiler.publish()
+
+    def _dispatch_many(self, tasks: List[Message]):
+        for workname, payloads in group_tasks(tasks):
+            self._dispatch(workname, payloads)
+
+    def _call(self, workname: str, handler: Callable[[Any], None], data: Any):
+        start = time.perf_counter()
+        try:
+            handler(data)
+        except Exception as e:
+            metrics.task_errors.labels(task=workname).inc()
+            logger.error(f"{workname}: {e}")
+        finally:
+            metrics.task_seconds.labels(task=workname).observe(time.perf_counter() - start)
+
+    def _dispatch(self, workname: str, payloads: List[Any]):
+        if workname in self.processor.batch_handlers:
+            self._call(workname, self.processor.batch_handlers[workname], payloads)
+        elif workname in self.processor.handlers:
+            for data in payloads:
+                self._call(workname, self.processor.handlers[workname], data)
         else:
             logger.error(f"No handler function for task `{workname}`")
 
-class Processor:
+class SpillFile:
+    """
+    Messages pickled one after the other in an append-only file and read back in order, the file is truncated
+    once everything in it has been read. The file is read again from the start on the next start, messages already
+    read back since it was last truncated are queued twice, which the upserts they carry tolerate.
+    """
+    def __init__(self, path: Union[str, Path], max_bytes: int):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._file = open(self.path, 'a+b')
+        self._read_offset = 0
+        self._lock = threading.Lock()
+        self.count = 0
+        self._file.seek(0)
+        while True:
+            good = self._file.tell()
+            try:
+                pickle.load(self._file)
+                self.count += 1
+            except EOFError:
+                break
+            except Exception as e:
+                # A write torn by a crash, appends after it could never be read back
+                logger.error(f"Dropping the unreadable end of {self.path}: {e}")
+                self._file.truncate(good)
+                break
+
+    def __len__(self) -> int:
+        return self.count
+
+    def append(self, message: Any) -> bool:
+        """
+        Returns False without writing anything once the file has reached `max_bytes`.
+        """
+        with self._lock:
+            self._file.seek(0, os.SEEK_END)
+            if self._file.tell() >= self.max_bytes:
+                return False
+            pickle.dump(message, self._file, protocol=pickle.HIGHEST_PROTOCOL)
+            self._file.flush()
+            self.count += 1
+            return True
+
+    def pop(self, n: int) -> List[Any]:
+        messages = []
+        with self._lock:
+            self._file.seek(self._read_offset)
+            while len(messages) < min(n, self.count):
+                messages.append(pickle.load(self._file))
+            self._read_offset = self._file.tell()
+            self.count -= len(messages)
+            if self.count == 0:
+                self._file.truncate(0)
+                self._read_offset = 0
+        return messages
+
+class BaseStage(ABC):
+    """
+    A queue of messages for the handlers of one stage. `high_water` counts messages, a batch added with
+    `add_work_batch` is one message. Past `high_water` queued messages, low priority work is written to `spill_dir`
+    and queued again once the queue is back under half the mark, or dropped if there's no spill directory or it is full.
+    """
+    def __init__(self, name: str, max_batch: int, high_water: int = 0, spill_dir: Optional[Union[str, Path]] = None, spill_max_mb: int = 512):
+        self.name = name
+        self.max_batch = max_batch
+        self.high_water = high_water
+        self.spill = SpillFile(Path(spill_dir) / f"{name}.spill", spill_max_mb * 2**20) if high_water and spill_dir else None
+        self.shedding = False
+
+    @abstractmethod
+    def queued(self) -> int:
+        return NotImplemented
+
+    @abstractmethod
+    def put(self, message: Message) -> None:
+        return NotImplemented
+
+    def pending(self) -> int:
+        return self.queued() + (len(self.spill) if self.spill is not None else 0)
+
+    def overloaded(self) -> bool:
+        # Once anything is spilled, later low priority work goes after it to keep it in order
+        return self.queued() >= self.high_water or (self.spill is not None and len(self.spill) > 0)
+
+    def admit(self, message: Message, items: int) -> bool:
+        """
+        Queues low priority work unless the stage is past its high-water mark, in which case it is spilled or dropped.
+        """
+        workname = message[0]
+        if not self.high_water or not self.overloaded():
+            self.put(message)
+            return True
+        if not self.shedding:
+            self.shedding = True
+            logger.warning(f"Stage {self.name} is past its high-water mark ({self.queued()} queued), {'spilling' if self.spill is not None else 'dropping'} low priority work")
+        if self.spill is not None and self.spill.append(message):
+            metrics.tasks_spilled.labels(task=workname).inc(items)
+            return True
+        metrics.tasks_shed.labels(task=workname).inc(items)
+        return False
+
+    def replay_spill(self):
+        if self.spill is not None and len(self.spill) and self.queued() < self.high_water // 2:
+            for message in self.spill.pop(self.high_water // 2 - self.queued()):
+                self.put(message)
+        if self.shedding and not self.overloaded():
+            self.shedding = False
+            logger.info(f"Stage {self.name} is back under its high-water mark")
+        metrics.queue_depth.labels(stage=self.name).set(self.queued())
+        if self.spill is not None:
+            metrics.spilled_messages.labels(stage=self.name).set(len(self.spill))
+
+class Stage(BaseStage):
+    """
+    A queue and the pool of worker processes that drain it. With `max_queue`, putting work on a full queue blocks,
+    so a stage that falls behind holds back the stage feeding it instead of buffering without limit.
+
+    The pool runs between `min_workers` and `max_workers`: the processor wakes a worker while the queued work would take
+    its workers longer than `target_backlog` seconds, a worker that found nothing to do for `idle_timeout` seconds parks.
+    All `max_workers` processes are forked by `Processor.start`, before the parent runs threads of its own: forking later,
+    from the scaler, could hand a child a lock some other thread of the parent was holding.
+    """
+    def __init__(self, processor: "Processor", name: str, min_workers: int, max_workers: int, max_batch: int, max_queue: int = 0,
+                 idle_timeout: float = 0, high_water: int = 0, spill_dir: Optional[Union[str, Path]] = None, spill_max_mb: int = 512):
+        super().__init__(name, max_batch, high_water, spill_dir, spill_max_mb)
+        self.processor = processor
+        self.min_workers = min_workers
+        self.max_workers = max(min_workers, max_workers)
+        self.idle_timeout = idle_timeout
+        self.queue = mp.Queue(max_queue)
+        self.depth = mp.Value('l', 0)
+        # Workers taking tasks, the others are parked on `wake`
+        self.live = mp.Value('l', 0)
+        self.wake = mp.Semaphore(0)
+        # Messages handled and seconds spent handling them, across all workers
+        self.work = mp.Array('d', 2)
+        self.latency = 0.0
+        self.workers: List[Worker] = []
+        self._next_id = 1
+        self._last_work = (0.0, 0.0)
+
+    def queued(self) -> int:
+        return self.depth.value
+
+    def put(self, message: Message):
+        with self.depth.get_lock():
+            self.depth.value += 1
+        self.queue.put(message)
+
+    def taken(self, n: int):
+        with self.depth.get_lock():
+            self.depth.value -= n
+
+    def handled(self, n: int, seconds: float):
+        with self.work.get_lock():
+            self.work[0] += n
+            self.work[1] += seconds
+
+    def spawn(self) -> Worker:
+        """
+        Forks a parked worker, only while the processor starts.
+        """
+        w = Worker(self._next_id, self.processor, self)
+        w.daemon = True
+        self._next_id += 1
+        self.workers.append(w)
+        w.start()
+        return w
+
+    def activate(self, n: int = 1) -> int:
+        """
+        Wakes up to `n` parked workers, returns how many there were to wake.
+        """
+        with self.live.get_lock():
+            n = max(0, min(n, len(self.alive()) - self.live.value))
+            self.live.value += n
+        for _ in range(n):
+            self.wake.release()
+        return n
+
+    def retire(self, force: bool = False) -> bool:
+        """
+        Called by a worker that is about to park or stop, an idle one may only park while more than `min_workers` are live.
+        """
+        with self.live.get_lock():
+            if not force and self.live.value <= self.min_workers:
+                return False
+            self.live.value -= 1
+            return True
+
+    def alive(self) -> List[Worker]:
+        return [ w for w in self.workers if w.is_alive() ]
+
+    def scale(self, target_backlog: float):
+        alive = self.alive()
+        for w in self.workers:
+            if not w.is_alive():
+                logger.error(f"Worker {w.name} exited with code {w.exitcode}, {len(alive)} workers left on stage {self.name}")
+                metrics.mark_process_dead(w.pid)
+                if w.active.value:
+                    # Crashed while taking tasks, it never retired
+                    with self.live.get_lock():
+                        self.live.value -= 1
+        self.workers = alive
+
+        with self.work.get_lock():
+            work = (self.work[0], self.work[1])
+        if work[0] > self._last_work[0]:
+            self.latency = (work[1] - self._last_work[1]) / (work[0] - self._last_work[0])
+        self._last_work = work
+
+        self.replay_spill()
+        # Spilled work is part of the backlog, more workers bring it back sooner
+        pending, n_workers = self.pending(), self.live.value
+        metrics.stage_workers.labels(stage=self.name).set(n_workers)
+        if n_workers < self.min_workers:
+            self.activate(self.min_workers - n_workers)
+        elif pending and n_workers < len(alive):
+            backlog = pending * self.latency / max(1, n_workers)
+            # Without a latency measured yet, only queued work every worker could already be busy with counts
+            if (backlog > target_backlog or (not self.latency and pending > n_workers)) and self.activate():
+                logger.info(f"Stage {self.name} scaled up to {n_workers + 1} workers, {pending} messages pending, {self.latency * 1000:.0f}ms per message")
+
+    def stop(self):
+        alive = self.alive()
+        if not alive and self.depth.value:
+            logger.error(f"No workers left on stage {self.name}, {self.depth.value} messages are lost")
+        for _ in alive:
+            self.queue.put(None)
+        # Parked workers take their sentinel too, the extra wakeups are never waited on
+        for _ in alive:
+            self.wake.release()
+        for w in alive:
+            w.join()
+            metrics.mark_process_dead(w.pid)
+        if self.spill is not None and len(self.spill):
+            logger.info(f"{len(self.spill)} messages stay spilled in {self.spill.path} until the next start")
+
+class BaseProcessor(ABC):
+    """
+    Handler registration shared by the processor backends. Handlers run in the `main` stage unless they are registered
+    on a stage created with `add_stage`, e.g. a large pool for network-bound work that handlers of a small DB-bound
+    pool hand their results to.
+    """
+    # Backends that run handlers on an event loop also accept coroutine functions as handlers
+    is_async = False
     handlers: Dict[str, Callable[[dict], None]]
-    def __init__(self, num_workers: int = 4):
-        self.queue = mp.Queue()
-        self.workers: list["Worker"] = []
+    batch_handlers: Dict[str, Callable[[List[Any]], None]]
+    shutdown_hooks: List[Callable[[], None]]
+    stop_hooks: List[Callable[[], None]]
+    def __init__(self, max_batch: int = 64):
+        self.max_batch = max_batch
+        self.stages: Dict[str, BaseStage] = {}
+        self.routes: Dict[str, BaseStage] = {}
+        self.low_priority: Set[str] = set()
         self.handlers = {}
+        self.batch_handlers = {}
+        self.shutdown_hooks = []
+        self.stop_hooks = []
+        self.started = False
+        self._stopping = threading.Event()
+
+    @abstractmethod
+    def add_stage(self, name: str, num_workers: int, **kwargs) -> BaseStage:
+        return NotImplemented
 
-        for i in range(num_workers):
-            w = Worker(i+1, self)
-            w.daemon = True
-            self.workers.append(w)
+    def _route(self, workname: str, stage: str, low_priority: bool = False):
+        if stage not in self.stages:
+            raise ValueError(f"Unknown stage `{stage}`")
+        self.routes[workname] = self.stages[stage]
+        if low_priority:
+            self.low_priority.add(workname)
+
+    @abstractmethod
+    def _put(self, message: Message, items: int) -> None:
+        return NotImplemented
 
     def add_work(self, workname: str, data: Any = None):
-        self.queue.put((workname, data))
+        self._put((workname, data, False, time.time()), 1)
+
+    def add_work_batch(self, workname: str, items: Iterable[Any]):
+        """
+        Enqueues all items as a single message, they are pickled and sent through the queue once.
+        """
+        items = list(items)
+        if items:
+            self._put((workname, items, True, time.time()), len(items))
 
-    def handler(self, workname: str):
+    def handler(self, workname: str, stage: str = MAIN_STAGE, low_priority: bool = False):
+        """
+        Low priority work is the first to be spilled or dropped once its stage is past the high-water mark.
+        """
         def decorator(func):
+            self._route(workname, stage, low_priority)
             self.handlers[workname] = func
             return func
         return decorator
 
-    def register_handlers(self, handlers: Dict[str, Callable[[dict], None]]):
+    def batch_handler(self, workname: str, stage: str = MAIN_STAGE, low_priority: bool = False):
+        """
+        Registers a handler that receives a list of payloads, every task of that type drained
+        in one wakeup is passed in a single call.
+        """
+        def decorator(func):
+            self._route(workname, stage, low_priority)
+            self.batch_handlers[workname] = func
+            return func
+        return decorator
+
+    def on_shutdown(self, func: Callable[[], None]):
+        """
+        Registers a hook every worker runs as it stops.
+        """
+        self.shutdown_hooks.append(func)
+        return func
+
+    def after_stop(self, func: Callable[[], None]):
+        """
+        Registers a hook `stop` runs in the process owning the processor, once every stage has stopped.
+        """
+        self.stop_hooks.append(func)
+        return func
+
+    def _run_stop_hooks(self):
+        for hook in self.stop_hooks:
+            try:
+                hook()
+            except Exception as e:
+                logger.error(f"Stop hook {hook.__name__}: {e}")
+
+    def register_handlers(self, handlers: Dict[str, Callable[[dict], None]], stage: str = MAIN_STAGE):
+        for workname in handlers:
+            self._route(workname, stage)
         self.handlers.update(handlers)
 
+    def pending(self) -> Dict[str, int]:
+        """
+        Messages queued or spilled per stage, messages being handled are not counted.
+        """
+        return { name: stage.pending() for name, stage in self.stages.items() }
+
+    @abstractmethod
+    def start(self) -> None:
+        return NotImplemented
+
+    @abstractmethod
+    def stop(self) -> None:
+        """
+        Stops the stages in the order they were added, each one after the stages feeding it have drained, then runs
+        the `after_stop` hooks.
+        """
+        return NotImplemented
+
     def run(self):
-        for w in self.workers:
-            w.start()
-        for w in self.workers:
-            try:
-                w.join()
-            except KeyboardInterrupt:
-                logger.warning("Stopping workers, tasks remaining in queue: ", self.queue.qsize() or 'N/A')
-                
+        """
+        Starts the processor unless it already runs and blocks until it is stopped, Ctrl+C stops it.
+        """
+        if not self.started:
+            self.start()
+        try:
+            self._stopping.wait()
+        except KeyboardInterrupt:
+            logger.warning(f"Stopping workers, messages remaining: {self.pending()}")
+            self.stop()
+
+class Processor(BaseProcessor):
+    """
+    Runs handlers in pools of worker processes, payloads are pickled through a multiprocessing queue.
+    """
+    def __init__(self, num_workers: int = 4, max_batch: int = 64, min_workers: Optional[int] = None, idle_timeout: float = 0,
+                 high_water: int = 0, spill_dir: Optional[Union[str, Path]] = None, spill_max_mb: int = 512,
+                 scale_interval: float = 1.0, target_backlog: float = 2.0):
+        super().__init__(max_batch)
+        self.scale_interval = scale_interval
+        self.target_backlog = target_backlog
+        self._pid = os.getpid()
+        self._scaler: Optional[threading.Thread] = None
+        self.queue = self.add_stage(MAIN_STAGE, num_workers, min_workers=min_workers, idle_timeout=idle_timeout,
+                                    high_water=high_water, spill_dir=spill_dir, spill_max_mb=spill_max_mb).queue
+
+    @property
+    def workers(self) -> List[Worker]:
+        return [ w for stage in self.stages.values() for w in stage.workers ]
+
+    def add_stage(self, name: str, num_workers: int, max_queue: int = 0, max_batch: Optional[int] = None, min_workers: Optional[int] = None,
+                  idle_timeout: float = 0, high_water: int = 0, spill_dir: Optional[Union[str, Path]] = None, spill_max_mb: int = 512) -> Stage:
+        """
+        Creates a stage with its own queue and a pool of `min_workers` to `num_workers` workers (a fixed pool of
+        `num_workers` by default), it must be added before the processor starts.
+        """
+        if name in self.stages:
+            raise ValueError(f"Stage `{name}` already exists")
+        min_workers = num_workers if min_workers is None else min_workers
+        self.stages[name] = Stage(self, name, min_workers, num_workers, max_batch or self.max_batch, max_queue,
+                                  idle_timeout, high_water, spill_dir, spill_max_mb)
+        return self.stages[name]
+
+    def _put(self, message: Message, items: int):
+        workname = message[0]
+        stage = self.routes.get(workname) or self.stages[MAIN_STAGE]
+        # Only the process that owns the processor spills, workers handing work to the next stage wait for room instead
+        if workname in self.low_priority and os.getpid() == self._pid:
+            stage.admit(message, items)
+        else:
+            stage.put(message)
+        metrics.tasks_enqueued.labels(task=workname).inc(items)
+
+    def _run_scaler(self):
+        while not self._stopping.wait(self.scale_interval):
+            for stage in self.stages.values():
+                try:
+                    stage.scale(self.target_backlog)
+                except Exception as e:
+                    logger.error(f"Scaling stage {stage.name}: {e}")
+
+    def start(self):
+        """
+        Forks every worker, call it before starting any thread that could hold a lock while a worker forks.
+        """
+        for stage in self.stages.values():
+            for _ in range(stage.max_workers):
+                stage.spawn()
+            stage.activate(stage.min_workers)
+        self.started = True
+        self._scaler = threading.Thread(target=self._run_scaler, name='processor-scaler', daemon=True)
+        self._scaler.start()
+
+    def stop(self):
+        self._stopping.set()
+        if self._scaler is not None:
+            self._scaler.join()
+        for stage in self.stages.values():
+            stage.stop()
+        self._run_stop_hooks()
@@ -0,0 +1,125 @@
+import os
+import time
+import numpy as np
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+from loguru import logger
+from autotind.db import PersonRepo
+from autotind.person import Person
+from autotind.writer import FlushStats, GroupCommitWriter
+
+
+def load_model(path: str, threads: int = 0) -> Callable:
+    """
+    Returns a function of padded images and lengths to like probabilities. Files written by
+    `autotind.classifier.export` (.pt, .onnx) are run without Lightning, anything else is loaded as a checkpoint.
+    """
+    # Imported here so the proxy process never pays for torch when scoring is off
+    import torch
+    if threads:
+        torch.set_num_threads(threads)
+    start = time.perf_counter()
+    if os.path.splitext(path)[1] in ('.pt', '.onnx'):
+        from autotind.classifier.runtime import InferenceRunner
+        model = InferenceRunner(path, threads).predict
+    else:
+        from autotind.classifier.model import PersonClassifier
+        classifier = PersonClassifier.load_from_checkpoint(path, map_location='cpu').eval()
+        model = lambda imgs, lengths: classifier((imgs, lengths, None))[:, 1].numpy()
+    logger.info(f"Loaded scoring model {path} in {time.perf_counter() - start:.1f}s")
+    return model
+
+
+def to_input(img: np.ndarray) -> "torch.Tensor":
+    """
+    (H, W, 3) uint8 image to the normalized (3, H, W) float tensor the classifier was trained on.
+    """
+    import torch
+    from autotind.classifier.embedding_cache import normalize
+    return normalize(torch.from_numpy(img).permute(2, 0, 1).float() / 255)
+
+
+class OnlineScorer:
+    """
+    Scores the photos of freshly stored persons with a trained `PersonClassifier` and writes the like
+    probability of each photo, taken as a one-photo profile, to `PhotoDB.score`.
+
+    Persons are collected into micro-batches bounded by `max_batch` and `max_delay_ms`, each batch runs the
+    model once over all of its photos. The model is loaded lazily, once per worker process.
+    """
+    def __init__(self, repo: PersonRepo, checkpoint: str, max_batch: int = 32, max_delay_ms: float = 500, threads: int = 1, size: int = 224):
+        self.repo = repo
+        self.checkpoint = checkpoint
+        self.threads = threads
+        self.size = size
+        self.batcher = GroupCommitWriter(self._score_batch, max_items=max_batch, max_delay_ms=max_delay_ms)
+        self.photos_scored = 0
+        self.busy_s = 0.0
+        self.wait_ms: Deque[float] = deque(maxlen=1024)
+        self._model = None
+        self._pid = None
+
+    def _load_model(self) -> Callable:
+        if self._pid != os.getpid():
+            self._model = load_model(self.checkpoint, self.threads)
+            self._pid = os.getpid()
+        return self._model
+
+    def submit(self, persons: Sequence[Person]):
+        now = time.monotonic()
+        for person in persons:
+            self.batcher.add((now, person))
+
+    def flush(self):
+        self.batcher.flush()
+
+    def _load_images(self, persons: Sequence[Person]) -> Tuple[List[str], Any]:
+        import torch
+        from autotind.classifier.image_cache import load_resized
+
+        photos = [ photo for person in persons for photo in person.photos ]
+        # Photos just downloaded carry their hash, their references may not be committed yet
+        paths = self.repo.blob_paths(photo.get_key() for photo in photos if not photo.sha256)
+        ids, imgs = [], []
+        for photo in photos:
+            path = self.repo.store.path(photo.sha256) if photo.sha256 else paths.get(photo.get_key())
+            if path is None:
+                continue
+            try:
+                img = load_resized(path, self.size)
+            except Exception as e:
+                logger.warning(f"Could not score {path}: {e}")
+                continue
+            ids.append(photo.id)
+            imgs.append(to_input(img))
+        return ids, torch.stack(imgs) if imgs else None
+
+    def _score_batch(self, items: Sequence[Tuple[float, Person]]) -> List[Optional[Exception]]:
+        import torch
+        model = self._load_model()
+        start = time.perf_counter()
+        self.wait_ms.append((time.monotonic() - min(queued for queued, _ in items)) * 1000)
+
+        ids, imgs = self._load_images([ person for _, person in items ])
+        if imgs is not None:
+            with torch.inference_mode():
+                # Every photo as a profile of one
+                probs = model(imgs[:, None], torch.ones(len(ids), dtype=torch.long))
+            self.repo.record_scores([ { 'id': id, 'score': float(score) } for id, score in zip(ids, probs) ])
+            self.photos_scored += len(ids)
+
+        elapsed = time.perf_counter() - start
+        self.busy_s += elapsed
+        logger.debug(f"Scored {len(ids)} photos of {len(items)} persons in {elapsed * 1000:.0f}ms "
+                     f"({len(ids) / elapsed:.1f} photos/s, oldest waited {self.wait_ms[-1]:.0f}ms)")
+        return [None] * len(items)
+
+    def stats(self) -> Dict[str, float]:
+        waits = list(self.wait_ms)
+        return {
+            **self.batcher.stats.snapshot(),
+            'photos': self.photos_scored,
+            'photos_per_s': self.photos_scored / self.busy_s if self.busy_s else 0.0,
+            'wait_ms_p95': FlushStats._percentile(waits, 0.95),
+            'wait_ms_max': max(waits, default=0.0),
+        }
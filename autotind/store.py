@@ -0,0 +1,88 @@
+import os
+import time
+import uuid
+import hashlib
+from pathlib import Path
+from typing import Iterator, Tuple, Union
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def hash_file(path: Union[str, Path]) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def blob_path(root_dir: Union[str, Path], sha256: str) -> Path:
+    # Two levels of 256-way fan-out keep every directory small even with millions of blobs
+    return Path(root_dir) / 'blobs' / sha256[:2] / sha256[2:4] / sha256
+
+
+class BlobStore:
+    """
+    Content-addressed file store, a blob's name is the sha256 of its bytes so identical photos are stored once.
+    Files are written under `tmp/` and moved into place by `commit` once their hash is known.
+    """
+    def __init__(self, root_dir: Union[str, Path]):
+        self.root = Path(root_dir)
+        self.blob_dir = self.root / 'blobs'
+        self.tmp_dir = self.root / 'tmp'
+        self.tmp_dir.mkdir(parents=True, exist_ok=True)
+
+    def path(self, sha256: str) -> Path:
+        return blob_path(self.root, sha256)
+
+    def exists(self, sha256: str) -> bool:
+        return self.path(sha256).exists()
+
+    def tmp_path(self) -> Path:
+        return self.tmp_dir / f"{uuid.uuid4().hex}.part"
+
+    def commit(self, tmp_path: Path, sha256: str) -> bool:
+        """
+        Moves a finished temp file to its blob path, returns False if the blob was already stored.
+        """
+        path = self.path(sha256)
+        if path.exists():
+            tmp_path.unlink(missing_ok=True)
+            return False
+        path.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(tmp_path, path)
+        return True
+
+    def import_file(self, path: Path) -> Tuple[str, int]:
+        """
+        Moves a file stored outside the blob tree into it, returns its hash and size.
+        """
+        size = path.stat().st_size
+        sha256 = hash_file(path)
+        self.commit(path, sha256)
+        return sha256, size
+
+    def delete(self, sha256: str):
+        self.path(sha256).unlink(missing_ok=True)
+
+    def iter_blobs(self) -> Iterator[Tuple[str, os.stat_result]]:
+        if not self.blob_dir.exists():
+            return
+        for shard in os.scandir(self.blob_dir):
+            if not shard.is_dir():
+                continue
+            for sub in os.scandir(shard.path):
+                if not sub.is_dir():
+                    continue
+                for entry in os.scandir(sub.path):
+                    if entry.is_file():
+                        yield entry.name, entry.stat()
+
+    def clean_tmp(self, min_age: float) -> int:
+        cutoff = time.time() - min_age
+        removed = 0
+        for entry in os.scandir(self.tmp_dir):
+            if entry.is_file() and entry.stat().st_mtime < cutoff:
+                os.unlink(entry.path)
+                removed += 1
+        return removed
@@ -0,0 +1,120 @@
+import os
+import time
+import threading
+from collections import deque
+from loguru import logger
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence
+
+
+class FlushStats:
+    def __init__(self, window: int = 1024):
+        self.sizes: Deque[int] = deque(maxlen=window)
+        self.latencies_ms: Deque[float] = deque(maxlen=window)
+        self.flushes = 0
+        self.items = 0
+        self.failed_items = 0
+        self._lock = threading.Lock()
+
+    def record(self, size: int, latency_ms: float, failed: int):
+        with self._lock:
+            self.sizes.append(size)
+            self.latencies_ms.append(latency_ms)
+            self.flushes += 1
+            self.items += size
+            self.failed_items += failed
+
+    @staticmethod
+    def _percentile(values: List[float], q: float) -> float:
+        if not values:
+            return 0.0
+        values = sorted(values)
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            sizes = list(self.sizes)
+            latencies = list(self.latencies_ms)
+            flushes, items, failed = self.flushes, self.items, self.failed_items
+        return {
+            'flushes': flushes,
+            'items': items,
+            'failed_items': failed,
+            'size_mean': sum(sizes) / len(sizes) if sizes else 0.0,
+            'size_max': max(sizes, default=0),
+            'latency_ms_mean': sum(latencies) / len(latencies) if latencies else 0.0,
+            'latency_ms_p50': self._percentile(latencies, 0.5),
+            'latency_ms_p95': self._percentile(latencies, 0.95),
+            'latency_ms_max': max(latencies, default=0.0),
+        }
+
+
+class GroupCommitWriter:
+    """
+    Buffers items and hands them to `flush_fn` as one batch once `max_items` are queued
+    or the oldest item has waited `max_delay_ms`.
+
+    `flush_fn` receives the batch and returns one entry per item: None on success or the exception
+    that item raised, so a single bad item never fails the rest of the batch.
+    """
+    def __init__(self, flush_fn: Callable[[Sequence[Any]], List[Optional[Exception]]], max_items: int = 20, max_delay_ms: float = 200):
+        self.flush_fn = flush_fn
+        self.max_items = max_items
+        self.max_delay = max_delay_ms / 1000
+        self.stats = FlushStats()
+        self._buffer: List[Any] = []
+        self._oldest: Optional[float] = None
+        self._cond = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._timer: Optional[threading.Thread] = None
+        self._pid = None
+
+    def _ensure_timer(self):
+        # The timer thread is per process, a forked child needs its own
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._timer = threading.Thread(target=self._run_timer, name='group-commit', daemon=True)
+            self._timer.start()
+
+    def add(self, item: Any):
+        with self._cond:
+            self._ensure_timer()
+            self._buffer.append(item)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+                self._cond.notify()
+            full = len(self._buffer) >= self.max_items
+        if full:
+            self.flush()
+
+    def _take(self) -> List[Any]:
+        with self._cond:
+            batch, self._buffer = self._buffer, []
+            self._oldest = None
+            return batch
+
+    def flush(self):
+        with self._flush_lock:
+            batch = self._take()
+            if not batch:
+                return
+            start = time.perf_counter()
+            try:
+                errors = self.flush_fn(batch)
+            except Exception as e:
+                errors = [e] * len(batch)
+            latency_ms = (time.perf_counter() - start) * 1000
+            failed = [ (item, e) for item, e in zip(batch, errors) if e is not None ]
+            for item, e in failed:
+                logger.error(f"Write failed for {item}: {e}")
+            self.stats.record(len(batch), latency_ms, len(failed))
+
+    def _run_timer(self):
+        while True:
+            with self._cond:
+                while self._oldest is None:
+                    self._cond.wait()
+                remaining = self._oldest + self.max_delay - time.monotonic()
+                if remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+            self.flush()
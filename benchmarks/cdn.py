@@ -0,0 +1,115 @@
+import io
+import time
+import threading
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from PIL import Image
+
+
+def make_jpeg(width: int, height: int, seed: int = 0) -> bytes:
+    noise = np.random.default_rng(seed).integers(0, 255, (height, width, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(noise).save(buffer, 'JPEG', quality=85)
+    return buffer.getvalue()
+
+
+class LocalCDN:
+    """
+    Stands in for the photo CDN. Any path is answered with a noise JPEG at the size the path asks for
+    (`/<user>/<w>x<h>_<file>`, originals use `original_size`), followed by the path itself after the end-of-image
+    marker so every photo hashes differently. `latency_ms` delays every response.
+
+    `fail` and `truncate` queue faults for a path, they are served before its photo. `hits` counts every request
+    per path, `requests` and `bytes_sent` only the photos served in full.
+    """
+    def __init__(self, host: str = '127.0.0.1', port: int = 0, latency_ms: float = 0, original_size=(1080, 1350)):
+        self.latency = latency_ms / 1000
+        self.original_size = original_size
+        self.requests = 0
+        self.bytes_sent = 0
+        self.hits = Counter()
+        self._faults = defaultdict(list)
+        self._images = {}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name='local-cdn', daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _image(self, width: int, height: int) -> bytes:
+        with self._lock:
+            if (width, height) not in self._images:
+                self._images[(width, height)] = make_jpeg(width, height)
+            return self._images[(width, height)]
+
+    def _body(self, path: str) -> bytes:
+        name = path.rsplit('/', 1)[-1]
+        size = name.split('_', 1)[0]
+        try:
+            width, height = (int(v) for v in size.split('x'))
+        except ValueError:
+            width, height = self.original_size
+        return self._image(width, height) + path.encode()
+
+    def fail(self, path: str, status: int, times: int = 1):
+        with self._lock:
+            self._faults[path].extend([status] * times)
+
+    def truncate(self, path: str, times: int = 1):
+        """
+        Sends half the photo with the Content-Length of all of it, then closes the connection.
+        """
+        with self._lock:
+            self._faults[path].extend(['truncate'] * times)
+
+    def _fault(self, path: str):
+        with self._lock:
+            self.hits[path] += 1
+            faults = self._faults.get(path)
+            return faults.pop(0) if faults else None
+
+    def _handler(self):
+        cdn = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if cdn.latency:
+                    time.sleep(cdn.latency)
+                fault = cdn._fault(self.path)
+                if isinstance(fault, int):
+                    self.send_error(fault)
+                    return
+                body = cdn._body(self.path)
+                if fault == 'truncate':
+                    self.send_response(200)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body[:len(body) // 2])
+                    self.close_connection = True
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                with cdn._lock:
+                    cdn.requests += 1
+                    cdn.bytes_sent += len(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self) -> "LocalCDN":
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
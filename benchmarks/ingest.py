@@ -0,0 +1,275 @@
+"""
+End-to-end ingest benchmark: synthetic flows go through InterceptorMiddleware -> Processor -> handlers -> PersonRepo,
+photos are downloaded from a local CDN. Runs against a throwaway database and image directory.
+
+    python -m benchmarks.ingest --recs 40 --recs-size 20 --rate 10 --save bench.json
+    python -m benchmarks.ingest --recs 40 --recs-size 20 --rate 10 --baseline bench.json
+    python -m benchmarks.ingest --recs 40 --recs-size 20 --rate 10 --backend asyncio --baseline bench.json
+"""
+import sys
+import json
+import time
+import asyncio
+import inspect
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import multiprocessing as mp
+from collections import defaultdict
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Tuple
+import numpy as np
+from loguru import logger
+from mitmproxy import http
+from autotind.config import config
+from benchmarks.cdn import LocalCDN
+from benchmarks.synthetic import ProfileFactory, like_flow, matches_flow, pass_flow, recs_flow
+
+
+def _percentiles(values: List[float]) -> Dict[str, float]:
+    if not values:
+        return { 'n': 0, 'p50': 0.0, 'p95': 0.0, 'p99': 0.0, 'max': 0.0 }
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return { 'n': len(values), 'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'max': float(max(values)) }
+
+
+def build_flows(args: argparse.Namespace, cdn_url: str) -> List[Tuple[str, http.HTTPFlow]]:
+    """
+    Every recs page is followed by swipes on some of its profiles, every `matches_every` pages a matches page
+    lists some of the liked profiles. Flows are built up front so building them is not timed.
+    """
+    factory = ProfileFactory(cdn_url, args.photos, seed=args.seed)
+    rand = random.Random(args.seed)
+    flows, liked = [], []
+    for page in range(args.recs):
+        users = [ factory.user() for _ in range(args.recs_size) ]
+        flows.append(('recs', recs_flow(users)))
+        for user in rand.sample(users, min(args.swipes, len(users))):
+            if rand.random() < 0.5:
+                flows.append(('like', like_flow(user['_id'])))
+                liked.append(user)
+            else:
+                flows.append(('pass', pass_flow(user['_id'])))
+        if args.matches_every and (page + 1) % args.matches_every == 0 and liked:
+            flows.append(('matches', matches_flow(rand.sample(liked, min(args.matches_size, len(liked))))))
+    return flows
+
+
+def instrument(processor, timings: mp.Queue):
+    """
+    Stamps every payload with its enqueue time and wraps the registered handlers to report queue wait and handler
+    time through `timings`. Workers are forked or run in this process, so wrapping before they start is enough.
+    """
+    add_work, add_work_batch = processor.add_work, processor.add_work_batch
+    processor.add_work = lambda workname, data=None: add_work(workname, (time.time(), data))
+    def stamped_batch(workname: str, items):
+        now = time.time()
+        add_work_batch(workname, [ (now, item) for item in items ])
+    processor.add_work_batch = stamped_batch
+
+    def timed(workname: str, handler: Callable, batch: bool) -> Callable:
+        def unstamp(payload: Any) -> Any:
+            return [ item for _, item in payload ] if batch else payload[1]
+
+        def report(payload: Any, started_at: float, start: float):
+            handler_ms = (time.perf_counter() - start) * 1000
+            stamped = payload if batch else [payload]
+            timings.put((workname, [ (started_at - queued) * 1000 for queued, _ in stamped ], handler_ms, time.time()))
+
+        if inspect.iscoroutinefunction(handler):
+            async def run_async(payload: Any):
+                started_at, start = time.time(), time.perf_counter()
+                try:
+                    await handler(unstamp(payload))
+                finally:
+                    report(payload, started_at, start)
+            return run_async
+
+        def run(payload: Any):
+            started_at, start = time.time(), time.perf_counter()
+            try:
+                handler(unstamp(payload))
+            finally:
+                report(payload, started_at, start)
+        return run
+
+    for workname, handler in list(processor.handlers.items()):
+        processor.handlers[workname] = timed(workname, handler, False)
+    for workname, handler in list(processor.batch_handlers.items()):
+        processor.batch_handlers[workname] = timed(workname, handler, True)
+
+
+async def replay(processor, middleware, flows: List[Tuple[str, http.HTTPFlow]], rate: float) -> Tuple[Dict[str, List[float]], float, float]:
+    """
+    Feeds the flows to the middleware from an event loop, as mitmproxy does, and waits until everything queued was
+    handled. Returns the hook latencies per flow kind, when the replay started and how long it took.
+    """
+    hook_ms = defaultdict(list)
+    interval = 1 / rate if rate else 0
+    start_wall, start = time.time(), time.perf_counter()
+    for idx, (kind, flow) in enumerate(flows):
+        # Yield between flows even without a rate, handlers of the asyncio backend run on this loop
+        await asyncio.sleep(max(0.0, start + idx * interval - time.perf_counter()) if interval else 0)
+        hook_start = time.perf_counter()
+        middleware.response(flow)
+        hook_ms[kind].append((time.perf_counter() - hook_start) * 1000)
+    offered_s = time.perf_counter() - start
+
+    # Let the pools scale and spilled recs come back before stopping, stop() would only drain the queues
+    while sum(processor.pending().values()):
+        await asyncio.sleep(0.05)
+    return hook_ms, start_wall, offered_s
+
+
+def run(args: argparse.Namespace) -> Dict[str, Any]:
+    work_dir = Path(tempfile.mkdtemp(prefix='autotind-bench-'))
+    config.set('DB_URL', f"sqlite:///{work_dir / 'bench.sqlite'}")
+    config.set('IMG_SAVE_PATH', str(work_dir / 'images'))
+    config.set('SCORING_CHECKPOINT', None)
+
+    # Imported after the config points at the throwaway database
+    from autotind import metrics
+    from autotind.db import PersonDB, PersonRepo, PhotoDB
+    from autotind.flow_utils import InterceptorMiddleware
+    from autotind.async_processor import AsyncProcessor
+    from autotind.processor import Processor
+    from flows import DislikeInterceptor, LikeInterceptor, MatchInterceptor, RecsInterceptor
+    from handlers import register_work_handlers
+
+    cdn = LocalCDN(latency_ms=args.cdn_latency_ms).start()
+    try:
+        flows = build_flows(args, cdn.url)
+        if args.backend == 'asyncio':
+            processor = AsyncProcessor(num_workers=args.workers, max_batch=config.PROCESSOR_MAX_BATCH, high_water=args.high_water,
+                                       spill_dir=work_dir / 'spill')
+        else:
+            processor = Processor(num_workers=args.workers, max_batch=config.PROCESSOR_MAX_BATCH, min_workers=args.min_workers,
+                                  idle_timeout=config.PROCESSOR_IDLE_TIMEOUT, high_water=args.high_water, spill_dir=work_dir / 'spill')
+        register_work_handlers(processor)
+        timings: mp.Queue = mp.Queue()
+        instrument(processor, timings)
+        middleware = InterceptorMiddleware([
+            RecsInterceptor(processor),
+            LikeInterceptor(processor),
+            DislikeInterceptor(processor),
+            MatchInterceptor(processor)
+        ])
+
+        tasks = defaultdict(lambda: { 'queue_wait_ms': [], 'handler_ms': [], 'items': 0 })
+        last_done = [0.0]
+        def collect():
+            while True:
+                message = timings.get()
+                # Put once every worker has stopped, a worker's timings are all sent before it exits
+                if message is None:
+                    return
+                workname, waits, handler_ms, done_at = message
+                tasks[workname]['queue_wait_ms'].extend(waits)
+                tasks[workname]['handler_ms'].append(handler_ms)
+                tasks[workname]['items'] += len(waits)
+                last_done[0] = max(last_done[0], done_at)
+        collector = threading.Thread(target=collect, daemon=True)
+        collector.start()
+
+        processor.start()
+        hook_ms, start_wall, offered_s = asyncio.run(replay(processor, middleware, flows, args.rate))
+        processor.stop()
+        timings.put(None)
+        collector.join()
+
+        repo = PersonRepo(config.DB_URL)
+        session = repo.Session()
+        try:
+            persons = session.query(PersonDB).count()
+            photos = session.query(PhotoDB).count()
+        finally:
+            session.close()
+        ingest_s = max(last_done[0] - start_wall, 1e-9)
+        admission = { name: metrics.total(counter) for name, counter in (('spilled', metrics.tasks_spilled), ('shed', metrics.tasks_shed)) }
+        return {
+            'backend': args.backend,
+            'flows': len(flows),
+            'offered_flows_per_s': len(flows) / offered_s if offered_s else 0.0,
+            'admission': admission,
+            'hook_ms': { kind: _percentiles(values) for kind, values in hook_ms.items() },
+            'tasks': {
+                workname: {
+                    'items': stats['items'],
+                    'calls': len(stats['handler_ms']),
+                    'queue_wait_ms': _percentiles(stats['queue_wait_ms']),
+                    'handler_ms': _percentiles(stats['handler_ms']),
+                } for workname, stats in tasks.items()
+            },
+            'ingest': {
+                'persons': persons,
+                'photos': photos,
+                'seconds': ingest_s,
+                'persons_per_s': persons / ingest_s,
+                'photos_per_s': photos / ingest_s,
+                'cdn_requests': cdn.requests,
+                'cdn_mib': cdn.bytes_sent / 2**20,
+            },
+        }
+    finally:
+        cdn.stop()
+        if not args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        else:
+            logger.info(f"Kept benchmark data in {work_dir}")
+
+
+def compare(result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float, min_delta_ms: float = 1.0) -> List[str]:
+    """
+    Lists regressions beyond `tolerance` (a fraction) in ingest throughput and p95 hook latency.
+    Hook latencies are sub-millisecond, so they must also grow by `min_delta_ms` to count.
+    """
+    regressions = []
+    old, new = baseline['ingest']['persons_per_s'], result['ingest']['persons_per_s']
+    if new < old * (1 - tolerance):
+        regressions.append(f"ingest throughput {new:.1f} persons/s, baseline {old:.1f}")
+    for kind, stats in result['hook_ms'].items():
+        old = baseline['hook_ms'].get(kind, {}).get('p95')
+        if old and stats['p95'] > old * (1 + tolerance) and stats['p95'] - old > min_delta_ms:
+            regressions.append(f"{kind} hook p95 {stats['p95']:.2f}ms, baseline {old:.2f}ms")
+    return regressions
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description="Replay synthetic Tinder flows through the ingest pipeline and measure it")
+    arg_parser.add_argument('--recs', type=int, default=20, help="Number of recs pages")
+    arg_parser.add_argument('--recs-size', type=int, default=20, help="Profiles per recs page")
+    arg_parser.add_argument('--photos', type=int, default=4, help="Photos per profile")
+    arg_parser.add_argument('--swipes', type=int, default=10, help="Likes/passes after each recs page")
+    arg_parser.add_argument('--matches-every', type=int, default=5, help="A matches page after every N recs pages, 0 for none")
+    arg_parser.add_argument('--matches-size', type=int, default=10)
+    arg_parser.add_argument('--rate', type=float, default=0, help="Flows per second, 0 to replay as fast as possible")
+    arg_parser.add_argument('--backend', choices=['process', 'asyncio'], default=config.PROCESSOR_BACKEND)
+    arg_parser.add_argument('--workers', type=int, default=config.PROCESSOR_WORKERS)
+    arg_parser.add_argument('--min-workers', type=int, default=None, help="Let the main pool scale between this and --workers, process backend only")
+    arg_parser.add_argument('--high-water', type=int, default=0, help="Spill recs past this many queued messages, 0 to never spill")
+    arg_parser.add_argument('--cdn-latency-ms', type=float, default=20)
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--keep', action='store_true', help="Keep the benchmark database and images")
+    arg_parser.add_argument('--save', default=None, help="Write the results to this JSON file")
+    arg_parser.add_argument('--baseline', default=None, help="Compare against results saved with --save, exit 1 on regression")
+    arg_parser.add_argument('--tolerance', type=float, default=0.2)
+    arg_parser.add_argument('--min-delta-ms', type=float, default=1.0, help="Ignore hook latency changes smaller than this")
+    arg_parser.add_argument('--log-level', default='WARNING', help="Handlers log every profile at INFO")
+    args = arg_parser.parse_args()
+
+    logger.remove()
+    logger.add(sys.stderr, level=args.log_level)
+    result = run(args)
+    print(json.dumps(result, indent=2))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(result, json.load(f), args.tolerance, args.min_delta_ms)
+        for regression in regressions:
+            logger.error(f"Regression: {regression}")
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,82 @@
+import json
+import random
+import uuid
+from datetime import date, timedelta
+from typing import List, Optional
+from mitmproxy import http
+from mitmproxy.test import tflow, tutils
+
+
+class ProfileFactory:
+    """
+    Builds Tinder-shaped user objects whose photos point at `cdn_url`. Every photo gets a unique path,
+    so the CDN serves distinct bytes for it and the blob store can't deduplicate them away.
+    """
+    def __init__(self, cdn_url: str, photos_per_person: int = 4, seed: Optional[int] = None):
+        self.cdn_url = cdn_url.rstrip('/')
+        self.photos_per_person = photos_per_person
+        self.random = random.Random(seed)
+
+    def _id(self) -> str:
+        return uuid.UUID(int=self.random.getrandbits(128)).hex[:24]
+
+    def photo(self, user_id: str, rank: int) -> dict:
+        photo_id = str(uuid.UUID(int=self.random.getrandbits(128)))
+        file_name = f"{photo_id}.jpg"
+        return {
+            'id': photo_id,
+            'url': f"{self.cdn_url}/{user_id}/original_{file_name}",
+            'fileName': file_name,
+            'extension': 'jpg',
+            'crop_info': { 'processed_by_bullseye': True, 'user_customized': False },
+            'media_type': 'image',
+            'rank': rank,
+            'processedFiles': [
+                { 'url': f"{self.cdn_url}/{user_id}/{width}x{height}_{file_name}", 'width': width, 'height': height }
+                for width, height in ((640, 800), (320, 400), (172, 216), (84, 106))
+            ],
+        }
+
+    def user(self) -> dict:
+        user_id = self._id()
+        birth_date = date(1990, 1, 1) + timedelta(days=self.random.randrange(365 * 12))
+        return {
+            '_id': user_id,
+            'name': self.random.choice(['Alex', 'Sam', 'Charlie', 'Jordan', 'Robin', 'Noa']),
+            'bio': ' '.join(self.random.choice(['coffee', 'hiking', 'dogs', 'travel', 'books', 'music']) for _ in range(12)),
+            'birth_date': f"{birth_date.isoformat()}T00:00:00.000Z",
+            'gender': self.random.choice([0, 1]),
+            'distance_mi': self.random.randrange(1, 50),
+            'photos': [ self.photo(user_id, rank) for rank in range(self.photos_per_person) ],
+            # Fields the extractor drops, kept so parsing and trimming cost what they cost in production
+            'badges': [],
+            'jobs': [ { 'title': { 'name': 'Engineer' } } ],
+            'schools': [ { 'name': 'University' } ],
+            'spotify_top_artists': [ { 'id': self._id(), 'name': 'Artist', 'top_track': { 'name': 'Track' } } for _ in range(5) ],
+        }
+
+
+def _flow(method: str, path: str, body: Optional[dict] = None) -> http.HTTPFlow:
+    content = json.dumps(body).encode() if body is not None else b''
+    request = tutils.treq(method=method.encode(), host='api.gotinder.com', port=443, scheme=b'https', path=path.encode())
+    response = tutils.tresp(content=content)
+    response.headers['content-type'] = 'application/json'
+    return tflow.tflow(req=request, resp=response)
+
+
+def recs_flow(users: List[dict]) -> http.HTTPFlow:
+    results = [ { 'type': 'user', 'user': user, 'distance_mi': user['distance_mi'], 's_number': 0 } for user in users ]
+    return _flow('GET', '/v2/recs/core?locale=en', { 'meta': { 'status': 200 }, 'data': { 'results': results } })
+
+
+def matches_flow(users: List[dict]) -> http.HTTPFlow:
+    matches = [ { '_id': f"{user['_id']}match", 'person': user, 'closed': False, 'dead': False } for user in users ]
+    return _flow('GET', '/v2/matches?count=60&message=0', { 'meta': { 'status': 200 }, 'data': { 'matches': matches } })
+
+
+def like_flow(user_id: str) -> http.HTTPFlow:
+    return _flow('POST', f"/like/{user_id}", { 'status': 200, 'match': False, 'likes_remaining': 100 })
+
+
+def pass_flow(user_id: str) -> http.HTTPFlow:
+    return _flow('GET', f"/pass/{user_id}", { 'status': 200 })
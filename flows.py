@@ -2,80 +2,67 @@ import json
 from typing import Any
 from mitmproxy import http
 from autotind.flow_utils import BaseInterceptor
-from loguru import logger
+from autotind.extract import extract_matches, extract_recs
 from handlers import WorkTypes
-from autotind.processor import Processor
+from autotind.processor import BaseProcessor
 
 class LocationInterceptor(BaseInterceptor):
+    method = 'POST'
+    path = r'/v2/meta'
+
     def __init__(self, processor):
         self.processor = processor
 
-    def accepts(self, flow: http.HTTPFlow):
-        return "/v2/meta" in flow.request.path_url and flow.request.method == "POST"
-
     def process(self, flow: http.HTTPFlow, body: Any) -> None:
         flow.response.set_content(json.dumps({ "lat": 45.538099, "lon": -73.604520, "force_fetch_resources": True}))
 
 class RecsInterceptor(BaseInterceptor):
-    def __init__(self, processor: Processor) -> None:
+    method = 'GET'
+    path = r'/v2/recs'
+
+    def __init__(self, processor: BaseProcessor) -> None:
         super().__init__()
         self.processor = processor
 
-    def accepts(self, flow: http.HTTPFlow) -> bool:
-        return "/v2/recs" in flow.request.path and flow.request.method == 'GET'
-
     def process(self, flow: http.HTTPFlow, body: Any) -> None:
         if not body:
             return
-        data = body.get('data', {})
-        results = data.get('results', [])
-        for result in results:
-            result_data = result.get('user')
-            if not result_data:
-                logger.warning(f"Rec data missing: {result}")
-            self.processor.add_work(WorkTypes.add_rec.value, result_data)
+        self.processor.add_work_batch(WorkTypes.add_rec.value, extract_recs(body))
                 
 class LikeInterceptor(BaseInterceptor):
-    def __init__(self, processor: Processor) -> None:
+    method = 'POST'
+    path = r'/like/'
+
+    def __init__(self, processor: BaseProcessor) -> None:
         super().__init__()
         self.processor = processor
     
-    def accepts(self, flow: http.HTTPFlow) -> bool:
-        return "/like/" in flow.request.path and flow.request.method == 'POST'
-
     def process(self, flow: http.HTTPFlow, body: Any) -> None:
         _, id = flow.request.path_components
         self.processor.add_work(WorkTypes.like.value, id)
 
 class DislikeInterceptor(BaseInterceptor):
-    def __init__(self, processor: Processor) -> None:
+    method = 'GET'
+    path = r'/pass/'
+
+    def __init__(self, processor: BaseProcessor) -> None:
         super().__init__()
         self.processor = processor
     
-    def accepts(self, flow: http.HTTPFlow) -> bool:
-        return "/pass/" in flow.request.path and flow.request.method == 'GET'
-
     def process(self, flow: http.HTTPFlow, body: Any) -> None:
         _, id = flow.request.path_components
         self.processor.add_work(WorkTypes.dislike.value, id)
 
 
 class MatchInterceptor(BaseInterceptor):
-    def __init__(self, processor: Processor) -> None:
+    method = 'GET'
+    path = r'/v2/matches'
+
+    def __init__(self, processor: BaseProcessor) -> None:
         super().__init__()
         self.processor = processor
     
-    def accepts(self, flow: http.HTTPFlow) -> bool:
-        return "/v2/matches" in flow.request.path and flow.request.method == 'GET'
-
     def process(self, flow: http.HTTPFlow, body: Any) -> None:
         if not body:
             return
-        data = body.get('data', {})
-        matches = data.get('matches', [])
-        for match in matches:
-            match_data = match.get('person')
-            if not match_data:
-                logger.warning(f"No person data in match: {match}")
-                continue
-            self.processor.add_work(WorkTypes.add_match.value, match_data)
\ No newline at end of file
+        self.processor.add_work_batch(WorkTypes.add_match.value, extract_matches(body))
\ No newline at end of file
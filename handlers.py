@@ -1,8 +1,13 @@
+import asyncio
 from enum import Enum
+from typing import List, Union
 from loguru import logger
 from autotind.person import Label, Person
-from autotind.processor import Processor
-from autotind.db import PersonRepo
+from autotind.processor import BaseProcessor
+from autotind.db import PersonRepo, make_async_downloader
+from autotind.dedup import ProfileCache
+from autotind.scoring import OnlineScorer
+from autotind.config import config
 
 
 class WorkTypes(Enum):
@@ -10,31 +15,92 @@ class WorkTypes(Enum):
     like = 'like'
     dislike = 'dislike'
     add_match = 'add_match'
+    download_photos = 'download_photos'
 
-def register_work_handlers(processor: Processor):
-    personRepo = PersonRepo('sqlite:///tind.sqlite')
+DOWNLOAD_STAGE = 'download'
 
-    @processor.handler(WorkTypes.add_rec.value)
-    def handle_recs(data: dict):
-        try:
-            person = Person.from_dict({ **data, 'label': Label.REC.value })
+def register_work_handlers(processor: BaseProcessor) -> PersonRepo:
+    # Rows are committed by the main stage, photos follow in a separate pool so a slow CDN never holds a DB worker
+    processor.add_stage(DOWNLOAD_STAGE, num_workers=config.DOWNLOAD_WORKERS, max_queue=config.DOWNLOAD_QUEUE_SIZE,
+                        min_workers=config.DOWNLOAD_MIN_WORKERS, idle_timeout=config.PROCESSOR_IDLE_TIMEOUT)
+    personRepo = PersonRepo(config.DB_URL, single_writer=config.DB_SINGLE_WRITER)
+    if config.DB_SINGLE_WRITER:
+        personRepo.start_writer()
+        # After the stages, the workers hand it their last rows as they stop
+        processor.after_stop(personRepo.stop_writer)
+    profileCache = ProfileCache(personRepo, max_size=config.PROFILE_CACHE_SIZE)
+    scorer = None
+    if config.SCORING_CHECKPOINT:
+        scorer = OnlineScorer(personRepo, config.SCORING_CHECKPOINT, max_batch=config.SCORING_BATCH_SIZE,
+                              max_delay_ms=config.SCORING_BATCH_MS, threads=config.SCORING_THREADS)
+
+    def upsert_persons(items: List[dict], label: Label, kind: str):
+        persons = []
+        for data in items:
+            person = Person.from_dict({ **data, 'label': label.value })
             if person:
-                logger.info(f"Intercepted Rec: {person.name}")
-                personRepo.upsert(person)
+                logger.info(f"Intercepted {kind}: {person.name}")
+                persons.append(person)
+            else:
+                logger.warning(f"Ignored {kind}: {data.get('_id')}")
+        changed = profileCache.filter_changed(persons)
+        # Unchanged profiles aren't written again, their sighting still counts for `seen_since`
+        changed_ids = { person._id for person in changed }
+        personRepo.mark_seen([ person._id for person in persons if person._id not in changed_ids ])
+        persons = changed
+        errors = personRepo.upsert_many(persons, download=False)
+        for person, e in zip(persons, errors):
+            if e:
+                logger.error(f"{person}: {e}")
+        written = [ person for person, e in zip(persons, errors) if not e ]
+        # Their fingerprints are stored with their photos: if the downloads fail, the next sighting stores them again
+        processor.add_work_batch(WorkTypes.download_photos.value, written)
+
+    # Recs are shown again later, swipes and matches are not: recs are the work to spill or drop under load
+    @processor.batch_handler(WorkTypes.add_rec.value, low_priority=True)
+    def handle_recs(items: List[dict]):
+        upsert_persons(items, Label.REC, 'rec')
+
+    @processor.batch_handler(WorkTypes.add_match.value)
+    def handle_matches(items: List[dict]):
+        upsert_persons(items, Label.MATCH, 'match')
+
+    def downloaded(persons: List[Person], results: List[Union[Person, Exception]]):
+        stored = []
+        for person, result in zip(persons, results):
+            if isinstance(result, Exception):
+                logger.error(f"{person}: {result}")
             else:
-                logger.warning(f"Ignored rec: {data.get('_id')}")
-        except Exception as e:
-            logger.error(e)
+                stored.append(result)
+        if scorer is not None:
+            # With the hashes of their new photos, the references may still be queued for the writer
+            scorer.submit(stored)
+
+    if processor.is_async:
+        downloader = make_async_downloader()
 
+        @processor.batch_handler(WorkTypes.download_photos.value, stage=DOWNLOAD_STAGE)
+        async def download_photos_async(persons: List[Person]):
+            results = await personRepo.download_photos_async(persons, downloader)
+            await asyncio.to_thread(downloaded, persons, results)
 
-    @processor.handler(WorkTypes.add_match.value)
-    def handle_matches(data: dict):
-        person = Person.from_dict({ **data, 'label': Label.MATCH.value })
-        if person:
-            logger.info(f"Intercepted match: {person.name}")
-            personRepo.upsert(person)
-        else:
-            logger.warning(f"Ignored match: {data.get('_id')}")
+        @processor.on_shutdown
+        def close_downloader():
+            # Hooks run in a thread, the session belongs to the processor's loop
+            asyncio.run_coroutine_threadsafe(downloader.close(), processor.loop).result()
+    else:
+        @processor.batch_handler(WorkTypes.download_photos.value, stage=DOWNLOAD_STAGE)
+        def download_photos(persons: List[Person]):
+            downloaded(persons, personRepo.download_photos(persons))
+
+    @processor.on_shutdown
+    def flush_writes():
+        personRepo.flush()
+        logger.info(f"Group commit stats: {personRepo.flush_stats()}")
+        logger.info(f"Profile cache stats: {profileCache.stats()}")
+        if scorer is not None:
+            scorer.flush()
+            logger.info(f"Scoring stats: {scorer.stats()}")
 
     @processor.handler(WorkTypes.like.value)
     def add_like(id: str):
@@ -45,3 +111,5 @@ def register_work_handlers(processor: Processor):
     def add_dislike(id: str):
         logger.info(f"Dislike: {id}")
         personRepo.dislike(id)
+
+    return personRepo
@@ -1,15 +1,50 @@
 #!/bin/env python
+import os
+import shutil
 import asyncio
 import threading
+from autotind.config import config
+
+if config.METRICS_PORT:
+    # prometheus_client picks its multiprocess mode on first import, so before anything imports autotind.metrics.
+    # Files left by an earlier run would be summed in.
+    shutil.rmtree(config.METRICS_DIR, ignore_errors=True)
+    os.makedirs(config.METRICS_DIR)
+    os.environ['PROMETHEUS_MULTIPROC_DIR'] = config.METRICS_DIR
+
 from mitmproxy import options
 from mitmproxy.tools import dump
 from autotind.flow_utils import InterceptorMiddleware
 from flows import DislikeInterceptor, LikeInterceptor, MatchInterceptor, RecsInterceptor
 from handlers import register_work_handlers
 from autotind.processor import Processor
+from autotind.async_processor import AsyncProcessor
+from autotind.integrity import PhotoVerifier
+from autotind.metrics import MetricsServer, profiler
 
-processor = Processor()
-register_work_handlers(processor)
+if config.PROCESSOR_BACKEND == 'asyncio':
+    # Handlers run on a loop of their own in this process, no worker processes
+    processor = AsyncProcessor(
+        num_workers=config.PROCESSOR_WORKERS,
+        max_batch=config.PROCESSOR_MAX_BATCH,
+        high_water=config.PROCESSOR_HIGH_WATER,
+        spill_dir=config.PROCESSOR_SPILL_DIR,
+        spill_max_mb=config.PROCESSOR_SPILL_MAX_MB,
+        scale_interval=config.PROCESSOR_SCALE_INTERVAL,
+    )
+else:
+    processor = Processor(
+        num_workers=config.PROCESSOR_WORKERS,
+        max_batch=config.PROCESSOR_MAX_BATCH,
+        min_workers=config.PROCESSOR_MIN_WORKERS,
+        idle_timeout=config.PROCESSOR_IDLE_TIMEOUT,
+        high_water=config.PROCESSOR_HIGH_WATER,
+        spill_dir=config.PROCESSOR_SPILL_DIR,
+        spill_max_mb=config.PROCESSOR_SPILL_MAX_MB,
+        scale_interval=config.PROCESSOR_SCALE_INTERVAL,
+        target_backlog=config.PROCESSOR_TARGET_BACKLOG,
+    )
+personRepo = register_work_handlers(processor)
 
 async def start_proxy(host, port):
     opts = options.Options(listen_host=host, listen_port=port)
@@ -35,10 +70,19 @@ async def start_proxy(host, port):
         master.shutdown()
     return master
 
+def start_verifier():
+    if config.PHOTO_VERIFY_INTERVAL:
+        PhotoVerifier(personRepo, interval=config.PHOTO_VERIFY_INTERVAL).start()
+
 def run_proxy():
     asyncio.run(start_proxy("*", 3000))
 
 if __name__ == '__main__':
+    # Workers fork here, before this process starts a thread of its own
+    processor.start()
+    if config.METRICS_PORT:
+        MetricsServer(profiler, config.METRICS_HOST, config.METRICS_PORT).start()
+    start_verifier()
     t = threading.Thread(target=run_proxy)
     t.start()
     processor.run()
@@ -0,0 +1,58 @@
+import time
+import threading
+from autotind.async_processor import AsyncProcessor
+
+
+def test_full_stage_holds_back_the_stage_feeding_it():
+    processor = AsyncProcessor(num_workers=2)
+    processor.add_stage('slow', num_workers=1, max_queue=2, max_batch=1)
+    stage = processor.stages['slow']
+    depths, handled = [], []
+
+    @processor.handler('feed')
+    def feed(i):
+        processor.add_work('slow', i)
+        depths.append(stage.queued())
+
+    @processor.handler('slow', stage='slow')
+    def slow(i):
+        time.sleep(0.01)
+        handled.append(i)
+
+    processor.start()
+    for i in range(30):
+        processor.add_work('feed', i)
+    stopper = threading.Thread(target=processor.stop, daemon=True)
+    stopper.start()
+    stopper.join(timeout=30)
+
+    assert not stopper.is_alive()
+    assert sorted(handled) == list(range(30))
+    assert max(depths) <= 2
+
+
+def test_unbounded_stage_takes_work_without_waiting_for_the_loop():
+    processor = AsyncProcessor(num_workers=1)
+    handled = []
+
+    @processor.handler('block')
+    async def block(seconds):
+        # Holds the processor's loop
+        time.sleep(seconds)
+
+    @processor.handler('count')
+    def count(i):
+        handled.append(i)
+
+    processor.start()
+    processor.add_work('block', 1.0)
+    time.sleep(0.1)
+    start = time.perf_counter()
+    for i in range(100):
+        processor.add_work('count', i)
+    elapsed = time.perf_counter() - start
+    assert processor.pending()['main'] == 100
+    processor.stop()
+
+    assert elapsed < 0.5
+    assert sorted(handled) == list(range(100))
@@ -0,0 +1,47 @@
+import os
+from autotind.bulk_score import BulkScorer
+from autotind.db import PersonRepo
+from tests.test_db import make_persons
+
+
+def ids(scorer: BulkScorer, after, since):
+    return [ row['_id'] for page in scorer._pages(after, since) for row in page ]
+
+
+def test_a_finished_pass_is_followed_by_the_persons_updated_since(tmp_path):
+    repo = PersonRepo(f"sqlite:///{tmp_path / 'test.sqlite'}", img_root=tmp_path / 'images')
+    model_path = tmp_path / 'model.pt'
+    model_path.write_bytes(b'model')
+    old, new = make_persons(2)
+    repo.write_many([old])
+
+    # A pass over everyone finished, then a person was added
+    finished = BulkScorer(repo, str(model_path), tmp_path / 'bulk_score.json', workers=1)
+    finished._save_checkpoint(old._id, None, done=True)
+    repo.write_many([new])
+
+    scorer = BulkScorer(repo, str(model_path), tmp_path / 'bulk_score.json', workers=1)
+    after, since = scorer._load_checkpoint()
+    assert (after, since) == (None, finished.started_at)
+    assert ids(scorer, after, since) == [new._id]
+
+    # A retrained model at the same path scores everyone again
+    os.utime(model_path, ns=(0, 0))
+    assert BulkScorer(repo, str(model_path), tmp_path / 'bulk_score.json', workers=1)._load_checkpoint() == (None, None)
+
+
+def test_an_unfinished_pass_resumes_with_its_selection(tmp_path):
+    repo = PersonRepo(f"sqlite:///{tmp_path / 'test.sqlite'}", img_root=tmp_path / 'images')
+    model_path = tmp_path / 'model.pt'
+    model_path.write_bytes(b'model')
+    persons = sorted(make_persons(3), key=lambda person: person._id)
+    repo.write_many(persons)
+
+    interrupted = BulkScorer(repo, str(model_path), tmp_path / 'bulk_score.json', workers=1)
+    interrupted._save_checkpoint(persons[0]._id, None)
+
+    scorer = BulkScorer(repo, str(model_path), tmp_path / 'bulk_score.json', workers=1)
+    after, since = scorer._load_checkpoint()
+    assert (after, since) == (persons[0]._id, None)
+    assert scorer.started_at == interrupted.started_at
+    assert ids(scorer, after, since) == [ person._id for person in persons[1:] ]
@@ -0,0 +1,21 @@
+import pickle
+import numpy as np
+from autotind.classifier.cache import SlotCache
+
+
+def test_pickled_cache_reloads_its_index(tmp_path):
+    cache = SlotCache(tmp_path, 'vectors', (4,), 'f4')
+    cache.capacity = 2
+    with open(cache.data_path, 'wb') as f:
+        f.truncate(2 * 4 * 4)
+    data = cache.writable()
+    data[1] = np.arange(4)
+    data.flush()
+    cache.commit([ (1, f"photo-{i}", f"{i}.jpg", [i, i]) for i in range(1000) ])
+
+    payload = pickle.dumps(cache)
+    assert b'photo-999' not in payload
+    child = pickle.loads(payload)
+    assert len(child) == 1000
+    assert child.get('photo-999', '999.jpg').tolist() == [0, 1, 2, 3]
+    assert child.get('photo-999', 'moved.jpg') is None
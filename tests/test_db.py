@@ -0,0 +1,156 @@
+import sys
+import hashlib
+import subprocess
+from dataclasses import replace
+from datetime import datetime, timedelta
+from pathlib import Path
+import pytest
+from sqlalchemy import event
+from autotind.db import BlobDB, PendingLabelDB, PersonDB, PersonRepo, PhotoDB, PhotoFileDB
+from autotind.person import Label, Person
+from benchmarks.cdn import LocalCDN
+from benchmarks.synthetic import ProfileFactory
+
+
+@pytest.fixture
+def repo(tmp_path):
+    return PersonRepo(f"sqlite:///{tmp_path / 'test.sqlite'}", img_root=tmp_path / 'images')
+
+
+def make_persons(n: int, photos: int = 2):
+    factory = ProfileFactory('http://cdn.local', photos, seed=0)
+    return [ Person.from_dict({ **factory.user(), 'label': 'rec' }) for _ in range(n) ]
+
+
+def store_blob(repo: PersonRepo, body: bytes) -> dict:
+    tmp_path = repo.store.tmp_path()
+    tmp_path.write_bytes(body)
+    sha256 = hashlib.sha256(body).hexdigest()
+    repo.store.commit(tmp_path, sha256)
+    return repo._blob_row(sha256, len(body))
+
+
+def test_refs_to_collected_blobs_are_dropped(repo):
+    [person] = make_persons(1)
+    repo.write_many([person])
+    blob = store_blob(repo, b'photo')
+    repo.record_files([], [{ **blob, 'created_at': datetime.utcnow() - timedelta(days=1) }])
+
+    # A download found the blob already stored, then the collector ran before its reference was written
+    assert repo.collect_garbage(min_age=timedelta(hours=1))['unreferenced_blobs'] == 1
+    photo = person.photos[0]
+    repo.record_files([ repo._ref_row(photo.get_key(), photo.id, blob['sha256'], blob['size']) ], [blob])
+
+    session = repo.Session()
+    try:
+        assert session.query(PhotoFileDB).count() == 0
+        assert session.query(BlobDB).count() == 0
+        assert session.get(PersonDB, person._id).fingerprint is None
+    finally:
+        session.close()
+
+
+def test_photo_files_load_with_the_photos(repo):
+    persons = make_persons(3)
+    repo.write_many(persons)
+    for person in persons:
+        for photo in person.photos:
+            blob = store_blob(repo, photo.id.encode())
+            repo.record_files([ repo._ref_row(photo.get_key(), photo.id, blob['sha256'], blob['size']) ], [blob])
+
+    statements = []
+    event.listen(repo.engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+    session = repo.Session()
+    try:
+        photos = [ photo.to_photo() for photo in session.query(PhotoDB) ]
+    finally:
+        session.close()
+
+    assert len(photos) == 6 and all(photo.sha256 for photo in photos)
+    assert len([ s for s in statements if s.lstrip().upper().startswith('SELECT') ]) == 2
+
+
+def test_seen_since_counts_unchanged_sightings(repo):
+    old, fresh = make_persons(2)
+    repo.write_many([old, fresh])
+    cutoff = datetime.utcnow()
+    assert repo.query().seen_since(cutoff).count() == 0
+
+    # Seen again unchanged: the dedup skips the upsert, only the sighting is recorded
+    repo.mark_seen([fresh._id])
+    repo.flush()
+    assert repo.query().seen_since(cutoff).ids() == [fresh._id]
+
+
+def test_count_applies_the_limit(repo):
+    repo.write_many(make_persons(5))
+    assert repo.query().count() == 5
+    assert repo.query().limit(3).count() == len(repo.query().limit(3).ids()) == 3
+
+
+def test_pending_swipes_never_undo_a_match(repo):
+    rec, match = make_persons(2)
+    match = replace(match, label=Label.MATCH.value)
+    repo.write_labels([ (rec._id, Label.LIKE.value), (match._id, Label.LIKE.value) ])
+    repo.write_many([rec, match])
+
+    session = repo.Session()
+    try:
+        assert session.get(PersonDB, rec._id).label == Label.LIKE.value
+        assert session.get(PersonDB, match._id).label == Label.MATCH.value
+        assert session.query(PendingLabelDB).count() == 0
+    finally:
+        session.close()
+
+
+WRITER_SCRIPT = """
+import sys
+from autotind.db import PersonRepo
+from tests.test_db import make_persons
+
+repo = PersonRepo(sys.argv[1], single_writer=True, img_root=sys.argv[2])
+repo.start_writer()
+assert repo.upsert_many(make_persons(5), download=False) == [None] * 5
+repo.mark_seen([ person._id for person in make_persons(5) ])
+# No stop_writer: the interpreter must still exit, and only once the writer committed everything
+"""
+
+
+def test_single_writer_commits_and_exits_with_the_interpreter(tmp_path):
+    db_url = f"sqlite:///{tmp_path / 'test.sqlite'}"
+    subprocess.run([sys.executable, '-c', WRITER_SCRIPT, db_url, str(tmp_path / 'images')],
+                   cwd=Path(__file__).parent.parent, timeout=60, check=True)
+
+    repo = PersonRepo(db_url, img_root=tmp_path / 'images')
+    assert repo.query().count() == 5
+
+
+def test_batched_upserts_count_in_the_flush_stats(repo):
+    persons = make_persons(3)
+    persons.append(replace(persons[0], _id='no-photos', photos=[]))
+    errors = repo.upsert_many(persons, download=False)
+
+    assert errors[:3] == [None] * 3 and errors[3] is not None
+    stats = repo.flush_stats()['upserts']
+    assert (stats['flushes'], stats['items'], stats['failed_items']) == (1, 3, 0)
+
+
+def test_fingerprint_is_stored_with_the_photos(tmp_path):
+    cdn = LocalCDN(original_size=(120, 150)).start()
+    try:
+        repo = PersonRepo(f"sqlite:///{tmp_path / 'test.sqlite'}", img_root=tmp_path / 'images')
+        factory = ProfileFactory(cdn.url, 2, seed=0)
+        ok, failing = [ Person.from_dict({ **factory.user(), 'label': 'rec' }) for _ in range(2) ]
+        for photo in failing.photos:
+            for url, _ in photo.downloads():
+                cdn.fail(url[len(cdn.url):], 403)
+
+        assert repo.upsert_many([ok, failing], download=False) == [None, None]
+        # Written, but as if never seen until the photos are stored
+        assert repo.fingerprints([ok._id, failing._id]) == { ok._id: None, failing._id: None }
+
+        results = repo.download_photos([ok, failing])
+        assert isinstance(results[1], Exception)
+        assert repo.fingerprints([ok._id, failing._id]) == { ok._id: ok.fingerprint(), failing._id: None }
+    finally:
+        cdn.stop()
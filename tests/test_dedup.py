@@ -0,0 +1,55 @@
+from dataclasses import replace
+import pytest
+from autotind.db import PersonRepo
+from autotind.dedup import ProfileCache
+from autotind.person import Label
+from tests.test_db import make_persons
+
+
+@pytest.fixture
+def repo(tmp_path):
+    return PersonRepo(f"sqlite:///{tmp_path / 'test.sqlite'}", img_root=tmp_path / 'images')
+
+
+def store(repo: PersonRepo, persons):
+    repo.write_many(persons)
+    repo.record_files([], [], { person._id: person.fingerprint() for person in persons })
+
+
+def test_unchanged_profiles_are_dropped(repo):
+    stored, written, new = make_persons(3)
+    store(repo, [stored])
+    # Written, but its photos never were
+    repo.write_many([written])
+    cache = ProfileCache(repo)
+
+    assert cache.filter_changed([stored, written, new]) == [written, new]
+    assert cache.filter_changed([stored, written, new]) == [written, new]
+    stats = cache.stats()
+    assert (stats['lru_hits'], stats['db_hits'], stats['misses']) == (1, 1, 4)
+
+
+def test_a_rec_seen_again_as_a_match_is_changed(repo):
+    [person] = make_persons(1)
+    store(repo, [person])
+    cache = ProfileCache(repo)
+    assert cache.filter_changed([person]) == []
+
+    match = replace(person, label=Label.MATCH)
+    assert cache.filter_changed([match]) == [match]
+    # Edited photos count as a change too
+    edited = replace(person, photos=person.photos[1:])
+    assert cache.filter_changed([edited]) == [edited]
+
+
+def test_least_recently_seen_profiles_are_evicted(repo):
+    persons = make_persons(3)
+    store(repo, persons)
+    cache = ProfileCache(repo, max_size=2)
+
+    assert cache.filter_changed(persons) == []
+    assert cache.stats()['size'] == 2
+    # The first one was evicted and is looked up in the database again, the others stay in memory
+    assert cache.filter_changed(persons) == []
+    stats = cache.stats()
+    assert (stats['lru_hits'], stats['db_hits'], stats['misses']) == (2, 4, 0)
@@ -0,0 +1,72 @@
+import hashlib
+import pytest
+from autotind.downloader import PhotoDownloader
+from benchmarks.cdn import LocalCDN
+
+
+@pytest.fixture
+def cdn():
+    cdn = LocalCDN().start()
+    yield cdn
+    cdn.stop()
+
+
+@pytest.fixture
+def downloader():
+    downloader = PhotoDownloader(max_concurrency=4, per_call_concurrency=2, retries=2, backoff_factor=0, timeout=5)
+    yield downloader
+    downloader.close()
+
+
+def leftovers(path):
+    return sorted(p.name for p in path.iterdir())
+
+
+def test_download_hashes_and_renames(cdn, downloader, tmp_path):
+    jobs = [ (f"{cdn.url}/user/320x400_{i}.jpg", tmp_path / f"{i}.jpg") for i in range(3) ]
+    results = downloader.download(jobs)
+
+    for (url, path), result in zip(jobs, results):
+        body = cdn._body(url[len(cdn.url):])
+        assert result.error is None
+        assert path.read_bytes() == body
+        assert (result.size, result.sha256) == (len(body), hashlib.sha256(body).hexdigest())
+    assert leftovers(tmp_path) == ['0.jpg', '1.jpg', '2.jpg']
+
+
+def test_download_retries_server_errors(cdn, downloader, tmp_path):
+    cdn.fail('/user/original_a.jpg', 503, times=2)
+    [result] = downloader.download([ (f"{cdn.url}/user/original_a.jpg", tmp_path / 'a.jpg') ])
+
+    assert result.error is None
+    assert cdn.hits['/user/original_a.jpg'] == 3
+    assert result.sha256 == hashlib.sha256(cdn._body('/user/original_a.jpg')).hexdigest()
+
+
+def test_download_gives_up_after_retries(cdn, downloader, tmp_path):
+    cdn.fail('/user/original_a.jpg', 503, times=3)
+    [result] = downloader.download([ (f"{cdn.url}/user/original_a.jpg", tmp_path / 'a.jpg') ])
+
+    assert result.error is not None and result.error.status_code == 503
+    assert cdn.hits['/user/original_a.jpg'] == 3
+    assert leftovers(tmp_path) == []
+
+
+def test_download_does_not_retry_client_errors(cdn, downloader, tmp_path):
+    cdn.fail('/user/original_a.jpg', 403)
+    [result] = downloader.download([ (f"{cdn.url}/user/original_a.jpg", tmp_path / 'a.jpg') ])
+
+    assert result.error.status_code == 403
+    assert cdn.hits['/user/original_a.jpg'] == 1
+
+
+def test_truncated_download_leaves_no_part_file(cdn, downloader, tmp_path):
+    cdn.truncate('/user/original_a.jpg')
+    results = downloader.download([
+        (f"{cdn.url}/user/original_a.jpg", tmp_path / 'a.jpg'),
+        (f"{cdn.url}/user/original_b.jpg", tmp_path / 'b.jpg'),
+    ])
+
+    assert results[0].error is not None
+    assert results[1].error is None
+    assert leftovers(tmp_path) == ['b.jpg']
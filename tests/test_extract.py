@@ -0,0 +1,100 @@
+from autotind.extract import select_variant, trim_person
+
+
+def make_user(**extra):
+    return {
+        '_id': 'u1',
+        'name': 'Ana',
+        'birth_date': '1995-01-01T00:00:00.000Z',
+        'bio': 'hi',
+        'spotify_top_artists': [{ 'name': 'x' * 1000 }],
+        'instagram': { 'photos': [ 'y' * 1000 ] },
+        'photos': [
+            {
+                'id': 'p1',
+                'url': 'https://images-ssl.gotinder.com/u1/original_p1.jpg',
+                'fileName': 'p1.jpg',
+                'crop_info': { 'processed_by_bullseye': True },
+                'media_type': 'image',
+                'processedFiles': [
+                    { 'url': 'https://images-ssl.gotinder.com/u1/640x800_p1.jpg', 'width': 640, 'height': 800 },
+                    { 'url': 'https://images-ssl.gotinder.com/u1/320x400_p1.jpg', 'width': 320, 'height': 400 },
+                ],
+            },
+            'not a photo',
+        ],
+        **extra,
+    }
+
+
+def test_trim_person_keeps_only_what_person_reads():
+    record = trim_person(make_user(label='like'))
+
+    assert set(record) == { '_id', 'name', 'birth_date', 'bio', 'photos' }
+    assert record['photos'] == [{
+        'id': 'p1',
+        'url': 'https://images-ssl.gotinder.com/u1/original_p1.jpg',
+        'fileName': 'p1.jpg',
+        'crop_info': { 'processed_by_bullseye': True },
+        'media_type': 'image',
+    }]
+
+
+def test_trim_person_without_an_id():
+    assert trim_person(make_user(_id=None)) is None
+    assert trim_person(None) is None
+    assert trim_person(['u1']) is None
+
+
+def variant(width, height):
+    return { 'url': f"https://images-ssl.gotinder.com/u1/{width}x{height}_p1.jpg", 'width': width, 'height': height }
+
+
+def test_select_variant_picks_the_smallest_large_enough():
+    photo = { 'processedFiles': [ variant(640, 800), variant(84, 106), variant(320, 400), variant(172, 216) ] }
+
+    assert select_variant(photo, 320) == variant(320, 400)
+    # The shorter side decides, 320x400 is too small for 400
+    assert select_variant(photo, 400) == variant(640, 800)
+    assert select_variant(photo, 100) == variant(172, 216)
+
+
+def test_select_variant_falls_back_to_the_original():
+    photo = { 'processedFiles': [ variant(320, 400), variant(640, 800) ] }
+
+    assert select_variant(photo, 1080) is None
+    assert select_variant(photo, None) is None
+    assert select_variant(photo, 0) is None
+    assert select_variant({}, 320) is None
+    assert select_variant({ 'processedFiles': None }, 320) is None
+
+
+def test_select_variant_skips_variants_without_size_metadata():
+    photo = { 'processedFiles': [
+        { 'url': 'https://images-ssl.gotinder.com/u1/a.jpg' },
+        { 'url': 'https://images-ssl.gotinder.com/u1/b.jpg', 'width': None, 'height': 400 },
+        { 'url': 'https://images-ssl.gotinder.com/u1/c.jpg', 'width': 'wide', 'height': 400 },
+        { 'width': 320, 'height': 400 },
+        { 'url': '', 'width': 320, 'height': 400 },
+        variant(640, 800),
+    ] }
+
+    assert select_variant(photo, 320) == variant(640, 800)
+    assert select_variant({ 'processedFiles': photo['processedFiles'][:5] }, 320) is None
+
+
+def test_trim_person_swaps_in_the_variant():
+    original = 'https://images-ssl.gotinder.com/u1/original_p1.jpg'
+
+    photo = trim_person(make_user(), min_size=320)['photos'][0]
+    assert photo['url'] == variant(320, 400)['url']
+    assert (photo['width'], photo['height']) == (320, 400)
+    assert 'original_url' not in photo
+
+    photo = trim_person(make_user(), min_size=320, keep_original=True)['photos'][0]
+    assert photo['original_url'] == original
+
+    # Nothing large enough, the original is kept without a size
+    photo = trim_person(make_user(), min_size=1080, keep_original=True)['photos'][0]
+    assert photo['url'] == original
+    assert 'width' not in photo and 'original_url' not in photo
@@ -0,0 +1,36 @@
+from autotind.flow_utils import BaseInterceptor, InterceptorMiddleware
+from benchmarks.synthetic import like_flow, pass_flow
+
+
+class Recorder(BaseInterceptor):
+    def __init__(self):
+        self.seen = []
+
+    def process(self, flow, body):
+        self.seen.append(flow.request.path)
+
+
+class LikeRecorder(Recorder):
+    method = 'POST'
+    path = r'^/like/'
+
+
+class Routeless(Recorder):
+    pass
+
+
+class PassRecorder(Recorder):
+    def accepts(self, flow):
+        return flow.request.path.startswith('/pass/')
+
+
+def test_routes_and_fallbacks():
+    like, routeless, passes = LikeRecorder(), Routeless(), PassRecorder()
+    middleware = InterceptorMiddleware([like, routeless, passes])
+    middleware.response(like_flow('a'))
+    middleware.response(pass_flow('b'))
+
+    assert like.seen == ['/like/a']
+    assert passes.seen == ['/pass/b']
+    # Without a route or an `accepts` of its own, an interceptor matches nothing
+    assert routeless.seen == []
@@ -0,0 +1,25 @@
+import io
+import queue
+from PIL import Image
+from autotind.db import PersonRepo
+from autotind.integrity import PhotoVerifier
+from tests.test_db import store_blob
+
+
+def jpeg(color) -> bytes:
+    out = io.BytesIO()
+    Image.new('RGB', (8, 8), color).save(out, format='JPEG')
+    return out.getvalue()
+
+
+def test_back_to_back_batches_check_each_blob_once(tmp_path):
+    repo = PersonRepo(f"sqlite:///{tmp_path / 'test.sqlite'}", img_root=tmp_path / 'images')
+    blobs = [ store_blob(repo, jpeg((i * 40, 0, 0))) for i in range(5) ]
+    repo.record_files([], blobs)
+    # As with a single writer: the checks are queued, not written yet
+    repo.writer_queue = queue.Queue()
+    verifier = PhotoVerifier(repo, batch_size=2)
+
+    assert [ verifier.verify_batch() for _ in range(3) ] == [2, 2, 1]
+    checks = [ blob['sha256'] for _ in range(repo.writer_queue.qsize()) for blob in repo.writer_queue.get()[1] ]
+    assert sorted(checks) == sorted(blob['sha256'] for blob in blobs)
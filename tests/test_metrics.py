@@ -0,0 +1,32 @@
+import os
+import sys
+import subprocess
+
+SCRIPT = """
+from prometheus_client import CollectorRegistry, generate_latest, multiprocess
+from autotind.processor import Processor
+
+processor = Processor(num_workers=2)
+
+@processor.handler('count')
+def count(_):
+    pass
+
+processor.start()
+for i in range(50):
+    processor.add_work('count', i)
+processor.stop()
+
+registry = CollectorRegistry()
+multiprocess.MultiProcessCollector(registry)
+print(generate_latest(registry).decode())
+"""
+
+
+def test_worker_metrics_are_summed_across_processes(tmp_path):
+    env = { **os.environ, 'PROMETHEUS_MULTIPROC_DIR': str(tmp_path) }
+    out = subprocess.run([sys.executable, '-c', SCRIPT], env=env, capture_output=True, text=True, timeout=60, check=True).stdout
+
+    # Handlers ran in the workers only, their values outlive them
+    assert 'autotind_task_seconds_count{task="count"} 50.0' in out
+    assert 'autotind_tasks_enqueued_total{task="count"} 50.0' in out
@@ -0,0 +1,70 @@
+import pickle
+import time
+import threading
+import multiprocessing as mp
+from autotind.processor import Processor, SpillFile
+
+
+def test_stop_hands_every_worker_its_sentinel():
+    processor = Processor(num_workers=3, max_batch=64)
+    handled = mp.Value('l', 0)
+
+    @processor.handler('count')
+    def count(_):
+        with handled.get_lock():
+            handled.value += 1
+
+    processor.start()
+    for i in range(200):
+        processor.add_work('count', i)
+    # Sentinels are queued right behind the work, one worker's drain could reach several of them
+    stopper = threading.Thread(target=processor.stop, daemon=True)
+    stopper.start()
+    stopper.join(timeout=30)
+
+    assert not stopper.is_alive()
+    assert handled.value == 200
+    assert not any(w.is_alive() for w in processor.workers)
+
+
+def test_spill_file_drops_a_torn_write(tmp_path):
+    spill = SpillFile(tmp_path / 'main.spill', 2**20)
+    spill.append(('a', 1, False, 0.0))
+    spill._file.write(pickle.dumps(('b', 'x' * 100, False, 0.0))[:40])
+    spill._file.close()
+
+    spill = SpillFile(tmp_path / 'main.spill', 2**20)
+    assert len(spill) == 1
+    spill.append(('c', 3, False, 0.0))
+    assert [ message[0] for message in spill.pop(10) ] == ['a', 'c']
+    assert len(spill) == 0
+
+
+def test_idle_workers_park_and_wake_up_without_forking():
+    processor = Processor(num_workers=3, max_batch=1, min_workers=1, idle_timeout=1, scale_interval=0.1)
+    stage = processor.stages['main']
+
+    @processor.handler('sleep')
+    def sleep(seconds):
+        time.sleep(seconds)
+
+    processor.start()
+    pids = { w.pid for w in processor.workers }
+    assert len(pids) == 3 and stage.live.value == 1
+
+    for _ in range(100):
+        processor.add_work('sleep', 0.05)
+    deadline = time.monotonic() + 10
+    while stage.live.value < 3 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    assert stage.live.value == 3
+
+    deadline = time.monotonic() + 10
+    while stage.live.value > 1 and time.monotonic() < deadline:
+        time.sleep(0.1)
+    assert stage.live.value == 1
+    # The idle ones parked instead of exiting
+    assert { w.pid for w in stage.alive() } == pids
+
+    processor.stop()
+    assert not any(w.is_alive() for w in processor.workers)
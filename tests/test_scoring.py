@@ -0,0 +1,33 @@
+import pytest
+from autotind.db import PersonRepo, PhotoFileDB
+from autotind.person import Person
+from autotind.scoring import OnlineScorer
+from benchmarks.cdn import LocalCDN
+from benchmarks.synthetic import ProfileFactory
+
+
+@pytest.fixture
+def cdn():
+    cdn = LocalCDN(original_size=(120, 150)).start()
+    yield cdn
+    cdn.stop()
+
+
+def test_new_photos_are_scored_before_their_references_are_committed(tmp_path, cdn):
+    repo = PersonRepo(f"sqlite:///{tmp_path / 'test.sqlite'}", img_root=tmp_path / 'images')
+    factory = ProfileFactory(cdn.url, 2, seed=0)
+    person = Person.from_dict({ **factory.user(), 'label': 'rec' })
+    repo.write_many([person])
+
+    [stored] = repo.download_photos([person])
+    assert all(photo.sha256 for photo in stored.photos)
+
+    # As if the references were still queued for the single writer
+    session = repo.Session()
+    session.query(PhotoFileDB).delete()
+    session.commit()
+    session.close()
+
+    ids, imgs = OnlineScorer(repo, 'unused.pt', size=32)._load_images([stored])
+    assert ids == [ photo.id for photo in person.photos ]
+    assert tuple(imgs.shape) == (2, 3, 32, 32)